@@ -0,0 +1,339 @@
+'''
+	Operators that apply coding functions (e.g., Fourier, Haar, Gray codes) to batches of transients/histograms without
+	materializing dense n x K coding matrices, and their adjoint/decoding operations.
+	All operators encode along the last dimension of (... x n) tensors into (... x K) coded measurements, which is
+	equivalent to transient @ coding_mat, where coding_mat is the matrix returned by the operator's to_dense().
+'''
+## Standard Library Imports
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from . import fft_ops
+from .signalproc_ops import get_fourier_mat, haar_matrix, generate_gray_code, circular_corr, circular_subbin_argmax, get_dominant_freqs, get_low_confidence_freqs
+from .np_utils import to_nparray, vectorize_tensor, get_chunk_slices, calc_gram_matrix, is_mutually_orthogonal
+from .shared_constants import *
+
+class FourierProjection:
+	'''
+		Project transients onto a subset of frequencies of the DFT, i.e., transient @ get_fourier_mat(n, freq_idx).
+		For real transients the coefficients are sliced from the rfft (O(n log n) per transient). When only a few frequencies
+		are needed (K <= max_matmul_freqs, by default log2(n)), the projection is a matmul with the n x K fourier matrix (O(n K)).
+	'''
+	def __init__(self, n, freq_idx, max_matmul_freqs=None):
+		self.n = n
+		self.freq_idx = to_nparray(freq_idx).astype(np.int64) % n
+		self.n_freqs = self.freq_idx.size
+		if(max_matmul_freqs is None): max_matmul_freqs = int(np.log2(n))
+		self.use_matmul = (self.n_freqs <= max_matmul_freqs)
+		# Frequencies above the nyquist frequency are the conjugate of the mirrored rfft frequency
+		self.is_conj_freq = self.freq_idx > (n // 2)
+		self.rfft_idx = np.where(self.is_conj_freq, n - self.freq_idx, self.freq_idx)
+		if(self.use_matmul):
+			# Same as get_fourier_mat, but in double precision
+			phase = (np.arange(0, n)[:, np.newaxis]*self.freq_idx[np.newaxis, :] % n)*(TWOPI / n)
+			self.fourier_mat = np.exp(-1j*phase)
+		else: self.fourier_mat = None
+
+	def encode(self, x):
+		'''
+			Compute the K coded measurements (fourier coefficients) of a (... x n) tensor. Returns a complex (... x K) tensor.
+		'''
+		x = to_nparray(x)
+		assert(x.shape[-1] == self.n), "input needs to have n={} elements along the last dimension".format(self.n)
+		if(self.use_matmul):
+			return x @ self.fourier_mat.astype(fft_ops.get_complex_dtype(x.dtype), copy=False)
+		if(not fft_ops.is_real(x)):
+			return fft_ops.fft(x, axis=-1)[..., self.freq_idx]
+		f_x = fft_ops.rfft(x, axis=-1)[..., self.rfft_idx]
+		return np.where(self.is_conj_freq, f_x.conj(), f_x)
+
+	def get_full_spectrum(self, coeffs):
+		f_y = np.zeros(coeffs.shape[0:-1] + (self.n,), dtype=fft_ops.get_complex_dtype(coeffs.dtype))
+		np.add.at(f_y, (Ellipsis, self.freq_idx), coeffs)
+		return f_y
+
+	def adjoint(self, coeffs):
+		'''
+			Adjoint of encode, i.e., conj(fourier_mat) @ coeffs. Maps (... x K) coefficients to a complex (... x n) tensor.
+		'''
+		coeffs = to_nparray(coeffs)
+		assert(coeffs.shape[-1] == self.n_freqs), "input needs to have K={} elements along the last dimension".format(self.n_freqs)
+		if(self.use_matmul):
+			return coeffs @ self.fourier_mat.conj().transpose().astype(fft_ops.get_complex_dtype(coeffs.dtype), copy=False)
+		return fft_ops.ifft(self.get_full_spectrum(coeffs), axis=-1)*self.n
+
+	def decode(self, coeffs):
+		'''
+			Reconstruct the real band-limited (... x n) signal whose fourier coefficients at freq_idx are coeffs, and that is
+			zero at all other frequencies (i.e., the least-squares reconstruction from the coded measurements).
+		'''
+		coeffs = to_nparray(coeffs)
+		assert(coeffs.shape[-1] == self.n_freqs), "input needs to have K={} elements along the last dimension".format(self.n_freqs)
+		f_y = np.zeros(coeffs.shape[0:-1] + ((self.n // 2) + 1,), dtype=fft_ops.get_complex_dtype(coeffs.dtype))
+		f_y[..., self.rfft_idx] = np.where(self.is_conj_freq, coeffs.conj(), coeffs)
+		return fft_ops.irfft(f_y, n=self.n, axis=-1)
+
+	def to_dense(self):
+		return get_fourier_mat(self.n, self.freq_idx)
+
+def is_power_of_2(n):
+	return (n > 0) and ((n & (n - 1)) == 0)
+
+def fwht(x):
+	'''
+		Fast (unnormalized) Walsh-Hadamard transform along the last dimension, in natural (Hadamard) order.
+		Same as x @ scipy.linalg.hadamard(n), in O(n log n). n needs to be a power of 2.
+	'''
+	x = to_nparray(x)
+	n = x.shape[-1]
+	assert(is_power_of_2(n)), "fwht is only implemented for powers of 2"
+	batch_shape = x.shape[0:-1]
+	y = x.astype(np.result_type(x.dtype, np.float32))
+	half_block_len = 1
+	while(half_block_len < n):
+		# Butterfly between the elements whose index differs in the bit of half_block_len
+		y = y.reshape(batch_shape + (n // (2*half_block_len), 2, half_block_len))
+		y = np.stack((y[..., 0, :] + y[..., 1, :], y[..., 0, :] - y[..., 1, :]), axis=-2)
+		half_block_len *= 2
+	return y.reshape(batch_shape + (n,))
+
+class HaarOperator:
+	'''
+		Haar coding functions with n_levels levels, i.e., the columns of haar_matrix(n, n_levels).
+		encode computes transient @ haar_matrix(n, n_levels) in O(n) with a pyramid of pairwise sums and differences.
+	'''
+	def __init__(self, n, n_levels):
+		assert(n_levels >= 0), "n_levels should be non-negative"
+		self.n = n
+		self.n_levels = n_levels
+		self.n_codes = np.power(2, n_levels)
+		assert((n % self.n_codes) == 0), "only implemented multiples of 2^n_levels"
+		self.finest_block_len = n // self.n_codes
+		# Squared norm of each code. The first code has norm n, and codes at level i have norm n / 2^(i-1)
+		self.codes_sq_norm = np.ones((self.n_codes,))*n
+		for i in range(1, n_levels+1): self.codes_sq_norm[np.power(2, i-1):np.power(2, i)] = n / np.power(2, i-1)
+
+	def encode(self, x):
+		x = to_nparray(x)
+		assert(x.shape[-1] == self.n), "input needs to have n={} elements along the last dimension".format(self.n)
+		batch_shape = x.shape[0:-1]
+		coded_x = np.zeros(batch_shape + (self.n_codes,), dtype=np.result_type(x.dtype, np.float32))
+		# Sums over the finest blocks, and then go up the pyramid
+		block_sums = x.reshape(batch_shape + (self.n_codes, self.finest_block_len)).sum(axis=-1)
+		for i in range(self.n_levels, 0, -1):
+			coded_x[..., np.power(2, i-1):np.power(2, i)] = block_sums[..., 0::2] - block_sums[..., 1::2]
+			block_sums = block_sums[..., 0::2] + block_sums[..., 1::2]
+		coded_x[..., 0] = block_sums[..., 0]
+		return coded_x
+
+	def adjoint(self, coded_x):
+		'''
+			Compute haar_matrix(n, n_levels) @ coded_x (for each ... x K coded vector)
+		'''
+		coded_x = to_nparray(coded_x)
+		assert(coded_x.shape[-1] == self.n_codes), "input needs to have K={} elements along the last dimension".format(self.n_codes)
+		batch_shape = coded_x.shape[0:-1]
+		y = coded_x[..., 0:1]
+		for i in range(1, self.n_levels+1):
+			level_codes = coded_x[..., np.power(2, i-1):np.power(2, i)]
+			y = np.stack((y + level_codes, y - level_codes), axis=-1).reshape(batch_shape + (np.power(2, i),))
+		return np.repeat(y, self.finest_block_len, axis=-1)
+
+	def inverse(self, coded_x):
+		'''
+			Least-squares reconstruction from the coded measurements (the haar codes are orthogonal). 
+			If 2^n_levels == n this is the exact inverse of encode.
+		'''
+		return self.adjoint(coded_x / self.codes_sq_norm)
+
+	def to_dense(self):
+		return haar_matrix(self.n, self.n_levels)
+
+class WalshHadamardOperator:
+	'''
+		Walsh-Hadamard coding functions, i.e., the columns code_idx of scipy.linalg.hadamard(n) (natural order).
+		encode computes all the walsh coefficients with the fast walsh-hadamard transform in O(n log n) and selects code_idx.
+	'''
+	def __init__(self, n, code_idx=None):
+		assert(is_power_of_2(n)), "n needs to be a power of 2"
+		self.n = n
+		if(code_idx is None): code_idx = np.arange(0, n)
+		self.code_idx = to_nparray(code_idx).astype(np.int64)
+		self.n_codes = self.code_idx.size
+
+	def encode(self, x):
+		x = to_nparray(x)
+		assert(x.shape[-1] == self.n), "input needs to have n={} elements along the last dimension".format(self.n)
+		return fwht(x)[..., self.code_idx]
+
+	def adjoint(self, coded_x):
+		coded_x = to_nparray(coded_x)
+		assert(coded_x.shape[-1] == self.n_codes), "input needs to have K={} elements along the last dimension".format(self.n_codes)
+		full_coded_x = np.zeros(coded_x.shape[0:-1] + (self.n,), dtype=np.result_type(coded_x.dtype, np.float32))
+		np.add.at(full_coded_x, (Ellipsis, self.code_idx), coded_x)
+		# The hadamard matrix is symmetric
+		return fwht(full_coded_x)
+
+	def inverse(self, coded_x):
+		'''
+			Least-squares reconstruction from the coded measurements. The walsh codes are orthogonal with squared norm n.
+		'''
+		return self.adjoint(coded_x) / self.n
+
+	def to_dense(self):
+		import scipy.linalg
+		return scipy.linalg.hadamard(self.n).astype(np.float64)[:, self.code_idx]
+
+class GrayCodeOperator(WalshHadamardOperator):
+	'''
+		Gray coding functions, i.e., the columns of generate_gray_code(n_bits) upsampled to n time bins (each codeword is 
+		repeated over n / 2^n_bits bins). If binary is False, the codes are mapped from {0, 1} to {-1, 1}.
+		Each {-1, 1} gray code is the negative of a walsh function: bit b of the gray code of u is bit b XOR bit b+1 of u,
+		so the codes are encoded with the fast walsh-hadamard transform.
+	'''
+	def __init__(self, n, n_bits, binary=True):
+		assert(n_bits >= 1), "invalid n_bits"
+		n_binary_codes = np.power(2, n_bits)
+		assert(is_power_of_2(n) and ((n % n_binary_codes) == 0)), "n needs to be a power of 2 and a multiple of 2^n_bits"
+		self.n_bits = n_bits
+		self.binary = binary
+		# Column j of the gray codes holds the bit (n_bits - 1 - j) of the codeword. Shift the walsh index to account for upsampling
+		bit_shift = int(np.log2(n // n_binary_codes))
+		code_bits = np.arange(n_bits-1, -1, -1)
+		walsh_idx = np.bitwise_or(np.left_shift(1, code_bits), np.left_shift(1, code_bits+1) % n_binary_codes)
+		super().__init__(n, code_idx=np.left_shift(walsh_idx, bit_shift))
+
+	def encode(self, x):
+		walsh_coded_x = super().encode(x)
+		if(self.binary): return 0.5*(to_nparray(x).sum(axis=-1, keepdims=True) - walsh_coded_x)
+		return -1*walsh_coded_x
+
+	def adjoint(self, coded_x):
+		walsh_adjoint = super().adjoint(coded_x)
+		if(self.binary): return 0.5*(to_nparray(coded_x).sum(axis=-1, keepdims=True) - walsh_adjoint)
+		return -1*walsh_adjoint
+
+	def inverse(self, coded_x):
+		'''
+			Least-squares (minimum norm) reconstruction from the coded measurements.
+			The binary codes are 0.5*(1 - w_k) for walsh functions w_k that are orthogonal to the DC (constant) signal, so the 
+			minimum norm reconstruction is a + sum_k(b_k*w_k), with c_k = 2*coded_x_k / n, a = sum_k(c_k) / (K+1) and b_k = a - c_k.
+		'''
+		# The {-1, 1} codes are orthogonal with squared norm n
+		if(not self.binary): return self.adjoint(coded_x) / self.n
+		scaled_coded_x = (2. / self.n)*to_nparray(coded_x)
+		dc_coeff = scaled_coded_x.sum(axis=-1, keepdims=True) / (self.n_codes + 1)
+		return dc_coeff + super().adjoint(dc_coeff - scaled_coded_x)
+
+	def to_dense(self):
+		codes = np.repeat(generate_gray_code(self.n_bits), self.n // np.power(2, self.n_bits), axis=0)
+		if(self.binary): return codes
+		return 2*codes - 1
+
+def zero_norm_t(v, axis=-1):
+	'''
+		Zero-mean and unit-norm along axis. Used to compute zero-mean normalized cross-correlations (ZNCC) with a dot product.
+	'''
+	v_zero_mean = v - v.mean(axis=axis, keepdims=True)
+	return v_zero_mean / (np.linalg.norm(v_zero_mean, ord=2, axis=axis, keepdims=True) + EPSILON)
+
+class CodedHistogramEngine:
+	'''
+		Encode transients/histograms with an n x K coding matrix (e.g., haar_matrix, get_fourier_mat, generate_gray_code) and 
+		decode depths by finding the time shift that maximizes the zero-mean normalized cross-correlation (ZNCC) between 
+		the coded measurements and the coded shifted IRF.
+		The lookup table of coded shifted IRFs (n depths x K) is computed and normalized once when the engine is built, 
+		so decoding is a chunked (n_pixels x K) @ (K x n) matmul followed by an argmax.
+		dtype=np.float32 halves the memory and speeds up the matmuls, but the ZNCC of neighboring depths may not be resolved
+		for codes whose coded shifted IRFs are very similar (e.g., coarse haar codes).
+		Example:
+			engine = CodedHistogramEngine(haar_matrix(1024, 4), h_irf=gaussian_pulse(tbins, 0, 5))
+			(depth_bins, zncc) = engine.decode(engine.encode(transients), method='parabolic')
+	'''
+	def __init__(self, coding_mat, h_irf=None, dtype=np.float64, chunk_size=4096):
+		coding_mat = to_nparray(coding_mat)
+		assert(coding_mat.ndim == 2), "coding_mat should be an n x K matrix"
+		assert(fft_ops.is_real(coding_mat)), "only real coding matrices are supported (split complex codes into real and imaginary parts)"
+		(self.n, self.n_codes) = coding_mat.shape
+		self.dtype = np.dtype(dtype)
+		self.chunk_size = chunk_size
+		self.coding_mat = coding_mat.astype(self.dtype)
+		# The lookup table row at depth d is the coded IRF shifted by d bins, i.e., np.roll(h_irf, d) @ coding_mat
+		if(h_irf is None): lut = coding_mat.astype(np.float64)
+		else:
+			h_irf = to_nparray(h_irf).astype(np.float64)
+			assert(h_irf.shape == (self.n,)), "h_irf should be a vector with n={} elements".format(self.n)
+			lut = circular_corr(h_irf[:, np.newaxis], coding_mat.astype(np.float64), axis=0)
+		self.lut = lut.astype(self.dtype)
+		# Transposed to do a single (n_pixels x K) @ (K x n) matmul when decoding
+		self.zn_lut_t = np.ascontiguousarray(zero_norm_t(lut, axis=-1).transpose()).astype(self.dtype)
+
+	def encode(self, transient):
+		'''
+			Compute the K coded measurements of a (... x n) transient tensor, i.e., transient @ coding_mat, in chunks of chunk_size.
+		'''
+		transient = to_nparray(transient)
+		assert(transient.shape[-1] == self.n), "input needs to have n={} elements along the last dimension".format(self.n)
+		(transient, transient_shape) = vectorize_tensor(transient)
+		coded_vals = np.zeros((transient.shape[0], self.n_codes), dtype=self.dtype)
+		for chunk in get_chunk_slices(transient.shape[0], self.chunk_size):
+			coded_vals[chunk] = transient[chunk].astype(self.dtype, copy=False) @ self.coding_mat
+		return coded_vals.reshape(transient_shape[0:-1] + (self.n_codes,))
+
+	def zncc(self, coded_vals):
+		'''
+			ZNCC between (... x K) coded measurements and each row of the lookup table. Returns a (... x n) tensor.
+			This materializes the full tensor, so decode should be preferred for large inputs.
+		'''
+		coded_vals = to_nparray(coded_vals)
+		return zero_norm_t(coded_vals.astype(self.dtype, copy=False), axis=-1) @ self.zn_lut_t
+
+	def decode(self, coded_vals, method=None):
+		'''
+			Decode the depth (in time bins) of (... x K) coded measurements as the argmax of the ZNCC with the lookup table.
+			The integer argmax can be refined to sub-bin precision with method='parabolic' or 'gaussian' (see circular_subbin_argmax).
+			Returns:
+				depth_bins: (...) tensor with the decoded depths, between [0, n)
+				zncc_peak: (...) tensor with the ZNCC at the decoded depths
+		'''
+		coded_vals = to_nparray(coded_vals)
+		assert(coded_vals.shape[-1] == self.n_codes), "input needs to have K={} elements along the last dimension".format(self.n_codes)
+		(coded_vals, coded_vals_shape) = vectorize_tensor(coded_vals)
+		n_elems = coded_vals.shape[0]
+		depth_bins = np.zeros((n_elems,), dtype=self.dtype)
+		zncc_peak = np.zeros((n_elems,), dtype=self.dtype)
+		for chunk in get_chunk_slices(n_elems, self.chunk_size):
+			(depth_bins[chunk], zncc_peak[chunk]) = circular_subbin_argmax(self.zncc(coded_vals[chunk]), axis=-1, method=method)
+		return (depth_bins.reshape(coded_vals_shape[0:-1]), zncc_peak.reshape(coded_vals_shape[0:-1]))
+
+def analyze_coding_scheme(Cmat, h_irf=None, valid_freq_thresh=0.2):
+	'''
+		Analyze a (... x n x K) stack of coding matrices, and optionally a (... x n) tensor of (e.g., per-pixel) IRFs, at once.
+		The batch dimensions of Cmat and h_irf need to broadcast with each other.
+		Returns a dict with:
+			gram: (... x K x K) gram matrices of the codes
+			is_orthogonal: (...) whether the codes of each matrix are mutually orthogonal
+			dominant_freqs: (... x K) frequency with the largest magnitude of each code
+			low_confidence_freqs: (... x n//2+1) mask of the frequencies with low amplitude in the IRF (only if h_irf is given)
+			low_confidence_codes: (... x K) mask of the codes whose dominant frequency is a low confidence frequency of the IRF
+	'''
+	Cmat = to_nparray(Cmat)
+	assert(Cmat.ndim >= 2), "Cmat should be an n x K matrix or a stack of matrices"
+	analysis = {}
+	analysis['gram'] = calc_gram_matrix(Cmat)
+	analysis['is_orthogonal'] = is_mutually_orthogonal(Cmat)
+	analysis['dominant_freqs'] = get_dominant_freqs(Cmat, axis=-2)
+	if(h_irf is None): return analysis
+	h_irf = to_nparray(h_irf)
+	assert(h_irf.shape[-1] == Cmat.shape[-2]), "h_irf and Cmat need to have the same number of time bins"
+	(_, low_confidence_freqs) = get_low_confidence_freqs(h_irf, valid_freq_thresh=valid_freq_thresh)
+	analysis['low_confidence_freqs'] = low_confidence_freqs
+	batch_shape = np.broadcast(low_confidence_freqs[..., 0], analysis['dominant_freqs'][..., 0]).shape
+	analysis['low_confidence_codes'] = np.take_along_axis(np.broadcast_to(low_confidence_freqs, batch_shape + low_confidence_freqs.shape[-1:]), 
+		np.broadcast_to(analysis['dominant_freqs'], batch_shape + analysis['dominant_freqs'].shape[-1:]), axis=-1)
+	return analysis
+
@@ -0,0 +1,129 @@
+'''
+	FFT backend used by the signal processing modules.
+	All FFT calls in signalproc_ops go through the functions in this module, so the backend can be switched at runtime
+	to benchmark them against each other. Available backends:
+		* 'scipy': scipy.fft. Keeps float32 inputs as float32/complex64 and can use multiple threads via workers.
+		* 'numpy': numpy.fft. Single-threaded. Outputs are cast back to the input precision.
+	Example:
+		set_fft_backend('scipy', workers=8)
+		with fft_backend('numpy'): y = circular_conv(v1, v2)
+	torch tensors are always transformed with torch.fft (on their device and with autograd support), independently of the 
+	selected backend. torch is never imported by this module: if the caller has not imported torch, no input can be a tensor.
+'''
+## Standard Library Imports
+import sys
+import contextlib
+
+## Library Imports
+import numpy as np
+from scipy import fft as scipy_fft
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+
+FFT_BACKENDS = ['scipy', 'numpy']
+
+# Current backend. workers=-1 uses all available cores (only used by the scipy backend)
+_fft_backend_config = {'backend': 'scipy', 'workers': -1}
+
+def set_fft_backend(backend='scipy', workers=-1):
+	'''
+		Select the FFT backend used by fft_ops. workers is the number of threads used by the scipy backend (-1 means all cores)
+	'''
+	if(not backend in FFT_BACKENDS):
+		raise ValueError("Chosen fft backend needs to be one of: {}".format(FFT_BACKENDS))
+	_fft_backend_config['backend'] = backend
+	_fft_backend_config['workers'] = workers
+
+def get_fft_backend():
+	return (_fft_backend_config['backend'], _fft_backend_config['workers'])
+
+@contextlib.contextmanager
+def fft_backend(backend='scipy', workers=-1):
+	'''
+		Temporarily switch the FFT backend inside a with block
+	'''
+	(prev_backend, prev_workers) = get_fft_backend()
+	set_fft_backend(backend, workers=workers)
+	try:
+		yield
+	finally:
+		set_fft_backend(prev_backend, workers=prev_workers)
+
+def is_torch_tensor(x):
+	torch = sys.modules.get('torch')
+	return (torch is not None) and isinstance(x, torch.Tensor)
+
+def as_array_like(a, like):
+	'''
+		If like is a torch tensor, convert the numpy array a to a tensor on the same device and with the same precision as like 
+		(complex arrays are converted to the complex dtype with the precision of like). Otherwise return a unchanged.
+	'''
+	if((not is_torch_tensor(like)) or is_torch_tensor(a)): return a
+	torch = sys.modules['torch']
+	a = np.asarray(a)
+	# Read-only arrays (e.g., cached windows) are copied since tensors can't be read-only
+	a = torch.as_tensor(a if a.flags.writeable else a.copy(), device=like.device)
+	if(like.is_floating_point() or like.is_complex()):
+		real_dtype = like.real.dtype if like.is_complex() else like.dtype
+		complex_dtype = (torch.ones((), dtype=real_dtype) + 0j).dtype
+		a = a.to(complex_dtype if a.is_complex() else real_dtype)
+	return a
+
+def get_np_dtype(x):
+	'''
+		numpy dtype of a numpy array or torch tensor
+	'''
+	if(is_torch_tensor(x)): return np.dtype(str(x.dtype).replace('torch.', ''))
+	return np.asarray(x).dtype
+
+def is_real(x):
+	if(is_torch_tensor(x)): return not x.is_complex()
+	return not np.iscomplexobj(x)
+
+def get_complex_dtype(dtype):
+	'''
+		Complex dtype with the same precision as dtype. Integers and float64 map to complex128, float32 maps to complex64.
+	'''
+	return np.result_type(dtype, np.complex64)
+
+def get_real_dtype(dtype):
+	'''
+		Real dtype with the same precision as dtype. Integers map to float64.
+	'''
+	return np.finfo(np.result_type(dtype, np.float32)).dtype
+
+def next_fast_len(n, real=False):
+	'''
+		Smallest length >= n that is fast to transform (e.g., to zero-pad signals before an FFT)
+	'''
+	return scipy_fft.next_fast_len(n, real=real)
+
+def rfft(x, n=None, axis=-1):
+	if(is_torch_tensor(x)): return sys.modules['torch'].fft.rfft(x, n=n, dim=axis)
+	x = np.asarray(x)
+	(backend, workers) = get_fft_backend()
+	if(backend == 'scipy'): return scipy_fft.rfft(x, n=n, axis=axis, workers=workers)
+	return np.fft.rfft(x, n=n, axis=axis).astype(get_complex_dtype(x.dtype), copy=False)
+
+def irfft(x, n=None, axis=-1):
+	if(is_torch_tensor(x)): return sys.modules['torch'].fft.irfft(x, n=n, dim=axis)
+	x = np.asarray(x)
+	(backend, workers) = get_fft_backend()
+	if(backend == 'scipy'): return scipy_fft.irfft(x, n=n, axis=axis, workers=workers)
+	return np.fft.irfft(x, n=n, axis=axis).astype(get_real_dtype(x.dtype), copy=False)
+
+def fft(x, n=None, axis=-1):
+	if(is_torch_tensor(x)): return sys.modules['torch'].fft.fft(x, n=n, dim=axis)
+	x = np.asarray(x)
+	(backend, workers) = get_fft_backend()
+	if(backend == 'scipy'): return scipy_fft.fft(x, n=n, axis=axis, workers=workers)
+	return np.fft.fft(x, n=n, axis=axis).astype(get_complex_dtype(x.dtype), copy=False)
+
+def ifft(x, n=None, axis=-1):
+	if(is_torch_tensor(x)): return sys.modules['torch'].fft.ifft(x, n=n, dim=axis)
+	x = np.asarray(x)
+	(backend, workers) = get_fft_backend()
+	if(backend == 'scipy'): return scipy_fft.ifft(x, n=n, axis=axis, workers=workers)
+	return np.fft.ifft(x, n=n, axis=axis).astype(get_complex_dtype(x.dtype), copy=False)
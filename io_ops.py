@@ -7,6 +7,7 @@ import pickle
 import shutil
 
 #### Library imports
+import numpy as np
 from IPython.core import debugger
 breakpoint = debugger.set_trace
 
@@ -106,7 +107,41 @@ def copy_all_files(src_dirpath, dst_dirpath, ignore_fname_list=[]):
 			if os.path.isfile(src_fpath): shutil.copy2(src_fpath, dst_fpath)
 	return 1
 
-def get_multi_folder_paired_fnames(dirpath_list, valid_file_ext_list):
+def scan_dir_fnames(dirpath, valid_file_ext_list):
+	'''
+		Single os.scandir pass over dirpath that returns a dict with the base filename (without extension) and file extension
+		of all the files with an extension in valid_file_ext_list. Hidden files are ignored (same as glob).
+	'''
+	assert(os.path.exists(dirpath)), "{} does not exist".format(dirpath)
+	valid_file_ext_set = set(valid_file_ext_list)
+	fname_to_ext = {}
+	with os.scandir(dirpath) as dir_entries:
+		for entry in dir_entries:
+			if(entry.name.startswith('.')): continue
+			(base_fname, file_ext) = os.path.splitext(entry.name)
+			if((file_ext[1:] in valid_file_ext_set) and entry.is_file()): fname_to_ext[base_fname] = file_ext[1:]
+	return fname_to_ext
+
+def get_dir_index(dirpath, valid_file_ext_list, prev_dir_index=None):
+	'''
+		Index with the sorted filenames and file extension of the valid files in dirpath (see scan_dir_fnames).
+		If prev_dir_index is given and the directory was not modified since it was created (same mtime), it is reused 
+		and the directory is not scanned.
+	'''
+	dir_mtime_ns = os.stat(dirpath).st_mtime_ns
+	if((prev_dir_index is not None) and (prev_dir_index['mtime_ns'] == dir_mtime_ns) and (prev_dir_index['valid_file_ext_list'] == list(valid_file_ext_list))):
+		return prev_dir_index
+	fname_to_ext = scan_dir_fnames(dirpath, valid_file_ext_list)
+	file_ext_list = sorted(set(fname_to_ext.values()))
+	assert(len(file_ext_list) <= 1), "{} should only contain one of the valid file extensions, but it has {}".format(dirpath, file_ext_list)
+	return {
+		'mtime_ns': dir_mtime_ns,
+		'valid_file_ext_list': list(valid_file_ext_list),
+		'file_ext': file_ext_list[0] if (len(file_ext_list) > 0) else None,
+		'filenames': sorted(fname_to_ext.keys())
+	}
+
+def get_multi_folder_paired_fnames(dirpath_list, valid_file_ext_list, manifest_fpath=None):
 	'''
 		Go through each folder in dirpath_list, get all filenames with the file extension in valid_file_ext_list.
 		Then check that across all folders you can find paired filenames. 
@@ -130,35 +165,116 @@ def get_multi_folder_paired_fnames(dirpath_list, valid_file_ext_list):
 			paired_filenames = ['f1', 'f2']
 			ext_per_dirpath = ['npy', 'npy', 'npz'] 
 		Why does this function exist? Because it is useful to organize small datasets in this way.
+		Each folder is listed with a single os.scandir pass, and the paired filenames are sorted.
+		If manifest_fpath is given, the index of each folder is saved to that json file, and the next call only rescans 
+		the folders that were modified since (i.e., whose mtime changed).
 	'''
 	assert(len(dirpath_list)>0), "empty dirpath list"
-	n_dirpaths = len(dirpath_list)
-	filenames_per_dirpath = []
-	file_ext_per_dirpath = []
-	all_filenames = []
-	n_filenames_per_dirpath = []
-	for i in range(n_dirpaths):
-		curr_dirpath = dirpath_list[i]
-		filenames_in_dir = []
-		for file_ext in valid_file_ext_list:
-			curr_filenames = get_filepaths_in_dir(curr_dirpath, match_str_pattern='*.'+file_ext, only_filenames=True, keep_ext=False)
-			if(len(curr_filenames) != 0): 
-				# We should only enter this condition once per deirpath
-				filenames_in_dir += curr_filenames
-				file_ext_per_dirpath.append(file_ext)
-		filenames_per_dirpath.append(filenames_in_dir)
-		all_filenames += filenames_in_dir
-		n_filenames_per_dirpath.append(len(filenames_in_dir))
+	manifest = {}
+	if((manifest_fpath is not None) and os.path.exists(manifest_fpath)): manifest = load_json(manifest_fpath)
+	dir_indeces = [get_dir_index(dirpath, valid_file_ext_list, prev_dir_index=manifest.get(os.path.abspath(dirpath))) for dirpath in dirpath_list]
+	if(manifest_fpath is not None):
+		# Keep the indeces of other folders in the manifest (e.g., of other datasets)
+		new_manifest = dict(manifest)
+		new_manifest.update({os.path.abspath(dirpath): dir_index for (dirpath, dir_index) in zip(dirpath_list, dir_indeces)})
+		if(new_manifest != manifest):
+			# Write to a temporary file first so that the manifest is never partially written
+			tmp_manifest_fpath = manifest_fpath + '.tmp'
+			with open(tmp_manifest_fpath, 'w') as manifest_file: json.dump(new_manifest, manifest_file)
+			os.replace(tmp_manifest_fpath, manifest_fpath)
+	# Check that we only have one file extension per directory
+	file_ext_per_dirpath = [dir_index['file_ext'] for dir_index in dir_indeces]
+	assert(not (None in file_ext_per_dirpath)), "Check that all dirpaths have files with a valid file extension"
 	# Check that all dirpath have the same number of filemaes
+	n_filenames_per_dirpath = [len(dir_index['filenames']) for dir_index in dir_indeces]
 	assert(len(set(n_filenames_per_dirpath)) == 1), "Check that all dirpaths have the same number of files"
-	n_samples = n_filenames_per_dirpath[0]
 	# Check that the filenames within each folder are the same 
 	# i.e., folder1/f1.npy, folder2/f1.npy , folder3/f1.npz 
-	paired_filenames = list(set(all_filenames))
-	assert(len(paired_filenames) == n_samples), "Filenames within each folder should match (folder1/f1.npy, folder2/f1.npy , folder3/f1.npz)"
-	# Check that we only have one file extension per directory
-	assert(len(file_ext_per_dirpath) == n_dirpaths)
-	return (paired_filenames, file_ext_per_dirpath)
+	paired_filenames = dir_indeces[0]['filenames']
+	for dir_index in dir_indeces[1:]:
+		assert(dir_index['filenames'] == paired_filenames), "Filenames within each folder should match (folder1/f1.npy, folder2/f1.npy , folder3/f1.npz)"
+	return (list(paired_filenames), file_ext_per_dirpath)
+
+PACKED_INDEX_FNAME = 'packed_index.json'
+
+def get_packed_shard_fpath(dirpath, shard_idx):
+	return os.path.join(dirpath, 'shard_{:06d}.bin'.format(shard_idx))
+
+def write_packed_array(shard_file, arr, alignment=64):
+	'''
+		Append the raw bytes of arr to shard_file, starting at an offset that is a multiple of alignment (so that the array 
+		can be viewed in place with any dtype). Returns the array info that is stored in the index.
+	'''
+	assert(not arr.dtype.hasobject), "object arrays can't be packed"
+	offset = shard_file.tell()
+	if((offset % alignment) != 0):
+		shard_file.write(bytes(alignment - (offset % alignment)))
+		offset = shard_file.tell()
+	shard_file.write(np.ascontiguousarray(arr).reshape(-1).view(np.uint8))
+	return {'offset': offset, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+
+def get_packed_array(shard_buffer, array_info):
+	'''
+		Zero-copy view of a packed array (see write_packed_array) in shard_buffer (e.g., a np.memmap of the shard file)
+	'''
+	return np.ndarray(shape=tuple(array_info['shape']), dtype=np.dtype(array_info['dtype']), buffer=shard_buffer, offset=array_info['offset'])
+
+def get_packed_sample(shard_buffer, sample_info):
+	'''
+		Returns the list with the arrays of each folder of the sample. The arrays of .npz files are returned as a dict.
+	'''
+	return [get_packed_array(shard_buffer, array_info) if ('offset' in array_info) else {key: get_packed_array(shard_buffer, info) for (key, info) in array_info.items()} for array_info in sample_info['arrays']]
+
+def pack_multi_folder_paired_data(dirpath_list, packed_dirpath, max_shard_nbytes=2**30, alignment=64):
+	'''
+		Pack the paired .npy/.npz files in dirpath_list (see get_multi_folder_paired_fnames) into a few large shard files 
+		in packed_dirpath, so that the dataset can be read with sequential I/O instead of opening many small files.
+			* The samples are written in sorted filename order, and a new shard is started when the shard would become larger 
+			than max_shard_nbytes (samples are never split across shards).
+			* The raw bytes of each array are written at an offset that is a multiple of alignment, and the index (written to 
+			PACKED_INDEX_FNAME) stores the shard, offset, dtype and shape of every array, so that they can be memory-mapped 
+			without copies (see get_packed_sample). 
+		The arrays are the same as the ones loaded from the original files. Returns the index.
+	'''
+	(base_filenames, file_ext_per_dirpath) = get_multi_folder_paired_fnames(dirpath_list, ['npy', 'npz'])
+	os.makedirs(packed_dirpath, exist_ok=True)
+	index = {
+		'dirpath_list': [os.path.abspath(dirpath) for dirpath in dirpath_list],
+		'file_ext_per_dirpath': file_ext_per_dirpath,
+		'shards': [],
+		'samples': []
+	}
+	shard_file = None
+	for (sample_idx, base_fname) in enumerate(base_filenames):
+		np_data_sample = []
+		for (dirpath, file_ext) in zip(dirpath_list, file_ext_per_dirpath):
+			fpath = os.path.join(dirpath, base_fname + '.' + file_ext)
+			if(file_ext == 'npz'):
+				with np.load(fpath) as npz_file: np_data_sample.append({key: npz_file[key] for key in npz_file.files})
+			else: np_data_sample.append(np.load(fpath))
+		sample_nbytes = sum([data.nbytes + alignment if isinstance(data, np.ndarray) else sum([arr.nbytes + alignment for arr in data.values()]) for data in np_data_sample])
+		# Start a new shard if the sample does not fit in the current one
+		if((shard_file is None) or ((shard_file.tell() > 0) and ((shard_file.tell() + sample_nbytes) > max_shard_nbytes))):
+			if(shard_file is not None): shard_file.close()
+			shard_fpath = get_packed_shard_fpath(packed_dirpath, len(index['shards']))
+			shard_file = open(shard_fpath, 'wb')
+			index['shards'].append({'fname': os.path.basename(shard_fpath), 'samples': [sample_idx, sample_idx]})
+		arrays_info = []
+		for data in np_data_sample:
+			if(isinstance(data, np.ndarray)): arrays_info.append(write_packed_array(shard_file, data, alignment=alignment))
+			else: arrays_info.append({key: write_packed_array(shard_file, arr, alignment=alignment) for (key, arr) in data.items()})
+		index['samples'].append({'base_fname': base_fname, 'shard_idx': len(index['shards']) - 1, 'arrays': arrays_info})
+		index['shards'][-1]['samples'][1] = sample_idx + 1
+	if(shard_file is not None): shard_file.close()
+	# Write the index last (and to a temporary file first), so that it only exists if all the shards were written
+	index_fpath = os.path.join(packed_dirpath, PACKED_INDEX_FNAME)
+	tmp_index_fpath = index_fpath + '.tmp'
+	with open(tmp_index_fpath, 'w') as index_file: json.dump(index, index_file)
+	os.replace(tmp_index_fpath, index_fpath)
+	return index
+
+def load_packed_index(packed_dirpath):
+	return load_json(os.path.join(packed_dirpath, PACKED_INDEX_FNAME))
 
 def get_string_from_file(filepath):
 	f = open(filepath)
@@ -13,21 +13,24 @@ breakpoint = debugger.set_trace
 from .shared_constants import *
 
 
-def vectorize_tensor(tensor, axis=-1):
+def vectorize_tensor(tensor, axis=-1, out=None):
 	'''
 		Take an N-Dim Tensor and make it a 2D matrix. Leave the first or last dimension untouched, and basically squeeze the 1st-N-1
 		dimensions.
 		This is useful when applying operations on only the first or last dimension of a tensor. Makes it easier to input to different
 		number of pytorch functions.
+		The output is a view of the tensor when possible. If out is given, the 2D matrix is copied (and cast) into out instead, 
+		e.g., to pack a float64 tensor into a preallocated float32 buffer.
 	'''
 	assert((axis==0) or (axis==-1)), 'Error: Input axis needs to be the first or last axis of tensor'
 	tensor_shape = tensor.shape
 	n_untouched_dim = tensor.shape[axis]
 	n_elems = int(round(tensor.size / n_untouched_dim))
-	if(axis == -1):
-		return (tensor.reshape((n_elems, n_untouched_dim)), tensor_shape)
-	else:
-		return (tensor.reshape((n_untouched_dim, n_elems)), tensor_shape)
+	if(axis == -1): vectorized_tensor = tensor.reshape((n_elems, n_untouched_dim))
+	else: vectorized_tensor = tensor.reshape((n_untouched_dim, n_elems))
+	if(out is None): return (vectorized_tensor, tensor_shape)
+	np.copyto(out, vectorized_tensor, casting='same_kind')
+	return (out, tensor_shape)
 
 def unvectorize_tensor(tensor, tensor_shape):
 	'''
@@ -35,6 +38,17 @@ def unvectorize_tensor(tensor, tensor_shape):
 	'''
 	return tensor.reshape(tensor_shape)
 
+def get_chunk_slices(n_elems, chunk_size=None):
+	'''
+		Split the range [0, n_elems) into contiguous slices with at most chunk_size elements each.
+		Useful to bound the memory used by vectorized operations over the first dimension of a vectorized tensor.
+		If chunk_size is None, a single slice covering all elements is returned.
+	'''
+	if((chunk_size is None) or (n_elems == 0)): return [slice(0, n_elems)]
+	chunk_size = int(chunk_size)
+	assert(chunk_size > 0), "chunk_size should be a positive integer"
+	return [slice(start_idx, min(start_idx + chunk_size, n_elems)) for start_idx in range(0, n_elems, chunk_size)]
+
 def to_nparray( a ):
 	'''
 		cast to np array. If a is scalar, make it a 1D 1 element vector
@@ -69,38 +83,56 @@ def get_extended_domain(domain, axis=-1):
 	domain_right = domain+(max_val + delta)
 	return np.concatenate((domain_left, domain, domain_right), axis=axis)
 
-def calc_mean_percentile_errors(errors, percentiles=[0.5, 0.75, 0.95, 0.99]):
+def calc_mean_percentile_errors(errors, percentiles=[0.5, 0.75, 0.95, 0.99], return_mask=True):
 	'''
 		Sort the errors from lowest to hightest.
 		Given a list of percentiles calculate the mean of the sorted errors within each percentile.
 		For instance, if percentiles=[0.5,0.75,1.0], then
 		we calculate the mean of the lowest 50% errors, then the mean of the errors in the 50-75% percentile, 
 		and finally the errors in the 75-100% percentile.
+		The errors are only partially sorted: they are partitioned at one boundary between percentiles at a time, from the 
+		lowest one, so that each np.partition only goes over the errors above the previous boundary (a single np.partition 
+		with multiple kth is slower than np.sort). The percentile_mask has the index of the percentile used for each error 
+		(-1 if it was not used). If return_mask is False, the mask is not computed and None is returned instead.
 	'''
 	errors_shape = errors.shape
-	errors = errors.flatten()
+	errors = errors.reshape((-1,))
 	n_elems = errors.size
-	# Sort errors
-	sorted_errors = np.sort(errors)
 	# Verify the input percentiles and find the indeces where we split the errors
 	percentiles = to_nparray(percentiles)
 	assert(not (np.any(percentiles > 1) or np.any(percentiles < 0))), "Percentiles need to be between 0 and 1"
-	percentile_indeces = np.round(n_elems*percentiles).astype(np.int)
+	percentile_indeces = np.round(n_elems*percentiles).astype(np.int64)
+	start_indeces = np.concatenate(([0], percentile_indeces[0:-1]))
+	# Partition the errors at the boundaries between percentiles
+	partitioned_errors = errors.copy()
+	prev_split_idx = 0
+	for split_idx in np.unique(percentile_indeces[(percentile_indeces > 0) & (percentile_indeces < n_elems)]):
+		partitioned_errors[prev_split_idx:].partition(split_idx - prev_split_idx)
+		prev_split_idx = split_idx
 	# Calculate mean for each percentile
 	percentile_mean_errors = np.zeros_like(percentiles)
-	percentile_mask = np.zeros_like(errors)-1.
 	for i in range(percentiles.size):
-		start_idx = 0
-		if(i > 0): start_idx = percentile_indeces[i-1] 
-		end_idx = percentile_indeces[i]
-		percentile_mean_errors[i] = np.mean(sorted_errors[start_idx:end_idx])
-		# Find which pixels were used to calculate this percentile mae
-		low_error_threshold = sorted_errors[start_idx]
-		high_error_threshold = sorted_errors[end_idx-1]
-		percentile_mask[np.logical_and(errors >= low_error_threshold, errors <= high_error_threshold)] = i
-	errors = errors.reshape(errors_shape)
-	percentile_mask = percentile_mask.reshape(errors_shape)
-	return (percentile_mean_errors, percentile_mask)
+		percentile_mean_errors[i] = np.mean(partitioned_errors[start_indeces[i]:percentile_indeces[i]])
+	if(not return_mask): return (percentile_mean_errors, None)
+	# Find which pixels were used to calculate each percentile mae. Each error is assigned to the highest percentile whose 
+	# lowest error is <= than it (so errors equal to the threshold between two percentiles are assigned to the higher one), 
+	# and errors above the highest error of the last percentile are not assigned. Empty percentiles are not assigned any errors.
+	mask_dtype = errors.dtype if np.issubdtype(errors.dtype, np.floating) else np.float64
+	percentile_mask = np.full(n_elems, -1, dtype=mask_dtype)
+	is_above_threshold = np.empty(n_elems, dtype=bool)
+	(last_start_idx, last_end_idx) = (0, 0)
+	for i in range(percentiles.size):
+		(start_idx, end_idx) = (start_indeces[i], percentile_indeces[i])
+		if(end_idx <= start_idx): continue
+		if(start_idx == 0): percentile_mask.fill(i)
+		else:
+			np.greater_equal(errors, partitioned_errors[start_idx:end_idx].min(), out=is_above_threshold)
+			np.copyto(percentile_mask, i, where=is_above_threshold)
+		(last_start_idx, last_end_idx) = (start_idx, end_idx)
+	if((last_end_idx > 0) and (last_end_idx < n_elems)):
+		np.greater(errors, partitioned_errors[last_start_idx:last_end_idx].max(), out=is_above_threshold)
+		np.copyto(percentile_mask, -1, where=is_above_threshold)
+	return (percentile_mean_errors, percentile_mask.reshape(errors_shape))
 
 def calc_eps_tolerance_error(errors, eps = 0.):
 	assert(eps >= 0.), "eps should be non-negative"
@@ -115,7 +147,7 @@ def calc_error_metrics(errors, percentiles=[0.5, 0.75, 0.95, 0.99], eps_list=[1.
 	metrics['mae'] = np.mean(errors)
 	metrics['rmse'] = np.sqrt(np.mean(np.square(errors)))
 	metrics['medae'] = np.median(errors)
-	(percentile_mean_errors, percentile_mask) = calc_mean_percentile_errors(errors, percentiles=percentiles)
+	(percentile_mean_errors, _) = calc_mean_percentile_errors(errors, percentiles=percentiles, return_mask=False)
 	metrics['percentile_mae'] = percentile_mean_errors
 	metrics['percentiles'] = percentiles
 	assert(delta_eps > 0.), "delta_eps should be nonnegative"
@@ -125,6 +157,120 @@ def calc_error_metrics(errors, percentiles=[0.5, 0.75, 0.95, 0.99], eps_list=[1.
 		metrics['{}_tol_errs'.format(int(eps_list[i]))] = calc_eps_tolerance_error(scaled_errors, eps = eps_list[i])
 	return metrics
 
+class ErrorMetricsAccumulator:
+	'''
+		Streaming version of calc_error_metrics for (absolute) errors that do not fit in memory or that are computed by 
+		multiple workers. Call update with each batch of errors, merge the accumulators of different workers, and get_metrics
+		returns a dict with the same keys as calc_error_metrics.
+		mae, rmse and the eps tolerance errors are exact. The median and percentile mae are computed from a log-bucket 
+		quantile sketch with a fixed number of buckets (bucket i holds errors between min_error*gamma^(i-1) and min_error*gamma^i, 
+		where gamma = (1 + relative_accuracy) / (1 - relative_accuracy)), so the median is within relative_accuracy of the 
+		true value, and memory does not depend on the number of errors. Errors <= min_error go to the first bucket, 
+		and errors > max_error to the last one.
+		Example:
+			accumulator = ErrorMetricsAccumulator(eps_list=[1., 5.])
+			for batch_errors in batches: accumulator.update(batch_errors)
+			print_error_metrics(accumulator.get_metrics())
+	'''
+	def __init__(self, percentiles=[0.5, 0.75, 0.95, 0.99], eps_list=[1.], delta_eps=1., relative_accuracy=0.01, min_error=1e-6, max_error=1e9):
+		assert(delta_eps > 0.), "delta_eps should be nonnegative"
+		assert((relative_accuracy > 0.) and (relative_accuracy < 1.)), "relative_accuracy should be between 0 and 1"
+		assert((min_error > 0.) and (max_error > min_error)), "min_error should be positive and smaller than max_error"
+		self.percentiles = percentiles
+		self.eps_list = eps_list
+		self.delta_eps = delta_eps
+		self.relative_accuracy = relative_accuracy
+		self.min_error = min_error
+		self.max_error = max_error
+		self.log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+		self.n_buckets = int(np.ceil(np.log(max_error / min_error) / self.log_gamma)) + 2
+		self.n_errors = 0
+		self.sum_errors = 0.
+		self.sum_sq_errors = 0.
+		# Tolerance counts for eps=0 and each eps in eps_list
+		self.n_tol_errors = np.zeros((len(eps_list) + 1,), dtype=np.int64)
+		self.bucket_counts = np.zeros((self.n_buckets,), dtype=np.int64)
+		self.bucket_sums = np.zeros((self.n_buckets,), dtype=np.float64)
+
+	def get_config(self):
+		return (list(self.percentiles), list(self.eps_list), self.delta_eps, self.relative_accuracy, self.min_error, self.max_error)
+
+	def get_bucket_idx(self, errors):
+		with np.errstate(divide='ignore'):
+			bucket_idx = np.ceil(np.log(errors / self.min_error) / self.log_gamma)
+		return np.clip(bucket_idx, 0, self.n_buckets - 1).astype(np.int64)
+
+	def update(self, errors):
+		errors = np.asarray(errors, dtype=np.float64).reshape((-1,))
+		assert(np.all(errors >= 0)), "errors should be non-negative (absolute errors)"
+		self.n_errors += errors.size
+		self.sum_errors += errors.sum()
+		self.sum_sq_errors += np.square(errors).sum()
+		scaled_errors = errors / self.delta_eps
+		for (i, eps) in enumerate([0.] + list(self.eps_list)):
+			self.n_tol_errors[i] += np.count_nonzero(scaled_errors <= (eps + EPSILON))
+		bucket_idx = self.get_bucket_idx(errors)
+		self.bucket_counts += np.bincount(bucket_idx, minlength=self.n_buckets)
+		self.bucket_sums += np.bincount(bucket_idx, weights=errors, minlength=self.n_buckets)
+		return self
+
+	def merge(self, other):
+		'''
+			Add the errors accumulated by other (which needs to have the same configuration) to this accumulator
+		'''
+		assert(self.get_config() == other.get_config()), "Can only merge accumulators with the same configuration"
+		self.n_errors += other.n_errors
+		self.sum_errors += other.sum_errors
+		self.sum_sq_errors += other.sum_sq_errors
+		self.n_tol_errors += other.n_tol_errors
+		self.bucket_counts += other.bucket_counts
+		self.bucket_sums += other.bucket_sums
+		return self
+
+	def get_bucket_vals(self):
+		'''
+			Value that represents each bucket, with a relative error of at most relative_accuracy for all its errors. 
+			The first bucket is represented by the mean of its errors.
+		'''
+		bucket_vals = self.min_error*2*np.exp(np.arange(0, self.n_buckets)*self.log_gamma) / (1 + np.exp(self.log_gamma))
+		bucket_vals[0] = self.bucket_sums[0] / max(self.bucket_counts[0], 1)
+		return bucket_vals
+
+	def calc_quantile(self, q):
+		cum_counts = np.cumsum(self.bucket_counts)
+		bucket_idx = min(np.searchsorted(cum_counts, q*(self.n_errors - 1), side='right'), self.n_buckets - 1)
+		return self.get_bucket_vals()[bucket_idx]
+
+	def calc_sum_lowest_errors(self, n_lowest):
+		'''
+			Approximate sum of the n_lowest smallest errors. Only the errors in the bucket with the n_lowest-th error are 
+			approximated by their mean.
+		'''
+		cum_counts = np.concatenate(([0], np.cumsum(self.bucket_counts)))
+		cum_sums = np.concatenate(([0.], np.cumsum(self.bucket_sums)))
+		bucket_idx = np.clip(np.searchsorted(cum_counts, n_lowest, side='right') - 1, 0, self.n_buckets - 1)
+		bucket_means = self.bucket_sums / np.maximum(self.bucket_counts, 1)
+		return cum_sums[bucket_idx] + (n_lowest - cum_counts[bucket_idx])*bucket_means[bucket_idx]
+
+	def calc_mean_percentile_errors(self):
+		percentile_indeces = np.round(self.n_errors*to_nparray(self.percentiles)).astype(np.int64)
+		start_indeces = np.concatenate(([0], percentile_indeces[0:-1]))
+		with np.errstate(divide='ignore', invalid='ignore'):
+			return (self.calc_sum_lowest_errors(percentile_indeces) - self.calc_sum_lowest_errors(start_indeces)) / (percentile_indeces - start_indeces)
+
+	def get_metrics(self):
+		assert(self.n_errors > 0), "No errors have been accumulated"
+		metrics = {}
+		metrics['mae'] = self.sum_errors / self.n_errors
+		metrics['rmse'] = np.sqrt(self.sum_sq_errors / self.n_errors)
+		metrics['medae'] = self.calc_quantile(0.5)
+		metrics['percentile_mae'] = self.calc_mean_percentile_errors()
+		metrics['percentiles'] = self.percentiles
+		metrics['0_tol_errs'] = self.n_tol_errors[0] / self.n_errors
+		for i in range(len(self.eps_list)):
+			metrics['{}_tol_errs'.format(int(self.eps_list[i]))] = self.n_tol_errors[i+1] / self.n_errors
+		return metrics
+
 def print_error_metrics(metrics, prefix=''):
 	print("{} mae = {:.2f}".format(prefix, metrics['mae']))
 	# print("{} rmse = {:.2f}".format(prefix, metrics['rmse']))
@@ -154,20 +300,24 @@ def are_orthogonal(v, u):
 	assert(u.shape == v.shape), "u and v should match dims"
 	return np.abs(np.dot(v, u) / v.size) <= EPSILON
 
+def calc_gram_matrix(X):
+	'''
+		Gram matrix (dot products between all pairs of columns) of an n x K matrix, or of a stack of ... x n x K matrices.
+		Computed with a single (batched) matmul.
+	'''
+	assert(X.ndim >= 2), "X should be a matrix or a stack of matrices"
+	return np.matmul(np.swapaxes(X, -1, -2), X)
+
 def is_mutually_orthogonal(X):
 	'''
-		Check if all cols are mutually orthogonal
-	'''
-	assert(X.ndim == 2), "X should be a matrix"
-	(n_rows, n_cols) = X.shape
-	for i in range(n_cols):
-		v_i = X[:, i]
-		for j in range(n_cols):
-			v_j = X[:, j]
-			# If i equals j skip,  If vectors are not orthogonal return false
-			if((i != j) and (not are_orthogonal(v_i, v_j))):
-				return False
-	return True
+		Check if all cols are mutually orthogonal (see are_orthogonal).
+		For a stack of ... x n x K matrices a boolean tensor with the result for each matrix is returned.
+	'''
+	assert(X.ndim >= 2), "X should be a matrix or a stack of matrices"
+	(n_rows, n_cols) = X.shape[-2:]
+	normalized_gram = np.abs(calc_gram_matrix(X) / n_rows)
+	is_offdiag = np.logical_not(np.eye(n_cols, dtype=bool))
+	return np.all((normalized_gram <= EPSILON) | np.logical_not(is_offdiag), axis=(-2, -1))
 
 def circular_signal_fit(signal):
 	'''
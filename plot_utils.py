@@ -10,6 +10,7 @@ from IPython.core import debugger
 breakpoint = debugger.set_trace
 
 #### Local imports
+from .np_utils import get_chunk_slices
 
 def get_ax_if_none(ax):
 	if(ax is None): return plt.gca()
@@ -203,40 +204,62 @@ def reset_color_cycle():
 		else: plt.gca().set_color_cycle(None)
 	else: plt.gca().set_prop_cycle(None)
 
-def calc_errbars(true_vals, meas_vals, axis=0):
+def calc_errbars(true_vals, meas_vals, axis=0, weights=None, chunk_size=None):
 	'''
 		Useful function to calculate errors bars for the matplotlib plt.errbars function
 		neg_mae corresponds to the mae of all values that were LOWER than the true_val
 		pos_mae corresponds to the mae of all values that were HIGHER than the true_val
+		Both are computed for all elements at once with masked sums and counts. 
+		If weights are given (same shape as meas_vals), the weighted mae is computed. 
+		NaN measurements (and measurements with NaN weights) are ignored. 
+		If chunk_size is given, the elements are processed in chunks of chunk_size to bound the memory used.
 	'''
 	true_vals = true_vals.squeeze()
 	meas_vals = meas_vals.squeeze()
 	assert((axis==0) or (axis==-1)), 'Error: Input axis needs to be the first or last axis of tensor'
 	assert((meas_vals.ndim==1) or (meas_vals.ndim==2)), 'Error: meas_vals needs to be a 1D or 2D tensor'
 	assert((meas_vals.ndim-1) == true_vals.ndim), 'Error: true_vals needs to have 1 less dim than meas_vals, i.e., if meas_vals is 2D true_vals is 1D'
+	if(weights is not None):
+		weights = weights.squeeze()
+		assert(weights.shape == meas_vals.shape), 'Error: weights need to have the same shape as meas_vals'
 	# place measurements in the last dimension
-	if(axis == 0): meas_vals = meas_vals.transpose()
+	if(axis == 0): 
+		meas_vals = meas_vals.transpose()
+		if(weights is not None): weights = weights.transpose()
 	# Reshape meas_vals and true_vals into 2D and 1D tensors respectively.
 	if(meas_vals.ndim==1):
 		meas_vals = np.expand_dims(meas_vals, axis=0)	
 		true_vals = np.expand_dims(true_vals, axis=0)
-	# Calculate errors
-	errors = meas_vals - np.expand_dims(true_vals, axis=-1) 
-	# Figure out how many elements there are and pre-allocate arrays for the positive and negative errors
-	# Note that this steps cannot be easily vectorized, because for each element there may be a different number of positive/negative errors.
+		if(weights is not None): weights = np.expand_dims(weights, axis=0)
 	n_elems = meas_vals.shape[0] # we know that the elems will be in the first dimension, because the measurements are always in the last dimension
-	# Calculate positive errors mean absolute error
 	pos_mae = np.zeros((n_elems,))
 	neg_mae = np.zeros((n_elems,))
-	for i in range(n_elems):
-		curr_errors = errors[i]
-		pos_mae[i] = np.mean(np.abs(curr_errors[curr_errors>=0])) 
-		neg_mae[i] = np.mean(np.abs(curr_errors[curr_errors<=0])) 
+	for chunk in get_chunk_slices(n_elems, chunk_size):
+		# Calculate errors. NaN errors are neither positive nor negative
+		errors = meas_vals[chunk] - np.expand_dims(true_vals[chunk], axis=-1)
+		abs_errors = np.abs(errors)
+		pos_mask = errors >= 0
+		neg_mask = errors <= 0
+		if(weights is None): 
+			(pos_norm, neg_norm) = (np.count_nonzero(pos_mask, axis=-1), np.count_nonzero(neg_mask, axis=-1))
+		else:
+			curr_weights = np.where(np.isnan(weights[chunk]), 0., weights[chunk])
+			abs_errors *= curr_weights
+			(pos_norm, neg_norm) = (np.sum(curr_weights, axis=-1, where=pos_mask), np.sum(curr_weights, axis=-1, where=neg_mask))
+		with np.errstate(divide='ignore', invalid='ignore'):
+			pos_mae[chunk] = np.sum(abs_errors, axis=-1, where=pos_mask) / pos_norm
+			neg_mae[chunk] = np.sum(abs_errors, axis=-1, where=neg_mask) / neg_norm
 	return np.stack((neg_mae, pos_mae), axis=0)
 
-def calc_mean_errbars(y, axis=0):
-	y_mean = np.mean(y, axis=axis)
-	y_negpos_mae = calc_errbars(y_mean, y, axis=axis)
+def calc_mean_errbars(y, axis=0, weights=None, chunk_size=None):
+	'''
+		Error bars around the mean of y (see calc_errbars). NaN values are ignored.
+	'''
+	if(weights is None): y_mean = np.nanmean(y, axis=axis)
+	else:
+		is_valid = np.logical_not(np.isnan(y) | np.isnan(weights))
+		y_mean = np.sum(np.where(is_valid, y*weights, 0.), axis=axis) / np.sum(np.where(is_valid, weights, 0.), axis=axis)
+	y_negpos_mae = calc_errbars(y_mean, y, axis=axis, weights=weights, chunk_size=chunk_size)
 	return y_negpos_mae
 
 def get_good_min_max_range(img):
@@ -1,14 +1,17 @@
 ## Standard Library Imports
+import functools
 
 ## Library Imports
 import numpy as np
 import scipy
 from scipy import signal
+from scipy.sparse.linalg import LinearOperator
 from IPython.core import debugger
 breakpoint = debugger.set_trace
 
 ## Local Imports
-from .np_utils import vectorize_tensor, unvectorize_tensor, to_nparray, get_extended_domain, extend_tensor_circularly
+from . import fft_ops
+from .np_utils import vectorize_tensor, to_nparray, get_extended_domain, get_chunk_slices
 from .shared_constants import *
 
 # Smoothing windows that are available to band-limit a signal
@@ -23,7 +26,10 @@ def circular_conv( v1, v2, axis=-1 ):
 	Returns:
 		v1convv2 (numpy.ndarray): convolution result. N x 1 vector.
 	"""
-	v1convv2 = np.fft.irfft( np.fft.rfft( v1, axis=axis ) * np.fft.rfft( v2, axis=axis ), axis=axis, n=v1.shape[axis] )
+	if(fft_ops.is_real(v1) and fft_ops.is_real(v2)):
+		v1convv2 = fft_ops.irfft( fft_ops.rfft( v1, axis=axis ) * fft_ops.rfft( v2, axis=axis ), axis=axis, n=v1.shape[axis] )
+	else:
+		v1convv2 = fft_ops.ifft( fft_ops.fft( v1, axis=axis ) * fft_ops.fft( v2, axis=axis ), axis=axis )
 	return v1convv2
 
 def circular_corr( v1, v2, axis=-1 ):
@@ -35,35 +41,211 @@ def circular_corr( v1, v2, axis=-1 ):
 	Returns:
 		v1corrv2 (numpy.ndarray): correlation result. N x 1 vector.
 	"""
-	v1corrv2 = np.fft.ifft( np.fft.fft( v1, axis=axis ).conj() * np.fft.fft( v2, axis=axis ), axis=axis ).real
+	if(fft_ops.is_real(v1) and fft_ops.is_real(v2)):
+		v1corrv2 = fft_ops.irfft( fft_ops.rfft( v1, axis=axis ).conj() * fft_ops.rfft( v2, axis=axis ), axis=axis, n=v1.shape[axis] )
+	else:
+		v1corrv2 = fft_ops.ifft( fft_ops.fft( v1, axis=axis ).conj() * fft_ops.fft( v2, axis=axis ), axis=axis ).real
 	return v1corrv2
 
 def circular_matched_filter(s, template, axis=-1):
 	assert(s.shape[axis] == template.shape[axis]), "input signal and template dims need to match at axis"
-	corrf = circular_corr(template, s, axis=axis)
-	return np.argmax(corrf, axis=axis)
+	return CircularFilter(template, axis=axis).matched_filter(s)
+
+def circular_matched_filter_subbin(s, template, axis=-1, chunk_size=4096, method='parabolic'):
+	'''
+		Same as circular_matched_filter, but the correlation is computed in chunks of chunk_size signals, so the full correlation
+		tensor is never materialized. The integer argmax of each correlation is refined to sub-bin precision using its neighbors
+		(see circular_subbin_argmax).
+		The template can be a single N-element vector or a tensor with the same shape as s (one template per signal).
+		Returns:
+			peak_loc: sub-bin location of the correlation peak, between [0, N)
+			peak_score: interpolated value of the correlation at peak_loc
+	'''
+	s = to_nparray(s)
+	template = to_nparray(template)
+	assert(s.shape[axis] == template.shape[axis]), "input signal and template dims need to match at axis"
+	# Place the time dimension last and vectorize
+	s = np.moveaxis(s, axis, -1)
+	n = s.shape[-1]
+	out_shape = s.shape[0:-1]
+	s = s.reshape((-1, n))
+	n_elems = s.shape[0]
+	if(template.ndim == 1): template_filter = CircularFilter(template)
+	else: template = np.moveaxis(template, axis, -1).reshape((-1, n))
+	peak_loc = np.zeros((n_elems,), dtype=fft_ops.get_real_dtype(s.dtype))
+	peak_score = np.zeros((n_elems,), dtype=fft_ops.get_real_dtype(s.dtype))
+	for chunk in get_chunk_slices(n_elems, chunk_size):
+		if(template.ndim > 1): template_filter = CircularFilter(template[chunk])
+		corrf = template_filter.correlate(s[chunk])
+		(peak_loc[chunk], peak_score[chunk]) = circular_subbin_argmax(corrf, axis=-1, method=method)
+	return (peak_loc.reshape(out_shape), peak_score.reshape(out_shape))
+
+def circular_subbin_argmax(y, axis=-1, method='parabolic'):
+	'''
+		Find the argmax of y along axis, and refine it to sub-bin precision by fitting a curve through the maximum and 
+		its two (circular) neighbors. Available methods:
+			* 'parabolic': Fit a parabola
+			* 'gaussian': Fit a gaussian (i.e., a parabola to log(y)). If any of the 3 values is non-positive we fallback to parabolic.
+			* None: No refinement, simply return the integer argmax
+		Returns the sub-bin argmax, between [0, N), and the interpolated value at the sub-bin argmax
+	'''
+	assert(method in ['parabolic', 'gaussian', None]), "Invalid sub-bin refinement method"
+	n = y.shape[axis]
+	argmax_idx = np.expand_dims(np.argmax(y, axis=axis), axis=axis)
+	y_0 = np.take_along_axis(y, argmax_idx, axis=axis)
+	if(method is None):
+		return (np.squeeze(argmax_idx, axis=axis).astype(y.dtype), np.squeeze(y_0, axis=axis))
+	y_minus = np.take_along_axis(y, (argmax_idx - 1) % n, axis=axis)
+	y_plus = np.take_along_axis(y, (argmax_idx + 1) % n, axis=axis)
+	(offset, peak_val) = parabolic_peak_interp(y_minus, y_0, y_plus)
+	if(method == 'gaussian'):
+		is_positive = (y_minus > 0) & (y_0 > 0) & (y_plus > 0)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			(log_offset, log_peak_val) = parabolic_peak_interp(np.log(y_minus), np.log(y_0), np.log(y_plus))
+		offset = np.where(is_positive, log_offset, offset)
+		peak_val = np.where(is_positive, np.exp(log_peak_val), peak_val)
+	peak_loc = (argmax_idx + offset) % n
+	return (np.squeeze(peak_loc, axis=axis), np.squeeze(peak_val, axis=axis))
+
+def parabolic_peak_interp(y_minus, y_0, y_plus):
+	'''
+		Fit a parabola through (-1, y_minus), (0, y_0), (1, y_plus), where y_0 is a local maximum.
+		Return the location of the vertex (offset between [-0.5, 0.5]) and its value.
+	'''
+	curvature = y_minus - 2*y_0 + y_plus
+	with np.errstate(divide='ignore', invalid='ignore'):
+		offset = np.where(curvature < 0, 0.5*(y_minus - y_plus) / curvature, 0.)
+	offset = np.clip(offset, -0.5, 0.5)
+	peak_val = y_0 - 0.25*(y_minus - y_plus)*offset
+	return (offset, peak_val)
+
+class CircularFilter:
+	'''
+		Circular filter with a fixed real-valued kernel (e.g., smoothing window, IRF or matched filter template).
+		The rfft of the kernel is computed once when the filter is created, so each call to convolve/correlate/matched_filter
+		only needs to transform the input data. 
+		The kernel can be a single ...xN vector that is broadcasted to all the input signals, or a tensor that broadcasts
+		with the inputs. If the kernel has less than n elements along axis, it is zero-padded.
+		Example:
+			smoothing_filter = CircularFilter(get_smoothing_window(N=n, window_len=10, window='hanning'))
+			for transient in transients: smoothed_transient = smoothing_filter.convolve(transient)
+	'''
+	def __init__(self, kernel, n=None, axis=-1):
+		if(not fft_ops.is_torch_tensor(kernel)): kernel = to_nparray(kernel)
+		# 1D kernels are broadcasted along axis of the inputs
+		kernel_axis = axis if (kernel.ndim > 1) else -1
+		if(n is None): n = kernel.shape[kernel_axis]
+		assert(kernel.shape[kernel_axis] <= n), "kernel can't have more than n elements along axis"
+		self.n = n
+		self.axis = axis
+		self.kernel_ndim = kernel.ndim
+		self.f_kernel = fft_ops.rfft(kernel, n=n, axis=kernel_axis)
+
+	@classmethod
+	def from_rfft(cls, f_kernel, n, axis=-1):
+		'''
+			Create the filter from a precomputed kernel spectrum (the rfft of a kernel with n elements along axis)
+		'''
+		circ_filter = cls.__new__(cls)
+		circ_filter.n = n
+		circ_filter.axis = axis
+		circ_filter.kernel_ndim = f_kernel.ndim
+		circ_filter.f_kernel = f_kernel
+		return circ_filter
+
+	def get_f_kernel(self, f_x):
+		'''
+			Return the kernel spectrum reshaped such that it broadcasts with the spectrum f_x of an input along self.axis.
+			If f_x is a torch tensor, the kernel spectrum is converted to a tensor on the same device.
+		'''
+		f_kernel = fft_ops.as_array_like(self.f_kernel, f_x)
+		if((self.kernel_ndim > 1) or (f_x.ndim == 1)): return f_kernel
+		f_kernel_shape = [1]*f_x.ndim
+		f_kernel_shape[self.axis] = f_kernel.shape[-1]
+		return f_kernel.reshape(f_kernel_shape)
+
+	def verify_input(self, x):
+		if(not fft_ops.is_torch_tensor(x)): x = to_nparray(x)
+		assert(x.shape[self.axis] == self.n), "input signal needs to have n={} elements along axis".format(self.n)
+		return x
 
-def get_smoothing_window(N=100,window_len=11,window='flat'):
+	def write_output(self, y, out):
+		if(out is None): return y
+		if(fft_ops.is_torch_tensor(out)): out.copy_(y)
+		else: np.copyto(out, y, casting='same_kind')
+		return out
+
+	def filter(self, x, out=None, conj_kernel=False):
+		x = self.verify_input(x)
+		f_x = fft_ops.rfft(x, axis=self.axis)
+		f_kernel = self.get_f_kernel(f_x)
+		if(conj_kernel): f_kernel = f_kernel.conj()
+		# torch inputs are not updated in-place to support autograd
+		if(fft_ops.is_torch_tensor(f_x)): f_x = f_x*f_kernel
+		else: f_x *= f_kernel
+		return self.write_output(fft_ops.irfft(f_x, n=self.n, axis=self.axis), out)
+
+	def convolve(self, x, out=None):
+		'''
+			Circular convolution of kernel and x. Same as circular_conv(kernel, x, axis)
+			If out is given, the result is written to out (which can be x).
+		'''
+		return self.filter(x, out=out)
+
+	def correlate(self, x, out=None):
+		'''
+			Circular correlation of kernel and x. Same as circular_corr(kernel, x, axis)
+			If out is given, the result is written to out (which can be x).
+		'''
+		return self.filter(x, out=out, conj_kernel=True)
+
+	def matched_filter(self, x):
+		'''
+			Index of the maximum of the circular correlation between kernel and x. Same as circular_matched_filter(x, kernel, axis)
+		'''
+		corrf = self.correlate(x)
+		if(fft_ops.is_torch_tensor(corrf)): return corrf.argmax(dim=self.axis)
+		return np.argmax(corrf, axis=self.axis)
+
+# numpy functions used to generate each tapered smoothing window
+SMOOTHING_WINDOW_FUNCS = {'hanning': np.hanning, 'hamming': np.hamming, 'bartlett': np.bartlett, 'blackman': np.blackman}
+
+def get_smoothing_window(N=100,window_len=11,window='flat',dtype=np.float64,return_rfft=False):
 	"""
 		smooth the data using a window with requested size.
+		Windows are cached for each (N, window_len, window, dtype), so the returned arrays are read-only. Copy them before modifying.
+		If return_rfft is True, return the (also cached) rfft of the window instead.
 	"""
 	## Validate Inputs
 	if(N < window_len):
 		raise ValueError("Input vector needs to be bigger than window size.")
 	if(not window in SMOOTHING_WINDOWS):
 		raise ValueError( "Chosen smoothing window needs to be one of: {}".format( SMOOTHING_WINDOWS ) )
+	if(return_rfft): return get_cached_smoothing_window_rfft(N, int(window_len), window, np.dtype(dtype))
+	return get_cached_smoothing_window(N, int(window_len), window, np.dtype(dtype))
+
+@functools.lru_cache(maxsize=128)
+def get_cached_smoothing_window(N, window_len, window, dtype):
 	## Generate smoothing window
-	w = np.zeros((N,))
+	w = np.zeros((N,), dtype=dtype)
 	if window == 'flat': #moving average
-		w[0:int(window_len)]=np.ones(int(window_len),'d')
+		w[0:window_len] = 1.
 	elif window == 'impulse':
 		w[0] = 1 
 	else:
-		w[0:int(window_len)]=eval('np.'+window+'(int(window_len))')
+		w[0:window_len] = SMOOTHING_WINDOW_FUNCS[window](window_len)
 	shift = np.argmax(w)
 	w = np.roll(w, shift=-1*shift )
-	# Return normalized smoothhing window
-	return (w / (w.sum()))
+	# Normalize smoothhing window
+	w /= w.sum()
+	w.setflags(write=False)
+	return w
+
+@functools.lru_cache(maxsize=128)
+def get_cached_smoothing_window_rfft(N, window_len, window, dtype):
+	f_w = fft_ops.rfft(get_cached_smoothing_window(N, window_len, window, dtype))
+	f_w.setflags(write=False)
+	return f_w
 
 def smooth(x, window_len=11, window='flat'):
 	"""smooth the data using a window with requested size.
@@ -104,37 +286,53 @@ def smooth(x, window_len=11, window='flat'):
 	if( window_len > len(x)):
 		print("Not smoothing. signal is smaller than window lengths")
 		return x
-	# Get smoothing window 
-	w = get_smoothing_window( N = len( x ), window = window, window_len = window_len )
-	y = np.real( circular_conv( x, w ) ) / ( w.sum() )
+	# Get smoothing filter (the smoothing window is already normalized)
+	y = get_smoothing_filter( N = len( x ), window = window, window_len = window_len ).convolve( x )
 	# y = np.real(np.fft.ifft(np.fft.fft(x)*np.fft.fft(w)))/(w.sum())
 	#### The line below performs the same operation as the line above but slower
 	# np.convolve(w/(w.sum()),s,mode='valid')
 	return y
 
-def smooth_tensor(X, window_duty=0.1, window='hanning'):
+def get_smoothing_filter(N=100, window_len=11, window='flat', axis=-1, dtype=np.float64):
+	'''
+		CircularFilter for the smoothing window returned by get_smoothing_window. 
+		The window spectrum is cached, so smoothing many signals or code matrices with the same window only computes it once.
+	'''
+	f_window = get_smoothing_window(N=N, window_len=window_len, window=window, dtype=dtype, return_rfft=True)
+	return CircularFilter.from_rfft(f_window, n=N, axis=axis)
+
+def smooth_tensor(X, window_duty=0.1, window='hanning', axis=-1, out=None, chunk_size=None):
+	'''
+		Smooth all the signals in X along axis in a single FFT pass. The smoothing window length is window_duty*N.
+		Same as applying smooth to each signal in X.
+		The output has the same precision as X (float32 inputs are not upcasted). If out is given the result is written to it 
+		(out=X smooths X in-place). If chunk_size is given, X is smoothed in chunks of chunk_size elements along its first 
+		dimension, which bounds the size of the temporary FFT arrays.
+	'''
 	assert(window_duty < 1.0), "window_duty needs to be less than one"
 	assert(window_duty > 0.0), "window_duty needs to be greater than 0"
-	X_shape = X.shape
-	n = X.shape[-1]
-	n_arrays = int(X.size / n)
-	X = X.reshape((n_arrays,n))
-
-	window = get_smoothing_window(N=n, window_len=window_duty*n, window=window)
-	window = window.reshape((1,n))
-
-	Y = np.real( circular_conv(X, window) ) / (window.sum())
-
-	return Y.reshape(X_shape)
-
-def smooth_codes( modfs, demodfs, window_duty=0.15 ):
-	(N,K) = modfs.shape
-	smoothed_modfs = np.zeros( (N,K) )
-	smoothed_demodfs = np.zeros( (N,K) )
-	#### Smooth functions. No smoothing is applied by default
-	for i in range(0,K):
-		smoothed_modfs[:,i] = Smooth( modfs[:,i], window_len = N*window_duty, window='hanning' ) 
-		smoothed_demodfs[:,i] = Smooth( demodfs[:,i], window_len = N*window_duty, window='hanning' )
+	n = X.shape[axis]
+	window_len = int(window_duty*n)
+	if(window_len < 3): 
+		if(out is None): return X
+		if(fft_ops.is_torch_tensor(out)): out.copy_(X)
+		else: np.copyto(out, X, casting='same_kind')
+		return out
+	dtype = fft_ops.get_real_dtype(fft_ops.get_np_dtype(X))
+	smoothing_filter = get_smoothing_filter(N=n, window_len=window_len, window=window, axis=axis, dtype=dtype)
+	if((chunk_size is None) or (X.ndim == 1) or ((axis % X.ndim) == 0)): return smoothing_filter.convolve(X, out=out)
+	if(out is None): out = X.new_empty(X.shape) if fft_ops.is_torch_tensor(X) else np.empty(X.shape, dtype=dtype)
+	for chunk in get_chunk_slices(X.shape[0], chunk_size):
+		smoothing_filter.convolve(X[chunk], out=out[chunk])
+	return out
+
+def smooth_codes( modfs, demodfs, window_duty=0.15, window='hanning', axis=-2 ):
+	'''
+		Smooth the modulation and demodulation functions of an N x K coding scheme (each column is a function).
+		Stacks of code matrices (... x N x K) are also supported. The functions are smoothed along axis.
+	'''
+	smoothed_modfs = smooth_tensor( modfs, window_duty=window_duty, window=window, axis=axis )
+	smoothed_demodfs = smooth_tensor( demodfs, window_duty=window_duty, window=window, axis=axis )
 	return (smoothed_modfs, smoothed_demodfs)
 
 def circulant(f, direction = 1):
@@ -153,24 +351,180 @@ def circulant(f, direction = 1):
 	# to be either forward (dir=1) or backward (dir=-1).'
 	#### Get parameters
 	N = f.size # We know f is a vector so just use its size.
-	C = np.zeros((N,N))
 	isRow = (f.shape[0] == 1) # Doesn't matter for ndarrays
-	#### Generate circulant matrix
-	if(isRow):
-		for i in range(0,N):
-			C[[i],:] = np.roll(f,i*direction)
-	else:
-		for i in range(0,N):
-			C[:,[i]] = np.roll(f,i*direction).reshape((N,1))
- 
-	return C
+	#### Generate circulant matrix. Each row (or column) is f shifted by i*direction
+	(shift_idx, elem_idx) = np.ogrid[0:N, 0:N]
+	C = f.reshape((N,))[(elem_idx - shift_idx*direction) % N].astype(np.result_type(f.dtype, np.float64))
+	if(isRow): return C
+	else: return C.transpose()
+
+class CirculantOperator(LinearOperator):
+	'''
+		Implicit circulant matrix with the same layout as circulant(f, direction), that only stores the spectrum of the 
+		generating vector f. Products and solves are computed with FFTs in O(N log N), and the dense matrix is only created
+		when calling to_dense(). Can be used anywhere a scipy.sparse.linalg.LinearOperator is accepted.
+		For a column vector f and direction=1, C @ x = circular_conv(f, x).
+		For direction=-1, C is symmetric and C @ x = circular_corr(x, f).
+		Only real-valued f are supported.
+	'''
+	def __init__(self, f, direction=1):
+		f = to_nparray(f)
+		assert(fft_ops.is_real(f)), "CirculantOperator only supports real-valued vectors"
+		assert((direction == 1) or (direction == -1)), 'direction needs to be either forward (dir=1) or backward (dir=-1).'
+		N = f.size
+		super().__init__(dtype=np.result_type(f.dtype, np.float64), shape=(N, N))
+		self.f = f
+		self.direction = direction
+		self.is_row = (f.shape[0] == 1)
+		self.f_f = fft_ops.rfft(f.reshape((N,)))[:, np.newaxis]
+		# With direction=1 the circulant matrix of a row vector is the transpose of the one for a column vector
+		self.is_transposed = self.is_row and (direction == 1)
+
+	def apply(self, x, transpose=False):
+		'''
+			Compute C @ x (or C.T @ x if transpose) for an N or N x K input
+		'''
+		N = self.shape[0]
+		x_shape = x.shape
+		f_x = fft_ops.rfft(x.reshape((N, -1)), axis=0)
+		if(self.direction == -1): f_y = f_x.conj() * self.f_f
+		elif(transpose != self.is_transposed): f_y = f_x * self.f_f.conj()
+		else: f_y = f_x * self.f_f
+		return fft_ops.irfft(f_y, n=N, axis=0).reshape(x_shape)
+
+	def _matvec(self, x): return self.apply(x)
+	def _matmat(self, X): return self.apply(X)
+	def _rmatvec(self, x): return self.apply(x, transpose=True)
+	def _rmatmat(self, X): return self.apply(X, transpose=True)
+
+	def solve(self, b, rcond=1e-15):
+		'''
+			Solve C @ x = b via spectral division. b can be an N or N x K tensor.
+			Frequencies with magnitude below rcond*max(magnitude) are zeroed out, i.e., we compute the pseudo-inverse solution 
+			(same as np.linalg.pinv(C, rcond) @ b).
+		'''
+		N = self.shape[0]
+		b_shape = b.shape
+		f_b = fft_ops.rfft(b.reshape((N, -1)), axis=0)
+		abs_f_f = np.abs(self.f_f)
+		is_valid = abs_f_f > (rcond*abs_f_f.max())
+		inv_f_f = np.where(is_valid, 1. / np.where(is_valid, self.f_f, 1.), 0.)
+		if(self.direction == -1): f_x = (f_b * inv_f_f).conj()
+		elif(self.is_transposed): f_x = f_b * inv_f_f.conj()
+		else: f_x = f_b * inv_f_f
+		return fft_ops.irfft(f_x, n=N, axis=0).reshape(b_shape)
+
+	def to_dense(self):
+		return circulant(self.f, direction=self.direction)
 
 def sinc_interp(lres_signal, hres_n, axis=-1):
 	'''
 		I found out the scipy's resample does sinc interpolation so I have replaced this code with that
+		Real signals are resampled with a cached SincResampler (same output as scipy's resample).
 	'''
-	hres_signal = signal.resample(lres_signal, hres_n, axis=axis)
-	return hres_signal
+	if(not fft_ops.is_real(lres_signal)): return signal.resample(lres_signal, hres_n, axis=axis)
+	lres_signal = to_nparray(lres_signal)
+	resampler = get_sinc_resampler(lres_signal.shape[axis], hres_n, dtype=fft_ops.get_real_dtype(lres_signal.dtype))
+	return resampler.resample(lres_signal, axis=axis)
+
+@functools.lru_cache(maxsize=32)
+def get_sinc_resampler(lres_n, hres_n, dtype=np.float64):
+	'''
+		Cached SincResampler for a given (lres_n, hres_n, dtype)
+	'''
+	return SincResampler(lres_n, hres_n, dtype=dtype)
+
+class SincResampler:
+	'''
+		Band-limited (sinc) resampling of real signals from lres_n to hres_n samples, same as scipy.signal.resample.
+		The spectral weights (zero-padding/truncation plan) are computed once, and the local interpolation matrices are 
+		cached for each window length, so the resampler can be reused across calls (see get_sinc_resampler).
+		local_resample only evaluates the hres signal in a small window around each signal's peak, which is much cheaper
+		than resample when only the peak location is needed.
+		Example:
+			resampler = get_sinc_resampler(n, 20*n)
+			(hres_idx, hres_vals) = resampler.local_resample(transients)
+			(peak_loc, peak_val) = resampler.local_argmax(transients)
+	'''
+	def __init__(self, lres_n, hres_n, dtype=np.float64):
+		assert((lres_n > 0) and (hres_n > 0)), "lres_n and hres_n should be positive"
+		self.lres_n = lres_n
+		self.hres_n = hres_n
+		self.dtype = np.dtype(dtype)
+		# Number of rfft bins shared by the lres and hres signals
+		n_shared = min(lres_n, hres_n)
+		self.nf = (n_shared // 2) + 1
+		# Scale so that the amplitude is preserved, and split/merge the unpaired nyquist bin
+		f_weights = np.ones((self.nf,))*(hres_n / lres_n)
+		if(((n_shared % 2) == 0) and (hres_n != lres_n)): f_weights[-1] *= 0.5 if (hres_n > lres_n) else 2.
+		self.f_weights = f_weights.astype(self.dtype)
+		self.f_weights.flags.writeable = False
+		self.local_interp_mats = {}
+
+	def get_f_hres(self, x):
+		'''
+			rfft of the hres signal (first nf bins) for a (... x lres_n) tensor
+		'''
+		assert(x.shape[-1] == self.lres_n), "input needs to have lres_n={} elements along the last dimension".format(self.lres_n)
+		return fft_ops.rfft(x, axis=-1)[..., 0:self.nf]*self.f_weights
+
+	def resample(self, x, axis=-1):
+		x = np.moveaxis(to_nparray(x), axis, -1)
+		return np.moveaxis(fft_ops.irfft(self.get_f_hres(x), n=self.hres_n, axis=-1), -1, axis)
+
+	def get_default_half_window_len(self):
+		# The peak of the hres signal is usually within one lres bin of the lres peak
+		return int(np.ceil(self.hres_n / self.lres_n))
+
+	def get_local_interp_mat(self, half_window_len):
+		'''
+			nf x (2*half_window_len + 1) matrix that evaluates the inverse rfft of the hres signal at offsets 
+			[-half_window_len, half_window_len] from hres bin 0. 
+		'''
+		if(not half_window_len in self.local_interp_mats):
+			freqs = np.arange(0, self.nf)
+			offsets = np.arange(-half_window_len, half_window_len + 1)
+			# Non-zero and non-nyquist frequencies appear twice in the full spectrum
+			freq_weights = np.where((freqs == 0) | (2*freqs == self.hres_n), 1., 2.) / self.hres_n
+			interp_mat = freq_weights[:, np.newaxis]*np.exp(1j*(TWOPI / self.hres_n)*freqs[:, np.newaxis]*offsets[np.newaxis, :])
+			self.local_interp_mats[half_window_len] = interp_mat.astype(fft_ops.get_complex_dtype(self.dtype))
+		return self.local_interp_mats[half_window_len]
+
+	def local_resample(self, x, half_window_len=None, center_idx=None, chunk_size=1024):
+		'''
+			Evaluate the hres signal only at the 2*half_window_len+1 hres bins around center_idx, for a (... x lres_n) tensor. 
+			By default center_idx is the hres bin of each signal's (lres) argmax, and half_window_len is one lres bin.
+			Returns:
+				hres_idx: (... x 2*half_window_len+1) hres bin indeces, between [0, hres_n)
+				hres_vals: (... x 2*half_window_len+1) hres signal at hres_idx
+		'''
+		x = to_nparray(x)
+		if(half_window_len is None): half_window_len = self.get_default_half_window_len()
+		(x, x_original_shape) = vectorize_tensor(x)
+		n_elems = x.shape[0]
+		if(center_idx is None): center_idx = np.round(np.argmax(x, axis=-1)*(self.hres_n / self.lres_n)).astype(np.int64)
+		else: center_idx = np.broadcast_to(to_nparray(center_idx), x_original_shape[0:-1]).reshape((n_elems,)).astype(np.int64)
+		interp_mat = self.get_local_interp_mat(half_window_len)
+		freqs = np.arange(0, self.nf)
+		hres_vals = np.zeros((n_elems, interp_mat.shape[-1]), dtype=self.dtype)
+		for chunk in get_chunk_slices(n_elems, chunk_size):
+			# Shift the hres signal so that center_idx is at bin 0
+			phase = (center_idx[chunk, np.newaxis]*freqs[np.newaxis, :] % self.hres_n)*(TWOPI / self.hres_n)
+			hres_vals[chunk] = ((self.get_f_hres(x[chunk])*np.exp(1j*phase)) @ interp_mat).real
+		hres_idx = (center_idx[:, np.newaxis] + np.arange(-half_window_len, half_window_len + 1)[np.newaxis, :]) % self.hres_n
+		out_shape = x_original_shape[0:-1] + (interp_mat.shape[-1],)
+		return (hres_idx.reshape(out_shape), hres_vals.reshape(out_shape))
+
+	def local_argmax(self, x, half_window_len=None, chunk_size=1024):
+		'''
+			hres argmax of a (... x lres_n) tensor, searched in a window around the lres argmax (see local_resample).
+			Returns the hres bin of the peak, between [0, hres_n), and the hres signal at the peak.
+		'''
+		(hres_idx, hres_vals) = self.local_resample(x, half_window_len=half_window_len, chunk_size=chunk_size)
+		local_argmax_idx = np.argmax(hres_vals, axis=-1)[..., np.newaxis]
+		peak_loc = np.take_along_axis(hres_idx, local_argmax_idx, axis=-1)[..., 0]
+		peak_val = np.take_along_axis(hres_vals, local_argmax_idx, axis=-1)[..., 0]
+		return (peak_loc, peak_val)
 
 def sinc_interp_old(lres_signal, hres_n):
 	'''
@@ -185,13 +539,13 @@ def sinc_interp_old(lres_signal, hres_n):
 	lres_n = lres_signal.shape[-1]
 	assert((hres_n % lres_n) == 0), "Current sinc_interp is only implemented for integer multiples of lres_n"
 	upscaling_factor = hres_n / lres_n
-	f_lres_signal = np.fft.rfft(lres_signal, axis=-1)
+	f_lres_signal = fft_ops.rfft(lres_signal, axis=-1)
 	lres_nf = f_lres_signal.shape[-1]
 	hres_nf = (hres_n // 2) + 1
 	f_hres_signal = np.zeros((n_elems, hres_nf), dtype=f_lres_signal.dtype)
 	f_hres_signal[..., 0:lres_nf] = f_lres_signal
 	# NOTE: For some reason we have to multiply by the upscaling factor if we want the output signal to have the same amplitude
-	hres_signal = np.fft.irfft(f_hres_signal)*upscaling_factor
+	hres_signal = fft_ops.irfft(f_hres_signal, n=hres_n)*upscaling_factor
 	# Reshape final vectors
 	hres_signal_original_shape = np.array(lres_signal_original_shape)
 	hres_signal_original_shape[-1] = hres_n
@@ -199,26 +553,102 @@ def sinc_interp_old(lres_signal, hres_n):
 	lres_signal = lres_signal.reshape(lres_signal_original_shape)
 	return hres_signal
 
-def normalize_signal(v, axis=-1): return v / (v.sum(axis=axis, keepdims=True) + EPSILON)
-def standardize_signal(v, axis=-1): return (v - v.min(axis=axis, keepdims=True)) / (v.max(axis=axis, keepdims=True) - v.min(axis=axis, keepdims=True) + EPSILON)
-
-def gaussian_pulse(time_domain, mu, width, circ_shifted=True):
+def normalize_signal(v, axis=-1, out=None):
+	v_sum = v.sum(axis=axis, keepdims=True) + EPSILON
+	if(out is None): return v / v_sum
+	if(fft_ops.is_torch_tensor(out)): return out.copy_(v / v_sum)
+	return np.divide(v, v_sum, out=out)
+def standardize_signal(v, axis=-1, out=None):
+	# Integer inputs are standardized in floating point (same as (v - v_min) / v_range)
+	dtype = np.result_type(v.dtype, np.float32)
+	v_min = v.min(axis=axis, keepdims=True).astype(dtype, copy=False)
+	v_range = v.max(axis=axis, keepdims=True) - v_min
+	v_range += EPSILON
+	if(out is None): out = np.empty(v.shape, dtype=dtype)
+	np.subtract(v, v_min, out=out)
+	return np.divide(out, v_range, out=out)
+
+def gaussian_pulse(time_domain, mu, width, circ_shifted=True, out=None, dtype=np.float64):
 	'''
 		Generate K gaussian pulses with mean=mu and sigma=width.
 		If circ_shifted is set to true we create a gaussian that wraps around at the boundaries.
+		If out is given (a C-contiguous array with K*len(time_domain) elements) the pulses are written to it. 
+		If mu or width are torch tensors, the pulses are generated with torch (differentiable w.r.t. mu and width).
 	'''
+	if(fft_ops.is_torch_tensor(mu) or fft_ops.is_torch_tensor(width)): return gaussian_pulse_torch(time_domain, mu, width, circ_shifted=circ_shifted)
 	mu_arr = to_nparray(mu)
 	width_arr = to_nparray(width)
 	assert((width_arr.size==1) or (width_arr.size==mu_arr.size)), "Input mu and width should have the same dimensions OR width should only be 1 element"
+	if(out is not None):
+		assert(out.flags.c_contiguous and (out.size == mu_arr.size*time_domain.size)), "out needs to be a C-contiguous array with K*n elements"
 	if(circ_shifted):
-		ext_time_domain = get_extended_domain(time_domain)
-		ext_pulse = np.exp(-1*np.square((ext_time_domain[np.newaxis,:] - mu_arr[:, np.newaxis]) / width_arr[:, np.newaxis]))
-		n_bins = time_domain.shape[-1]
-		pulse = ext_pulse[...,0:n_bins] + ext_pulse[...,n_bins:2*n_bins] + ext_pulse[...,2*n_bins:3*n_bins]
+		if(out is None): return gaussian_pulse_bank(time_domain, mu_arr, width_arr, dtype=dtype).squeeze()
+		gaussian_pulse_bank(time_domain, mu_arr, width_arr, out=out.reshape((mu_arr.size, time_domain.size)))
+		return out
 	else:
 		pulse = np.exp(-1*np.square((time_domain[np.newaxis,:] - mu_arr[:, np.newaxis]) / width_arr[:, np.newaxis]))
+	if(out is None): return normalize_signal(pulse.squeeze(), axis=-1).astype(dtype, copy=False)
+	normalize_signal(pulse, axis=-1, out=out.reshape(pulse.shape))
+	return out
+
+def gaussian_pulse_torch(time_domain, mu, width, circ_shifted=True):
+	'''
+		torch version of gaussian_pulse. Pulses are evaluated over the full (extended) domain.
+	'''
+	like = mu if fft_ops.is_torch_tensor(mu) else width
+	mu = fft_ops.as_array_like(mu, like).reshape((-1, 1))
+	width = fft_ops.as_array_like(width, like).reshape((-1, 1))
+	n = time_domain.size
+	if(circ_shifted):
+		ext_pulse = (-1*(((fft_ops.as_array_like(get_extended_domain(time_domain), like) - mu) / width)**2)).exp()
+		pulse = ext_pulse[..., 0:n] + ext_pulse[..., n:2*n] + ext_pulse[..., 2*n:3*n]
+	else:
+		pulse = (-1*(((fft_ops.as_array_like(time_domain, like) - mu) / width)**2)).exp()
 	return normalize_signal(pulse.squeeze(), axis=-1)
 
+def gaussian_pulse_bank(time_domain, mu, width, out=None, dtype=np.float64, chunk_size=4096, support_n_widths=None):
+	'''
+		Generate K normalized gaussian pulses with mean=mu and sigma=width that wrap around at the boundaries. 
+		Outputs the same K x N pulses as gaussian_pulse with circ_shifted=True, but each pulse is only evaluated over its 
+		effective support, i.e., the bins within support_n_widths*width of mu, which are wrapped with modular indexing.
+		By default the support is the region where the gaussian is larger than the machine epsilon of the output dtype.
+		The pulses are written into out (K x N, e.g., a preallocated float32 array) if given, and generated in chunks of 
+		chunk_size pulses to bound the memory used by temporary arrays.
+	'''
+	time_domain = to_nparray(time_domain)
+	mu_arr = to_nparray(mu).reshape((-1,))
+	width_arr = to_nparray(width).reshape((-1,))
+	assert((width_arr.size==1) or (width_arr.size==mu_arr.size)), "Input mu and width should have the same dimensions OR width should only be 1 element"
+	(n_pulses, n_bins) = (mu_arr.size, time_domain.shape[-1])
+	if(out is None): out = np.zeros((n_pulses, n_bins), dtype=dtype)
+	assert(out.shape == (n_pulses, n_bins)), "out needs to be a K x N array"
+	# exp(-x^2) is smaller than the machine epsilon for x > sqrt(-log(eps))
+	if(support_n_widths is None): support_n_widths = np.sqrt(-1*np.log(np.finfo(out.dtype).eps))
+	# Time bin size and period of the circularly extended domain (same as in get_extended_domain)
+	dt = time_domain[1] - time_domain[0]
+	period = time_domain.max() + dt
+	for chunk in get_chunk_slices(n_pulses, chunk_size):
+		curr_mu = mu_arr[chunk, np.newaxis]
+		curr_width = width_arr[chunk, np.newaxis] if (width_arr.size > 1) else width_arr[:, np.newaxis]
+		half_support_len = int(np.ceil(support_n_widths*curr_width.max() / dt))
+		if((2*half_support_len + 1) >= n_bins):
+			# Pulses are as wide as the domain, so evaluate them over the full extended domain
+			ext_time_domain = get_extended_domain(time_domain)
+			ext_pulse = np.exp(-1*np.square((ext_time_domain[np.newaxis,:] - curr_mu) / curr_width))
+			pulse = ext_pulse[...,0:n_bins] + ext_pulse[...,n_bins:2*n_bins] + ext_pulse[...,2*n_bins:3*n_bins]
+			normalize_signal(pulse, axis=-1, out=out[chunk])
+			continue
+		# Bins in the support of each pulse, and the number of periods they wrapped around
+		center_bin = np.round((curr_mu - time_domain[0]) / dt).astype(np.int64)
+		(n_wraps, support_bin) = np.divmod(center_bin + np.arange(-half_support_len, half_support_len+1)[np.newaxis,:], n_bins)
+		pulse_support = np.exp(-1*np.square((time_domain[support_bin] + n_wraps*period - curr_mu) / curr_width))
+		# Only the previous, current and next periods are added (same as the extended domain in gaussian_pulse)
+		pulse_support[np.abs(n_wraps) > 1] = 0
+		out[chunk] = 0
+		np.put_along_axis(out[chunk], support_bin, pulse_support, axis=-1)
+		out[chunk] /= (pulse_support.sum(axis=-1, keepdims=True) + EPSILON)
+	return out
+
 def expgaussian_pulse_erfc(time_domain, mu, sigma, exp_lambda):
 	if(exp_lambda is None): return gaussian_pulse(time_domain, mu, sigma)
 	mu_arr = to_nparray(mu)
@@ -226,7 +656,14 @@ def expgaussian_pulse_erfc(time_domain, mu, sigma, exp_lambda):
 	mu_minus_t = mu_arr[:, np.newaxis] - time_domain[np.newaxis,:]  
 	lambda_sigma_sq = exp_lambda*sigma_sq
 	erfc_input = (mu_minus_t + lambda_sigma_sq) / sigma
-	pulse = exp_lambda*np.exp(0.5*exp_lambda*(lambda_sigma_sq + 2*mu_minus_t))*scipy.special.erfc(erfc_input)
+	# exp(...)*erfc(erfc_input) overflows (inf*0) for large erfc_input. For erfc_input >= 0 use erfc(x) = erfcx(x)*exp(-x^2), 
+	# whose exponent is always <= 0. For erfc_input < 0 the original exponent is < 0 and erfc(x) is between 1 and 2
+	is_pos_input = erfc_input >= 0
+	log_scale = np.where(is_pos_input, -1*(np.square(mu_minus_t) / sigma_sq + exp_lambda*mu_minus_t + 0.5*exp_lambda*lambda_sigma_sq), 0.5*exp_lambda*(lambda_sigma_sq + 2*mu_minus_t))
+	erfc_vals = np.where(is_pos_input, scipy.special.erfcx(np.maximum(erfc_input, 0)), scipy.special.erfc(np.minimum(erfc_input, 0)))
+	# The pulses are normalized, so the scale of each pulse can be removed to avoid underflow
+	log_scale -= log_scale.max(axis=-1, keepdims=True)
+	pulse = exp_lambda*np.exp(log_scale)*erfc_vals
 	return normalize_signal(pulse.squeeze(), axis=-1)
 
 def expgaussian_pulse_conv(time_domain, mu, sigma, exp_lambda, circ_shifted=True):
@@ -248,21 +685,27 @@ def verify_time_domain(time_domain=None, n=1000):
 	tau = time_domain[-1] + dt
 	return (time_domain, n, tau, dt)
 
-def get_random_gaussian_pulse_params(time_domain=None, n=1000, min_max_sigma=None, n_samples=1):
+def get_random_gaussian_pulse_params(time_domain=None, n=1000, min_max_sigma=None, n_samples=1, rng=None):
+	'''
+		rng is the random number generator used to draw the parameters (e.g., a seeded np.random.RandomState). 
+		By default the global numpy random generator is used.
+	'''
+	if(rng is None): rng = np.random
 	(time_domain, n, tau, dt) = verify_time_domain(time_domain, n)
-	mu = tau*np.random.rand(n_samples)
+	mu = tau*rng.rand(n_samples)
 	if(min_max_sigma is None): min_max_sigma = (1, 10)
 	if(min_max_sigma[1] == min_max_sigma[0]): sigma = np.ones_like(mu)*min_max_sigma[0]
-	else: sigma = dt*np.random.randint(low=min_max_sigma[0], high=min_max_sigma[1], size=(n_samples,))
+	else: sigma = dt*rng.randint(low=min_max_sigma[0], high=min_max_sigma[1], size=(n_samples,))
 	return (mu, sigma)
 
-def get_random_expgaussian_pulse_params(time_domain=None, n=1000, min_max_sigma=None, min_max_lambda=None, n_samples=1):
+def get_random_expgaussian_pulse_params(time_domain=None, n=1000, min_max_sigma=None, min_max_lambda=None, n_samples=1, rng=None):
+	if(rng is None): rng = np.random
 	(time_domain, n, tau, dt) = verify_time_domain(time_domain, n)
-	(mu, sigma) = get_random_gaussian_pulse_params(time_domain=time_domain, n=n, min_max_sigma=min_max_sigma, n_samples=n_samples)
+	(mu, sigma) = get_random_gaussian_pulse_params(time_domain=time_domain, n=n, min_max_sigma=min_max_sigma, n_samples=n_samples, rng=rng)
 	if(min_max_lambda is None): min_max_lambda = (1, 50)
 	if(min_max_lambda[1] == min_max_lambda[0]): exp_lambda = np.ones_like(mu)*min_max_lambda[0]
-	else: exp_lambda = dt*np.random.randint(low=min_max_lambda[0], high=min_max_lambda[1], size=(n_samples,))
-	exp_lambda = 1. / (dt*np.random.randint(low=min_max_lambda[0], high=min_max_lambda[1], size=(n_samples,)))
+	else: exp_lambda = dt*rng.randint(low=min_max_lambda[0], high=min_max_lambda[1], size=(n_samples,))
+	exp_lambda = 1. / (dt*rng.randint(low=min_max_lambda[0], high=min_max_lambda[1], size=(n_samples,)))
 	return (mu, sigma, exp_lambda)
 
 def get_fourier_mat(n, freq_idx=None):
@@ -275,17 +718,20 @@ def get_fourier_mat(n, freq_idx=None):
 	# If no frequency indeces are given simply return the full dft matrix
 	if(freq_idx is None):
 		return scipy.linalg.dft(n)
-	# For each frequency idx add them to their corresponding cmpx sinusoid to the matrix
-	n_freqs = len(freq_idx)
+	# Add all frequency idx to their corresponding cmpx sinusoid columns at once
 	domain = np.arange(0, n)*(TWOPI / n)
-	fourier_mat = np.zeros((n, n_freqs), dtype=np.complex64)
-	for i in range(n_freqs):
-		fourier_mat[:, i] = np.cos(freq_idx[i]*domain) - 1j*np.sin(freq_idx[i]*domain)
+	freq_idx = to_nparray(freq_idx)
+	phase = freq_idx[np.newaxis, :]*domain[:, np.newaxis]
+	fourier_mat = np.empty((n, freq_idx.size), dtype=np.complex64)
+	fourier_mat.real = np.cos(phase)
+	fourier_mat.imag = -1*np.sin(phase)
 	return fourier_mat
 
-def broadcast_toeplitz( C_tensor, R_tensor=None):
+def broadcast_toeplitz( C_tensor, R_tensor=None, as_view=False):
 	'''
 		Create a toeplitz matrix using the last dimension of the input tensor
+		If as_view is True, return a read-only strided view of the (..., N, N) toeplitz matrices instead of a copy. 
+		The view only uses the memory of the (..., 2N-1) tensor with the unique values of each matrix.
 	'''
 	if R_tensor is None:
 		R_tensor = C_tensor.conjugate()
@@ -294,91 +740,178 @@ def broadcast_toeplitz( C_tensor, R_tensor=None):
 	# Form a 1D array of values to be used in the matrix, containing a reversed
 	# copy of r[1:], followed by c.
 	vals_tensor = np.concatenate((R_tensor[...,-1:0:-1], C_tensor), axis=-1)
+	if(as_view):
+		# Element (i, j) of the toeplitz matrix is vals[n_cols - 1 + i - j]. So we start at vals[n_cols-1] and move one element
+		# forward per row and one element backward per column.
+		(n_rows, n_cols) = (C_tensor.shape[-1], R_tensor.shape[-1])
+		elem_stride = vals_tensor.strides[-1]
+		return np.lib.stride_tricks.as_strided(vals_tensor[..., n_cols-1:], shape=vals_tensor.shape[0:-1] + (n_rows, n_cols), 
+			strides=vals_tensor.strides[0:-1] + (elem_stride, -1*elem_stride), writeable=False)
 	a, b = np.ogrid[0:C_tensor.shape[-1], R_tensor.shape[-1] - 1:-1:-1]
 	indx = a + b
 	# `indx` is a 2D array of indices into the 1D array `vals`, arranged so
 	# that `vals[indx]` is the Toeplitz matrix.
 	return vals_tensor[..., indx]
 
-def max_gaussian_center_of_mass_mle(transient, tbins=None, sigma_tbins = 1):
+class BatchedToeplitzOperator:
+	'''
+		Implicit stack of toeplitz matrices with the same layout as broadcast_toeplitz(C_tensor, R_tensor), i.e., a (..., N, M)
+		tensor whose first columns are C_tensor (..., N) and first rows are R_tensor (..., M).
+		Each matrix is embedded in a circulant matrix of size >= N+M-1, whose spectrum is computed once, so products 
+		are computed with FFTs without forming the matrices.
+	'''
+	def __init__(self, C_tensor, R_tensor=None):
+		C_tensor = to_nparray(C_tensor)
+		if(R_tensor is None): R_tensor = C_tensor.conjugate()
+		else: R_tensor = to_nparray(R_tensor)
+		self.C_tensor = C_tensor
+		self.R_tensor = R_tensor
+		(n_rows, n_cols) = (C_tensor.shape[-1], R_tensor.shape[-1])
+		self.shape = np.broadcast(C_tensor[..., 0], R_tensor[..., 0]).shape + (n_rows, n_cols)
+		self.is_real = fft_ops.is_real(C_tensor) and fft_ops.is_real(R_tensor)
+		# First column of the circulant matrix: [c_0, ..., c_{N-1}, 0, ..., 0, r_{M-1}, ..., r_1]
+		self.n_circ = fft_ops.next_fast_len(n_rows + n_cols - 1, real=self.is_real)
+		circ_col = np.zeros(self.shape[0:-2] + (self.n_circ,), dtype=np.result_type(C_tensor.dtype, R_tensor.dtype))
+		circ_col[..., 0:n_rows] = C_tensor
+		circ_col[..., self.n_circ-n_cols+1:] = R_tensor[..., -1:0:-1]
+		if(self.is_real): self.f_circ_col = fft_ops.rfft(circ_col, axis=-1)
+		else: self.f_circ_col = fft_ops.fft(circ_col, axis=-1)
+
+	def apply(self, x, axis, n_out, conj):
+		if(self.is_real and (not fft_ops.is_real(x))):
+			# Real toeplitz matrices can be applied to the real and imaginary parts independently
+			return self.apply(x.real, axis, n_out, conj) + 1j*self.apply(x.imag, axis, n_out, conj)
+		f_circ_col = self.f_circ_col.conj() if conj else self.f_circ_col
+		if(axis == -2): f_circ_col = f_circ_col[..., np.newaxis]
+		if(self.is_real): 
+			y = fft_ops.irfft(fft_ops.rfft(x, n=self.n_circ, axis=axis) * f_circ_col, n=self.n_circ, axis=axis)
+		else: 
+			y = fft_ops.ifft(fft_ops.fft(x, n=self.n_circ, axis=axis) * f_circ_col, axis=axis)
+		if(axis == -2): return y[..., 0:n_out, :]
+		return y[..., 0:n_out]
+
+	def matvec(self, x):
+		'''
+			Compute T @ x for a (..., M) tensor x. Returns a (..., N) tensor.
+		'''
+		assert(x.shape[-1] == self.shape[-1]), "x needs to have {} elements along its last dimension".format(self.shape[-1])
+		return self.apply(x, axis=-1, n_out=self.shape[-2], conj=False)
+
+	def matmat(self, X):
+		'''
+			Compute T @ X for a (..., M, K) tensor X. Returns a (..., N, K) tensor.
+		'''
+		assert(X.shape[-2] == self.shape[-1]), "X needs to have {} rows".format(self.shape[-1])
+		return self.apply(X, axis=-2, n_out=self.shape[-2], conj=False)
+
+	def rmatvec(self, y):
+		'''
+			Compute the adjoint product conj(T).T @ y for a (..., N) tensor y. Returns a (..., M) tensor.
+		'''
+		assert(y.shape[-1] == self.shape[-2]), "y needs to have {} elements along its last dimension".format(self.shape[-2])
+		return self.apply(y, axis=-1, n_out=self.shape[-1], conj=True)
+
+	def to_dense(self, as_view=False):
+		return broadcast_toeplitz(self.C_tensor, self.R_tensor, as_view=as_view)
+
+def max_gaussian_center_of_mass_mle(transient, tbins=None, sigma_tbins = 1, chunk_size=4096, dtype=None):
 	'''
 		In this function we find the maximum of the transient and then calculate the center of mass in the neighborhood of the maximum.
 		NOTE: At low SNR, low depths will have lower depth error on average than far away depths. 
 		This is because, at low SNR (low SBR/low photon counts), it becomes very likely that there are multiple maximums, some maximums are 
 		due to the signal and others due to ambient photons. And since numpy's argmax function always takes the 1st maximum it finds, then at low depths
 		the maximum due to the signal are preferred, but at large depths the maximums due to ambient (that come before) are chosen.
+		The neighborhood of the maximum is gathered circularly for all pixels at once, and pixels are processed in chunks of chunk_size
+		elements to bound the memory used by the temporary arrays. 
+		If dtype is given (e.g., np.float32), the center of mass is computed with that precision. Otherwise float64 is used.
+		torch tensors are processed with torch ops (see max_gaussian_center_of_mass_mle_torch).
 	'''
+	if(fft_ops.is_torch_tensor(transient)): return max_gaussian_center_of_mass_mle_torch(transient, tbins=tbins, sigma_tbins=sigma_tbins, chunk_size=chunk_size)
 	# Reshape transient to simplify vectorized operations
 	(transient, transient_original_shape) = vectorize_tensor(transient)
 	n_elems = transient.shape[0]
 	n_tbins = transient.shape[-1]
-	# Remove ambient (assume that median is a good estimate of ambient component)
-	ambient_estimate = np.median(transient, axis=-1, keepdims=True)
-	transient_noamb = transient - ambient_estimate
-	# Make sure there are not negative values
-	transient_noamb[transient_noamb < 0] = 0
-	# Find start and end tbin of gaussian pulse
-	argmax_tbin = np.argmax(transient, axis=-1)
-	# start_tbin = np.clip(argmax_tbin - int(np.ceil(2*sigma_tbins)), 0, n_tbins)
-	# end_tbin = np.clip(argmax_tbin + int(np.ceil(2*sigma_tbins)) + 1, 0, n_tbins)
-	start_tbin = argmax_tbin - int(np.ceil(2*sigma_tbins))
-	end_tbin = argmax_tbin + int(np.ceil(2*sigma_tbins)) + 1
+	if(dtype is None): dtype = np.float64
 	# Create a dummy tbin array if tbins are not given
 	if(tbins is None): tbins = np.arange(0, n_tbins) 
 	assert(transient.shape[-1] == len(tbins)), 'transient and tbins should have the same number of elements'
+	tbins = to_nparray(tbins).astype(dtype)
+	# Period of the circularly extended tbins domain (same as in get_extended_domain)
+	tbins_period = tbins.max() + (tbins[1] - tbins[0])
+	# Offsets of the tbins in the neighborhood of the maximum
+	half_window_len = int(np.ceil(2*sigma_tbins))
+	window_offsets = np.arange(-half_window_len, half_window_len + 1)
 	# For each 1D transient calculate the center of mass max likelihood estimate
-	center_of_mass_mle = np.zeros((n_elems,))
-	extended_tbins = get_extended_domain(tbins, axis=-1)
-	extended_transient_noamb = extend_tensor_circularly(transient_noamb, axis=-1)
-	# for i in range(n_elems):
-	# 	tbin_vec = tbins[start_tbin[i]:end_tbin[i]]
-	# 	transient_vec = transient_noamb[i, start_tbin[i]:end_tbin[i]]
-	# 	center_of_mass_mle[i] = np.dot(transient_vec, tbin_vec) / (np.sum(transient_vec) + EPSILON)
-	for i in range(n_elems):
-		start_idx = start_tbin[i]+n_tbins
-		end_idx = end_tbin[i]+n_tbins
-		tbin_vec = extended_tbins[start_idx:end_idx]
-		transient_vec = extended_transient_noamb[i, start_idx:end_idx]
-		center_of_mass_mle[i] = np.dot(transient_vec, tbin_vec) / (np.sum(transient_vec) + EPSILON)
+	center_of_mass_mle = np.zeros((n_elems,), dtype=dtype)
+	for chunk in get_chunk_slices(n_elems, chunk_size):
+		curr_transient = transient[chunk]
+		# Find start and end tbin of gaussian pulse
+		argmax_tbin = np.argmax(curr_transient, axis=-1)
+		# Circularly wrap the window indeces, and keep track of how many times they wrapped around to shift the tbins
+		(n_wraps, window_tbin) = np.divmod(argmax_tbin[:, np.newaxis] + window_offsets[np.newaxis, :], n_tbins)
+		# Remove ambient (assume that median is a good estimate of ambient component) and make sure there are not negative values
+		ambient_estimate = np.median(curr_transient, axis=-1, keepdims=True).astype(dtype)
+		transient_window = np.take_along_axis(curr_transient, window_tbin, axis=-1).astype(dtype)
+		transient_window -= ambient_estimate
+		np.maximum(transient_window, 0, out=transient_window)
+		tbins_window = tbins[window_tbin]
+		tbins_window += n_wraps*tbins_period
+		center_of_mass_mle[chunk] = np.sum(transient_window*tbins_window, axis=-1) / (np.sum(transient_window, axis=-1) + EPSILON)
 	# Reshape to original shapes, useful when dealing with images
-	transient = unvectorize_tensor(transient, transient_original_shape)
 	center_of_mass_mle = center_of_mass_mle.reshape(transient_original_shape[0:-1])
 	return center_of_mass_mle
 
+def max_gaussian_center_of_mass_mle_torch(transient, tbins=None, sigma_tbins=1, chunk_size=4096):
+	'''
+		torch version of max_gaussian_center_of_mass_mle. The output has the same precision and device as the transient
+		(float64 for integer transients, e.g., photon counts), and the center of mass is differentiable w.r.t. the transient 
+		values in the neighborhood of the maximum.
+	'''
+	n_tbins = transient.shape[-1]
+	vec_transient = transient.reshape((-1, n_tbins))
+	if(tbins is None): tbins = np.arange(0, n_tbins)
+	assert(n_tbins == len(tbins)), 'transient and tbins should have the same number of elements'
+	tbins = fft_ops.as_array_like(to_nparray(tbins).astype(np.float64), transient)
+	tbins_period = tbins.max() + (tbins[1] - tbins[0])
+	half_window_len = int(np.ceil(2*sigma_tbins))
+	window_offsets = fft_ops.as_array_like(np.arange(-half_window_len, half_window_len + 1), vec_transient).long()
+	center_of_mass_mle = vec_transient.new_zeros((vec_transient.shape[0],), dtype=tbins.dtype)
+	for chunk in get_chunk_slices(vec_transient.shape[0], chunk_size):
+		# Integer transients are cast to the precision of tbins (float64), since quantile needs floating point inputs
+		curr_transient = vec_transient[chunk].to(tbins.dtype)
+		window_idx = curr_transient.argmax(dim=-1, keepdim=True) + window_offsets
+		(n_wraps, window_tbin) = (window_idx.div(n_tbins, rounding_mode='floor'), window_idx.remainder(n_tbins))
+		# Same as np.median (torch.median returns the lower of the two middle values)
+		ambient_estimate = curr_transient.quantile(0.5, dim=-1, keepdim=True)
+		transient_window = (curr_transient.gather(-1, window_tbin) - ambient_estimate).clamp(min=0)
+		tbins_window = tbins[window_tbin] + n_wraps*tbins_period
+		center_of_mass_mle[chunk] = (transient_window*tbins_window).sum(dim=-1) / (transient_window.sum(dim=-1) + EPSILON)
+	return center_of_mass_mle.reshape(transient.shape[0:-1])
+
 def haar_matrix(n, n_levels):
 	assert(n_levels >= 0), 'n_levels should be larger than '
 	n_codes = np.power(2, n_levels)
 	assert((n % n_codes) == 0), "only implemented multiples of 2^n_levels"
 	H = np.zeros((n, n_codes))
-	for i in range(n_levels+1):
-		curr_total_codes = np.power(2, i)
-		n_codes_at_curr_lvl = int(np.ceil(curr_total_codes / 2))
-		half_duty_len = int(n / curr_total_codes)
-		curr_start_code_idx = int(curr_total_codes - n_codes_at_curr_lvl)
-		for j in range(n_codes_at_curr_lvl):
-			start_idx = (j*half_duty_len*2)
-			mid_point_idx = start_idx + half_duty_len
-			end_idx = start_idx + 2*half_duty_len
-			H[start_idx:mid_point_idx, curr_start_code_idx+j] = 1.0
-			H[mid_point_idx:end_idx, curr_start_code_idx+j] = -1.0
+	# The first code is constant
+	H[:, 0] = 1.0
+	for i in range(1, n_levels+1):
+		# At level i there are 2^(i-1) codes. Code j is +1 over the interval [2*j*half_duty_len, (2*j+1)*half_duty_len), 
+		# -1 over the next half_duty_len elements, and 0 everywhere else
+		n_codes_at_curr_lvl = np.power(2, i-1)
+		half_duty_len = int(n / np.power(2, i))
+		code_block = np.concatenate((np.ones((half_duty_len,)), -1*np.ones((half_duty_len,))))
+		H[:, n_codes_at_curr_lvl:2*n_codes_at_curr_lvl] = np.kron(np.eye(n_codes_at_curr_lvl), code_block[:, np.newaxis])
 	return H
 
 def generate_gray_code(n_bits):
 	assert(n_bits >= 1), "invalid n_bits"
 	n_binary_codes = np.power(2, n_bits)
-	n_binary_codes_over2 = int(n_binary_codes / 2)
-	codes = np.zeros((n_binary_codes, n_bits))
-	codes[1, -1] = 1 
-	for i in range(n_bits-1):
-		curr_n_bits = i + 2 
-		start_code_idx = 0
-		end_code_idx1 = np.power(2, i+1)
-		end_code_idx2 = 2*end_code_idx1
-		# Reflect 
-		reflected_codes = np.flipud(codes[start_code_idx:end_code_idx1, :])
-		codes[end_code_idx1:end_code_idx2, :] = reflected_codes
-		# Prefix with ones
-		codes[end_code_idx1:end_code_idx2, -curr_n_bits] = 1
+	# The gray code of i is i XOR (i >> 1). The last column holds the least significant bit
+	gray_code_ints = np.arange(0, n_binary_codes)
+	gray_code_ints = np.bitwise_xor(gray_code_ints, np.right_shift(gray_code_ints, 1))
+	bit_shifts = np.arange(n_bits-1, -1, -1)
+	codes = np.bitwise_and(np.right_shift(gray_code_ints[:, np.newaxis], bit_shifts[np.newaxis, :]), 1).astype(np.float64)
 	return codes
 
 def get_orthogonal_binary_code(c):
@@ -389,7 +922,7 @@ def get_orthogonal_binary_code(c):
 	n = c.shape[0]
 	shift_f0_90deg = n // 4
 	# Find the repetition frequency of the code
-	f_c = np.fft.rfft(c, axis=0)
+	f_c = fft_ops.rfft(c, axis=0)
 	fk = np.abs(f_c).argmax()
 	# Shift the code
 	shift = int(np.round(shift_f0_90deg / fk))
@@ -398,21 +931,27 @@ def get_orthogonal_binary_code(c):
 	return c_orth
 
 def get_dominant_freqs(Cmat, axis=0):
-	f_Cmat = np.fft.rfft(Cmat, axis=axis)
+	'''
+		Frequency with the largest magnitude of each code along axis. Works for stacks of code matrices (e.g., ... x n x K)
+	'''
+	f_Cmat = fft_ops.rfft(Cmat, axis=axis)
 	return np.argmax(np.abs(f_Cmat), axis=axis)
 
 def get_low_confidence_freqs(h_irf, valid_freq_thresh=0.2):
 	'''
 		Look at frequency response of h_irf vector, and find frequencies with low amplitude
+		h_irf can also be a (... x nt) tensor (e.g., per-pixel IRFs). In that case the low_confidence_freqs mask is (... x nt//2+1),
+		and low_confidence_freq_idx is the tuple of indeces returned by np.nonzero(low_confidence_freqs).
 	'''
 	nt = h_irf.shape[-1]
 	abs_max_freq_idx = nt // 2
 	all_freq_idx = np.arange(0, abs_max_freq_idx+1)
 	# Calculate FFT of IRF and get frequencies with magnitude above threshold
-	f_h_irf = np.fft.rfft(h_irf)
+	f_h_irf = fft_ops.rfft(h_irf, axis=-1)
 	amp_f_h_irf = np.abs(f_h_irf)
 	# Frequencies should have a magnitude higher than the following computed w.r.t the 1st harmonic
-	threshold = f_h_irf[1]*valid_freq_thresh
+	threshold = amp_f_h_irf[..., 1:2]*valid_freq_thresh
 	low_confidence_freqs = amp_f_h_irf < threshold
+	if(h_irf.ndim > 1): return (np.nonzero(low_confidence_freqs), low_confidence_freqs)
 	low_confidence_freq_idx = all_freq_idx[low_confidence_freqs]
 	return (low_confidence_freq_idx, low_confidence_freqs)
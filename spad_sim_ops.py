@@ -0,0 +1,102 @@
+'''
+	Simulate photon-count histograms measured by a single-photon detector (e.g., a SPAD) from noiseless transients,
+	and estimate the photon flux back from the histograms with the Coates pile-up correction.
+	All functions operate on the last dimension of (... x n_tbins) tensors, and process the pixels in chunks of chunk_size
+	to bound the memory used by temporary arrays.
+	Example:
+		flux = get_photon_flux(gaussian_pulse(tbins, mu, width), mean_signal_photons=0.5, mean_ambient_photons=0.5)
+		counts = simulate_photon_counts(flux, n_laser_cycles=1000, mode='synchronous')
+		flux_est = coates_correction(counts, n_laser_cycles=1000)
+'''
+## Standard Library Imports
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from .np_utils import vectorize_tensor, unvectorize_tensor, get_chunk_slices
+from .signalproc_ops import normalize_signal
+from .shared_constants import *
+
+# Photon count models
+#	* 'poisson': Photon counts are independent poisson random variables (no pile-up)
+#	* 'multinomial': A fixed number of photons (by default the expected number of photons over all laser cycles) is 
+#	distributed across the bins following the flux (no pile-up)
+#	* 'synchronous': Synchronous mode detector that records at most the first photon of each laser cycle (pile-up)
+PHOTON_COUNT_MODES = ['poisson', 'multinomial', 'synchronous']
+
+def get_photon_flux(transient, mean_signal_photons=None, mean_ambient_photons=0., axis=-1):
+	'''
+		Scale a transient to get the mean number of photons that arrive at each time bin per laser cycle.
+		If mean_signal_photons is given, the transient is normalized so that it contains mean_signal_photons photons per cycle.
+		Otherwise it is assumed to already be in units of photons per cycle.
+		mean_ambient_photons are spread uniformly across all time bins.
+		Both can be scalars or tensors that broadcast with the transient (e.g., per-pixel signal levels with shape (..., 1))
+	'''
+	n_tbins = transient.shape[axis]
+	if(mean_signal_photons is None): flux = transient.astype(np.float64)
+	else: flux = normalize_signal(transient, axis=axis)*mean_signal_photons
+	return flux + (mean_ambient_photons / n_tbins)
+
+def simulate_photon_counts(flux, n_laser_cycles, mode='synchronous', rng=None, chunk_size=4096, n_photons=None):
+	'''
+		Simulate the photon-count histograms measured over n_laser_cycles, for a (... x n_tbins) photon flux tensor
+		(mean photons per bin per laser cycle, see get_photon_flux). See PHOTON_COUNT_MODES for the available models.
+		rng is the random number generator used (e.g., a seeded np.random.RandomState). By default the global numpy one is used.
+		The multinomial and synchronous modes are drawn as a sequence of binomials along the time bins (vectorized across pixels),
+		which is equivalent to drawing one multinomial per pixel.
+		The number of photons of each multinomial histogram is n_photons (a scalar or a tensor with one element per pixel) if 
+		given, and otherwise n_laser_cycles*flux.sum(axis=-1) rounded to the nearest integer (so it scales with the signal 
+		and ambient levels of each pixel).
+	'''
+	assert(mode in PHOTON_COUNT_MODES), "mode should be one of {}".format(PHOTON_COUNT_MODES)
+	assert(np.all(flux >= 0)), "flux should be non-negative"
+	if(rng is None): rng = np.random
+	(flux, flux_original_shape) = vectorize_tensor(flux)
+	(n_elems, n_tbins) = flux.shape
+	counts = np.zeros((n_elems, n_tbins), dtype=np.int64)
+	if(mode == 'multinomial'):
+		if(n_photons is None): n_photons = np.round(n_laser_cycles*flux.sum(axis=-1)).astype(np.int64)
+		else: n_photons = np.broadcast_to(n_photons, flux_original_shape[0:-1]).reshape((n_elems,)).astype(np.int64)
+	for chunk in get_chunk_slices(n_elems, chunk_size):
+		curr_flux = flux[chunk]
+		if(mode == 'poisson'):
+			counts[chunk] = rng.poisson(n_laser_cycles*curr_flux)
+			continue
+		if(mode == 'synchronous'):
+			# Probability of detecting a photon in a bin given that no photon was detected in the previous bins
+			detection_probs = -1*np.expm1(-1*curr_flux)
+		else:
+			# Probability of a photon falling in a bin given that it did not fall in the previous bins
+			probs = normalize_signal(curr_flux, axis=-1)
+			remaining_probs = 1 - (np.cumsum(probs, axis=-1) - probs)
+			detection_probs = np.clip(probs / np.maximum(remaining_probs, EPSILON), 0., 1.)
+			# All the remaining photons fall in the last bin
+			detection_probs[:, -1] = 1.
+		# Photons (multinomial) or laser cycles (synchronous) that were not detected in the previous bins
+		if(mode == 'multinomial'): remaining_cycles = n_photons[chunk].copy()
+		else: remaining_cycles = np.full((detection_probs.shape[0],), n_laser_cycles, dtype=np.int64)
+		for i in range(n_tbins):
+			counts[chunk, i] = rng.binomial(remaining_cycles, detection_probs[:, i])
+			remaining_cycles -= counts[chunk, i]
+	return unvectorize_tensor(counts, flux_original_shape)
+
+def coates_correction(counts, n_laser_cycles, chunk_size=4096):
+	'''
+		Coates estimator of the photon flux (mean photons per bin per laser cycle) from the (... x n_tbins) photon-count
+		histograms measured with a synchronous mode detector over n_laser_cycles, which undoes the pile-up distortion.
+		The flux at each bin is -log(1 - counts / (cycles where no photon was detected in the previous bins)).
+	'''
+	(counts, counts_original_shape) = vectorize_tensor(counts)
+	n_elems = counts.shape[0]
+	flux = np.zeros(counts.shape, dtype=np.float64)
+	for chunk in get_chunk_slices(n_elems, chunk_size):
+		curr_counts = counts[chunk].astype(np.float64)
+		# Number of cycles that reached each bin without a detection
+		remaining_cycles = n_laser_cycles - (np.cumsum(curr_counts, axis=-1) - curr_counts)
+		detection_probs = curr_counts / np.maximum(remaining_cycles, 1.)
+		# If all remaining cycles detected a photon the flux can't be estimated, so we clip it
+		flux[chunk] = -1*np.log1p(-1*np.minimum(detection_probs, 1. - EPSILON))
+	return unvectorize_tensor(flux, counts_original_shape)
@@ -0,0 +1,99 @@
+## Standard Library Imports
+import sys
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+import scipy.linalg
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from research_utils.coding_ops import *
+from research_utils.signalproc_ops import get_fourier_mat, haar_matrix, gaussian_pulse, get_low_confidence_freqs, get_dominant_freqs
+
+
+def test_fourier_projection(n=64, n_elems=10):
+	x = np.random.rand(n_elems, n)
+	for freq_idx in [[1, 2], [0, 3, 5, 32, 40, 63]]:
+		fourier_mat = get_fourier_mat(n, freq_idx)
+		for max_matmul_freqs in [0, n]:
+			fourier_proj = FourierProjection(n, freq_idx, max_matmul_freqs=max_matmul_freqs)
+			assert(np.allclose(fourier_proj.to_dense(), fourier_mat)), "dense fourier matrix does not match"
+			assert(np.allclose(fourier_proj.encode(x), x @ fourier_mat, atol=1e-4)), "fourier projection does not match matmul"
+			x_cmpx = x + 1j*np.random.rand(n_elems, n)
+			assert(np.allclose(fourier_proj.encode(x_cmpx), x_cmpx @ fourier_mat, atol=1e-4)), "fourier projection does not match matmul for complex inputs"
+			coeffs = np.random.rand(n_elems, len(freq_idx)) + 1j*np.random.rand(n_elems, len(freq_idx))
+			assert(np.allclose(fourier_proj.adjoint(coeffs), coeffs @ fourier_mat.conj().transpose(), atol=1e-4)), "fourier projection adjoint does not match matmul"
+	# Decoding the coefficients of a band-limited signal recovers the signal
+	freq_idx = [0, 1, 3, 7]
+	fourier_proj = FourierProjection(n, freq_idx)
+	bandlimited_x = fourier_proj.decode(fourier_proj.encode(x))
+	assert(np.allclose(fourier_proj.decode(fourier_proj.encode(bandlimited_x)), bandlimited_x)), "decode did not recover band-limited signal"
+	assert(np.allclose(fourier_proj.encode(bandlimited_x), fourier_proj.encode(x))), "decoded signal coefficients do not match"
+	print("PASSED test_fourier_projection")
+
+def test_fast_coding_operators(n=64, n_elems=10):
+	x = np.random.rand(n_elems, n)
+	coding_ops = [HaarOperator(n, 0), HaarOperator(n, 3), HaarOperator(n, 6), WalshHadamardOperator(n), WalshHadamardOperator(n, [0, 3, 7, 40]),
+		GrayCodeOperator(n, 1), GrayCodeOperator(n, 4), GrayCodeOperator(n, 6, binary=False)]
+	for coding_op in coding_ops:
+		coding_mat = coding_op.to_dense()
+		coded_x = np.random.rand(n_elems, coding_mat.shape[-1])
+		assert(np.allclose(coding_op.encode(x), x @ coding_mat)), "{} encode does not match matmul".format(type(coding_op).__name__)
+		assert(np.allclose(coding_op.adjoint(coded_x), coded_x @ coding_mat.transpose())), "{} adjoint does not match matmul".format(type(coding_op).__name__)
+	# Complete orthogonal codes can be inverted
+	for coding_op in [HaarOperator(n, 6), WalshHadamardOperator(n)]:
+		assert(np.allclose(coding_op.inverse(coding_op.encode(x)), x)), "{} inverse did not recover signal".format(type(coding_op).__name__)
+	# Incomplete codes are inverted with the pseudo-inverse
+	for coding_op in [GrayCodeOperator(n, 1), GrayCodeOperator(n, 4), GrayCodeOperator(n, 6), GrayCodeOperator(n, 6, binary=False)]:
+		coded_x = coding_op.encode(x)
+		assert(np.allclose(coding_op.inverse(coded_x), coded_x @ np.linalg.pinv(coding_op.to_dense()))), "{} inverse does not match pseudo-inverse".format(type(coding_op).__name__)
+	assert(np.allclose(fwht(np.eye(n)), scipy.linalg.hadamard(n))), "fwht does not match hadamard matrix"
+	print("PASSED test_fast_coding_operators")
+
+def test_coded_histogram_engine(n=256, n_elems=20):
+	tbins = np.arange(0, n)
+	h_irf = gaussian_pulse(tbins, 0, 3)
+	gt_depths = np.random.randint(0, n, size=(4, n_elems // 4))
+	transients = gaussian_pulse(tbins, gt_depths.flatten(), 3).reshape(gt_depths.shape + (n,))
+	fourier_mat = get_fourier_mat(n, [1, 2, 3])
+	for coding_mat in [haar_matrix(n, 4), np.concatenate((fourier_mat.real, fourier_mat.imag), axis=-1)]:
+		engine = CodedHistogramEngine(coding_mat, h_irf=h_irf, chunk_size=7)
+		coded_vals = engine.encode(transients)
+		assert(np.allclose(coded_vals, transients @ coding_mat, atol=1e-4)), "encode does not match matmul"
+		(depth_bins, zncc_peak) = engine.decode(coded_vals)
+		assert(np.all(depth_bins == gt_depths)), "decoded depths do not match"
+		assert(np.allclose(zncc_peak, 1., atol=1e-3)), "zncc of noiseless transients should be 1"
+		assert(np.allclose(engine.zncc(coded_vals).max(axis=-1), zncc_peak)), "zncc peak does not match"
+	# Sub-bin depths (the zncc of the fourier codes is smooth around the peak)
+	subbin_depths = 1 + np.random.rand(n_elems)*(n - 2)
+	(subbin_depth_bins, _) = engine.decode(engine.encode(gaussian_pulse(tbins, subbin_depths, 3)), method='parabolic')
+	assert(np.allclose(subbin_depth_bins, subbin_depths, atol=0.15)), "sub-bin decoded depths do not match"
+	print("PASSED test_coded_histogram_engine")
+
+def test_analyze_coding_scheme(n=64, n_pixels=5):
+	fourier_mat = get_fourier_mat(n, [1, 2, 20])
+	# get_fourier_mat is single precision
+	fourier_codes = np.concatenate((fourier_mat.real, fourier_mat.imag), axis=-1).astype(np.float64)
+	Cmat = np.stack((fourier_codes, haar_matrix(n, 3)[:, 0:6] + 0.5), axis=0)
+	tbins = np.arange(0, n)
+	h_irf = gaussian_pulse(tbins, np.zeros((n_pixels,)), np.random.rand(n_pixels)*2 + 1)
+	analysis = analyze_coding_scheme(Cmat[:, np.newaxis], h_irf=h_irf)
+	assert(np.array_equal(analysis['is_orthogonal'][:, 0], [True, False])), "code orthogonality does not match"
+	assert(np.allclose(analysis['gram'][1, 0], Cmat[1].transpose() @ Cmat[1])), "gram matrix does not match"
+	assert(np.array_equal(analysis['dominant_freqs'][0, 0], [1, 2, 20, 1, 2, 20])), "dominant frequencies do not match"
+	assert(analysis['low_confidence_codes'].shape == (2, n_pixels, 6)), "incorrect low confidence codes shape"
+	for i in range(n_pixels):
+		(low_confidence_freq_idx, low_confidence_freqs) = get_low_confidence_freqs(h_irf[i])
+		assert(np.array_equal(analysis['low_confidence_freqs'][i], low_confidence_freqs)), "batched low confidence freqs do not match"
+		for j in range(2):
+			expected_low_confidence_codes = np.isin(get_dominant_freqs(Cmat[j], axis=0), low_confidence_freq_idx)
+			assert(np.array_equal(analysis['low_confidence_codes'][j, i], expected_low_confidence_codes)), "low confidence codes do not match"
+	print("PASSED test_analyze_coding_scheme")
+
+if __name__=='__main__':
+	test_fourier_projection()
+	test_fast_coding_operators()
+	test_coded_histogram_engine()
+	test_analyze_coding_scheme()
@@ -0,0 +1,68 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from research_utils.io_ops import *
+
+
+def test_get_multi_folder_paired_fnames(n_files=20):
+	with tempfile.TemporaryDirectory() as tmp_dirpath:
+		dirpath_list = [os.path.join(tmp_dirpath, 'folder{}'.format(i)) for i in range(3)]
+		file_ext_per_dirpath = ['npy', 'npy', 'npz']
+		for (dirpath, file_ext) in zip(dirpath_list, file_ext_per_dirpath):
+			os.makedirs(os.path.join(dirpath, 'subdir.npy'))
+			for i in range(n_files): open(os.path.join(dirpath, 'f{}.{}'.format(i, file_ext)), 'w').close()
+		open(os.path.join(dirpath_list[2], 'xkcd.txt'), 'w').close()
+		open(os.path.join(dirpath_list[2], '.hidden.npz'), 'w').close()
+		expected_fnames = sorted(['f{}'.format(i) for i in range(n_files)])
+		manifest_fpath = os.path.join(tmp_dirpath, 'manifest.json')
+		for curr_manifest_fpath in [None, manifest_fpath, manifest_fpath]:
+			(paired_fnames, ext_per_dirpath) = get_multi_folder_paired_fnames(dirpath_list, ['npy', 'npz'], manifest_fpath=curr_manifest_fpath)
+			assert((paired_fnames == expected_fnames) and (ext_per_dirpath == file_ext_per_dirpath)), "paired filenames do not match"
+		assert(os.path.exists(manifest_fpath)), "manifest was not written"
+		# Adding a file to one folder changes its mtime, so it is rescanned and the filenames no longer match
+		open(os.path.join(dirpath_list[1], 'extra.npy'), 'w').close()
+		try:
+			get_multi_folder_paired_fnames(dirpath_list, ['npy', 'npz'], manifest_fpath=manifest_fpath)
+			assert(False), "unpaired filenames were not detected"
+		except AssertionError as e:
+			assert("same number of files" in str(e)), "unpaired filenames were not detected"
+		os.remove(os.path.join(dirpath_list[1], 'extra.npy'))
+		(paired_fnames, _) = get_multi_folder_paired_fnames(dirpath_list, ['npy', 'npz'], manifest_fpath=manifest_fpath)
+		assert(paired_fnames == expected_fnames), "paired filenames do not match after refresh"
+	print("PASSED test_get_multi_folder_paired_fnames")
+
+def test_pack_multi_folder_paired_data(n_files=10):
+	with tempfile.TemporaryDirectory() as tmp_dirpath:
+		dirpath_list = [os.path.join(tmp_dirpath, 'folder{}'.format(i)) for i in range(3)]
+		for dirpath in dirpath_list: os.makedirs(dirpath)
+		for i in range(n_files):
+			np.save(os.path.join(dirpath_list[0], 'f{}.npy'.format(i)), np.random.rand(8, 6, 20).astype(np.float32))
+			np.save(os.path.join(dirpath_list[1], 'f{}.npy'.format(i)), np.asfortranarray(np.random.randint(0, 100, size=(i + 1, 3))))
+			np.savez(os.path.join(dirpath_list[2], 'f{}.npz'.format(i)), depth=np.random.rand(8, 6), is_valid=np.random.rand(8, 6) > 0.5, n_photons=np.array(i, dtype=np.int16))
+		packed_dirpath = os.path.join(tmp_dirpath, 'packed')
+		index = pack_multi_folder_paired_data(dirpath_list, packed_dirpath, max_shard_nbytes=8000)
+		assert(len(index['shards']) > 1), "samples were not split into multiple shards"
+		assert(load_packed_index(packed_dirpath) == index), "index was not written"
+		shard_buffers = [np.memmap(get_packed_shard_fpath(packed_dirpath, i), dtype=np.uint8, mode='r') for i in range(len(index['shards']))]
+		for (i, sample_info) in enumerate(index['samples']):
+			assert(sample_info['base_fname'] == 'f{}'.format(sorted(range(n_files), key=str)[i])), "samples are not sorted"
+			packed_sample = get_packed_sample(shard_buffers[sample_info['shard_idx']], sample_info)
+			for (dirpath, file_ext, packed_data) in zip(dirpath_list, index['file_ext_per_dirpath'], packed_sample):
+				data = np.load(os.path.join(dirpath, sample_info['base_fname'] + '.' + file_ext))
+				arr_pairs = [(data, packed_data)] if (file_ext == 'npy') else [(data[key], packed_data[key]) for key in data.files]
+				for (arr, packed_arr) in arr_pairs:
+					assert((arr.dtype == packed_arr.dtype) and np.array_equal(arr, packed_arr)), "packed array does not match"
+	print("PASSED test_pack_multi_folder_paired_data")
+
+if __name__=='__main__':
+	test_get_multi_folder_paired_fnames()
+	test_pack_multi_folder_paired_data()
@@ -0,0 +1,71 @@
+## Standard Library Imports
+import sys
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from research_utils.np_utils import *
+
+
+def calc_mean_percentile_errors_sort(errors, percentiles):
+	'''
+		Reference implementation that fully sorts the errors and builds the mask with one pass per percentile
+	'''
+	errors = errors.flatten()
+	sorted_errors = np.sort(errors)
+	percentile_indeces = np.round(errors.size*np.array(percentiles)).astype(np.int64)
+	percentile_mean_errors = np.zeros((len(percentiles),))
+	percentile_mask = np.zeros_like(errors)-1.
+	for i in range(len(percentiles)):
+		start_idx = 0 if (i == 0) else percentile_indeces[i-1]
+		end_idx = percentile_indeces[i]
+		percentile_mean_errors[i] = np.mean(sorted_errors[start_idx:end_idx])
+		percentile_mask[np.logical_and(errors >= sorted_errors[start_idx], errors <= sorted_errors[end_idx-1])] = i
+	return (percentile_mean_errors, percentile_mask)
+
+def test_calc_mean_percentile_errors(n_rows=30, n_cols=40):
+	for errors in [np.random.rand(n_rows, n_cols), np.random.randint(0, 5, size=(n_rows, n_cols)).astype(np.float64), np.random.randint(0, 5, size=(n_rows, n_cols))]:
+		for percentiles in [[0.5, 0.75, 0.95, 0.99], [0.5, 0.75, 1.0], [0.1, 0.3, 1.0]]:
+			(expected_mean_errors, expected_mask) = calc_mean_percentile_errors_sort(errors, percentiles)
+			(percentile_mean_errors, percentile_mask) = calc_mean_percentile_errors(errors, percentiles=percentiles)
+			assert(np.allclose(percentile_mean_errors, expected_mean_errors)), "percentile mean errors do not match"
+			assert(np.array_equal(percentile_mask, expected_mask.reshape(errors.shape))), "percentile mask does not match"
+			assert(percentile_mask.dtype == expected_mask.dtype), "percentile mask dtype does not match"
+			(percentile_mean_errors, percentile_mask) = calc_mean_percentile_errors(errors, percentiles=percentiles, return_mask=False)
+			assert(np.allclose(percentile_mean_errors, expected_mean_errors) and (percentile_mask is None)), "percentile mean errors without mask do not match"
+	print("PASSED test_calc_mean_percentile_errors")
+
+def test_error_metrics_accumulator(n_errors=100000, n_batches=20, n_workers=3):
+	errors = np.abs(np.random.standard_cauchy(n_errors))*10
+	errors[0:100] = 0
+	expected_metrics = calc_error_metrics(errors, eps_list=[1., 5.])
+	accumulators = [ErrorMetricsAccumulator(eps_list=[1., 5.], relative_accuracy=0.01) for i in range(n_workers)]
+	for (i, batch_errors) in enumerate(np.array_split(errors, n_batches)): accumulators[i % n_workers].update(batch_errors)
+	for accumulator in accumulators[1:]: accumulators[0].merge(accumulator)
+	metrics = accumulators[0].get_metrics()
+	assert(set(metrics.keys()) == set(expected_metrics.keys())), "metrics keys do not match"
+	for key in ['mae', 'rmse', '0_tol_errs', '1_tol_errs', '5_tol_errs']:
+		assert(np.allclose(metrics[key], expected_metrics[key])), "{} does not match".format(key)
+	assert(np.abs(metrics['medae'] - expected_metrics['medae']) <= 0.01*expected_metrics['medae']), "medae is not within the relative accuracy"
+	assert(np.allclose(metrics['percentile_mae'], expected_metrics['percentile_mae'], rtol=0.01)), "percentile_mae does not match"
+	print("PASSED test_error_metrics_accumulator")
+
+def test_is_mutually_orthogonal(n=32, n_codes=4, n_matrices=6):
+	import scipy.linalg
+	orthogonal_mat = scipy.linalg.hadamard(n)[:, 0:n_codes].astype(np.float64)
+	X = np.stack([orthogonal_mat]*n_matrices, axis=0)
+	X[1:4] += np.random.rand(3, n, n_codes)
+	expected_is_orthogonal = [all([are_orthogonal(x[:, i], x[:, j]) for i in range(n_codes) for j in range(n_codes) if (i != j)]) for x in X]
+	assert(np.array_equal(is_mutually_orthogonal(X), expected_is_orthogonal)), "batched is_mutually_orthogonal does not match"
+	assert(is_mutually_orthogonal(orthogonal_mat) and (not is_mutually_orthogonal(X[1]))), "is_mutually_orthogonal does not match"
+	assert(np.allclose(calc_gram_matrix(X), np.einsum('bni,bnj->bij', X, X))), "gram matrix does not match"
+	print("PASSED test_is_mutually_orthogonal")
+
+if __name__=='__main__':
+	test_calc_mean_percentile_errors()
+	test_error_metrics_accumulator()
+	test_is_mutually_orthogonal()
@@ -0,0 +1,46 @@
+## Standard Library Imports
+import sys
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from research_utils.plot_utils import *
+
+
+def calc_errbars_loop(true_vals, meas_vals):
+	'''
+		Reference implementation that loops over each element (measurements are in the first dimension)
+	'''
+	errors = meas_vals - true_vals[np.newaxis, :]
+	neg_pos_mae = np.zeros((2, true_vals.size))
+	for i in range(true_vals.size):
+		curr_errors = errors[:, i]
+		neg_pos_mae[0, i] = np.mean(np.abs(curr_errors[curr_errors<=0]))
+		neg_pos_mae[1, i] = np.mean(np.abs(curr_errors[curr_errors>=0]))
+	return neg_pos_mae
+
+def test_calc_errbars(n_trials=30, n_elems=50):
+	true_vals = np.random.rand(n_elems)
+	meas_vals = true_vals[np.newaxis, :] + np.random.randn(n_trials, n_elems)
+	meas_vals[0, 0] = true_vals[0]
+	meas_vals[2, 5] = np.nan
+	expected_errbars = calc_errbars_loop(true_vals, meas_vals)
+	for chunk_size in [None, 7]:
+		assert(np.allclose(calc_errbars(true_vals, meas_vals, axis=0, chunk_size=chunk_size), expected_errbars)), "calc_errbars does not match reference"
+		assert(np.allclose(calc_errbars(true_vals, meas_vals.transpose(), axis=-1, chunk_size=chunk_size), expected_errbars)), "calc_errbars at axis=-1 does not match reference"
+	# Integer weights are the same as repeating the measurements
+	weights = np.random.randint(1, 4, size=(n_trials, n_elems))
+	weighted_errbars = calc_errbars(true_vals, meas_vals, weights=weights)
+	for i in [0, 1, 5]:
+		repeated_meas_vals = np.repeat(meas_vals[:, i], weights[:, i])
+		assert(np.allclose(weighted_errbars[:, i], calc_errbars_loop(true_vals[i:i+1], repeated_meas_vals[:, np.newaxis])[:, 0])), "weighted calc_errbars does not match reference"
+	# Mean errbars ignore NaNs
+	assert(np.allclose(calc_mean_errbars(meas_vals), calc_errbars_loop(np.nanmean(meas_vals, axis=0), meas_vals))), "calc_mean_errbars does not match reference"
+	print("PASSED test_calc_errbars")
+
+if __name__=='__main__':
+	test_calc_errbars()
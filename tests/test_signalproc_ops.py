@@ -0,0 +1,348 @@
+## Standard Library Imports
+import sys
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from research_utils.signalproc_ops import *
+from research_utils import fft_ops
+from research_utils.np_utils import get_extended_domain, extend_tensor_circularly, vectorize_tensor
+from research_utils.shared_constants import *
+
+
+def max_gaussian_center_of_mass_mle_loop(transient, tbins=None, sigma_tbins=1):
+	'''
+		Reference implementation that loops over each pixel
+	'''
+	transient = transient.reshape((-1, transient.shape[-1]))
+	(n_elems, n_tbins) = transient.shape
+	if(tbins is None): tbins = np.arange(0, n_tbins)
+	transient_noamb = transient - np.median(transient, axis=-1, keepdims=True)
+	transient_noamb[transient_noamb < 0] = 0
+	argmax_tbin = np.argmax(transient, axis=-1)
+	start_tbin = argmax_tbin - int(np.ceil(2*sigma_tbins)) + n_tbins
+	end_tbin = argmax_tbin + int(np.ceil(2*sigma_tbins)) + 1 + n_tbins
+	extended_tbins = get_extended_domain(tbins, axis=-1)
+	extended_transient_noamb = extend_tensor_circularly(transient_noamb, axis=-1)
+	center_of_mass_mle = np.zeros((n_elems,))
+	for i in range(n_elems):
+		tbin_vec = extended_tbins[start_tbin[i]:end_tbin[i]]
+		transient_vec = extended_transient_noamb[i, start_tbin[i]:end_tbin[i]]
+		center_of_mass_mle[i] = np.dot(transient_vec, tbin_vec) / (np.sum(transient_vec) + EPSILON)
+	return center_of_mass_mle
+
+def test_max_gaussian_center_of_mass_mle(n_rows=7, n_cols=9, n_tbins=64, sigma_tbins=2):
+	tbins = np.arange(0, n_tbins)*0.5
+	mu = np.random.rand(n_rows*n_cols)*tbins[-1]
+	# Force some pulses to be at the boundaries so that the window wraps around
+	mu[0:2] = [0, tbins[-1]]
+	transient = gaussian_pulse(tbins, mu, 2*sigma_tbins*(tbins[1]-tbins[0])) + 0.001*np.random.rand(n_rows*n_cols, n_tbins)
+	transient = transient.reshape((n_rows, n_cols, n_tbins))
+	expected = max_gaussian_center_of_mass_mle_loop(transient, tbins=tbins, sigma_tbins=sigma_tbins).reshape((n_rows, n_cols))
+	for chunk_size in [None, 1, 10]:
+		center_of_mass_mle = max_gaussian_center_of_mass_mle(transient, tbins=tbins, sigma_tbins=sigma_tbins, chunk_size=chunk_size)
+		assert(center_of_mass_mle.shape == (n_rows, n_cols)), "incorrect output shape"
+		assert(np.allclose(center_of_mass_mle, expected)), "batched center of mass does not match per-pixel loop"
+	center_of_mass_mle = max_gaussian_center_of_mass_mle(transient.astype(np.float32), tbins=tbins, sigma_tbins=sigma_tbins, dtype=np.float32)
+	assert(center_of_mass_mle.dtype == np.float32), "dtype was not preserved"
+	assert(np.allclose(center_of_mass_mle, expected, atol=1e-3)), "float32 center of mass does not match per-pixel loop"
+	print("PASSED test_max_gaussian_center_of_mass_mle")
+
+def test_circular_filter(n_elems=20, n=100):
+	X = np.random.rand(n_elems, n)
+	kernel = np.random.rand(n)
+	circ_filter = CircularFilter(kernel)
+	assert(np.allclose(circ_filter.convolve(X), circular_conv(np.tile(kernel, (n_elems, 1)), X))), "filter convolve does not match circular_conv"
+	assert(np.allclose(circ_filter.correlate(X), circular_corr(np.tile(kernel, (n_elems, 1)), X))), "filter correlate does not match circular_corr"
+	assert(np.all(circ_filter.matched_filter(X) == np.argmax(circular_corr(kernel[np.newaxis, :], X), axis=-1))), "filter matched_filter does not match circular_corr argmax"
+	# Filter along the first dimension
+	circ_filter = CircularFilter(kernel, axis=0)
+	assert(np.allclose(circ_filter.convolve(X.transpose()), circular_conv(kernel[:, np.newaxis], X.transpose(), axis=0))), "filter convolve along axis 0 does not match circular_conv"
+	# Zero-padded kernels
+	circ_filter = CircularFilter(kernel[0:10], n=n)
+	padded_kernel = np.zeros((n,))
+	padded_kernel[0:10] = kernel[0:10]
+	assert(np.allclose(circ_filter.convolve(X), circular_conv(padded_kernel[np.newaxis, :], X))), "zero-padded kernel does not match circular_conv"
+	print("PASSED test_circular_filter")
+
+def test_fft_backends(n_elems=10, n=101):
+	v1 = np.random.rand(n_elems, n)
+	v2 = np.random.rand(n_elems, n)
+	expected_corr = np.fft.ifft(np.fft.fft(v1, axis=-1).conj() * np.fft.fft(v2, axis=-1), axis=-1).real
+	expected_conv = np.fft.ifft(np.fft.fft(v1, axis=-1) * np.fft.fft(v2, axis=-1), axis=-1).real
+	for backend in fft_ops.FFT_BACKENDS:
+		with fft_ops.fft_backend(backend, workers=2):
+			assert(fft_ops.get_fft_backend() == (backend, 2)), "fft backend was not set"
+			assert(np.allclose(circular_corr(v1, v2), expected_corr)), "circular_corr does not match with {} backend".format(backend)
+			assert(np.allclose(circular_conv(v1, v2), expected_conv)), "circular_conv does not match with {} backend".format(backend)
+			corr_f32 = circular_corr(v1.astype(np.float32), v2.astype(np.float32))
+			assert(corr_f32.dtype == np.float32), "float32 was not preserved with {} backend".format(backend)
+			assert(np.allclose(corr_f32, expected_corr, atol=1e-4)), "float32 circular_corr does not match with {} backend".format(backend)
+	# Complex inputs use the full fft
+	v1_cmpx = v1 + 1j*np.random.rand(n_elems, n)
+	expected_corr = np.fft.ifft(np.fft.fft(v1_cmpx, axis=-1).conj() * np.fft.fft(v2, axis=-1), axis=-1).real
+	assert(np.allclose(circular_corr(v1_cmpx, v2), expected_corr)), "circular_corr does not match for complex inputs"
+	assert(fft_ops.get_fft_backend()[0] == 'scipy'), "fft backend was not restored"
+	print("PASSED test_fft_backends")
+
+def test_circular_matched_filter_subbin(n_elems=50, n=200, sigma=3.):
+	tbins = np.arange(0, n)
+	mu = np.random.rand(n_elems)*n
+	s = gaussian_pulse(tbins, mu, sigma)
+	template = gaussian_pulse(tbins, 0, sigma)
+	int_peak_loc = circular_matched_filter(s, template)
+	for chunk_size in [None, 7]:
+		(peak_loc, peak_score) = circular_matched_filter_subbin(s, template, chunk_size=chunk_size, method=None)
+		assert(np.all(peak_loc == int_peak_loc)), "integer argmax does not match circular_matched_filter"
+		(peak_loc, peak_score) = circular_matched_filter_subbin(s, template, chunk_size=chunk_size, method='gaussian')
+		circ_errors = np.abs(np.mod(peak_loc - mu + 0.5*n, n) - 0.5*n)
+		assert(np.all(circ_errors < 0.01)), "gaussian sub-bin refinement is not accurate"
+		(peak_loc, peak_score) = circular_matched_filter_subbin(s, template, chunk_size=chunk_size, method='parabolic')
+		circ_errors = np.abs(np.mod(peak_loc - mu + 0.5*n, n) - 0.5*n)
+		int_circ_errors = np.abs(np.mod(int_peak_loc - mu + 0.5*n, n) - 0.5*n)
+		assert(np.mean(circ_errors) < np.mean(int_circ_errors)), "parabolic sub-bin refinement is less accurate than argmax"
+		assert(np.all(peak_score >= np.max(circular_corr(template[np.newaxis, :], s), axis=-1) - EPSILON)), "interpolated peak score is lower than the max"
+	# Per-signal templates along the first axis
+	(peak_loc, peak_score) = circular_matched_filter_subbin(s.transpose(), np.tile(template, (n_elems, 1)).transpose(), axis=0, chunk_size=7, method='gaussian')
+	circ_errors = np.abs(np.mod(peak_loc - mu + 0.5*n, n) - 0.5*n)
+	assert(np.all(circ_errors < 0.01)), "gaussian sub-bin refinement is not accurate along axis 0"
+	print("PASSED test_circular_matched_filter_subbin")
+
+def test_smooth_codes(n=100, n_codes=4, window_duty=0.15):
+	modfs = np.random.rand(n, n_codes)
+	demodfs = np.random.rand(n, n_codes)
+	(smoothed_modfs, smoothed_demodfs) = smooth_codes(modfs, demodfs, window_duty=window_duty)
+	for i in range(n_codes):
+		assert(np.allclose(smoothed_modfs[:, i], smooth(modfs[:, i], window_len=n*window_duty, window='hanning'))), "smoothed modfs do not match smooth"
+		assert(np.allclose(smoothed_demodfs[:, i], smooth(demodfs[:, i], window_len=n*window_duty, window='hanning'))), "smoothed demodfs do not match smooth"
+	# Stack of code matrices
+	modfs_stack = np.stack((modfs, demodfs, modfs), axis=0)
+	(smoothed_modfs_stack, _) = smooth_codes(modfs_stack, modfs_stack, window_duty=window_duty)
+	assert(np.allclose(smoothed_modfs_stack[1], smoothed_demodfs)), "smoothed stack of codes does not match"
+	# Windows that are too small are not applied
+	(smoothed_modfs, smoothed_demodfs) = smooth_codes(modfs, demodfs, window_duty=0.01)
+	assert(np.all(smoothed_modfs == modfs)), "codes should not be smoothed for windows smaller than 3"
+	print("PASSED test_smooth_codes")
+
+def test_get_smoothing_window(N=100):
+	for window in SMOOTHING_WINDOWS:
+		for window_len in [3, 10, 11.5]:
+			# Reference window generated without cache
+			expected_w = np.zeros((N,))
+			if(window == 'flat'): expected_w[0:int(window_len)] = 1.
+			elif(window == 'impulse'): expected_w[0] = 1.
+			else: expected_w[0:int(window_len)] = getattr(np, window)(int(window_len))
+			expected_w = np.roll(expected_w, shift=-1*np.argmax(expected_w))
+			expected_w /= expected_w.sum()
+			w = get_smoothing_window(N=N, window_len=window_len, window=window)
+			assert(np.allclose(w, expected_w)), "smoothing window does not match"
+			assert(not w.flags.writeable), "cached smoothing windows should be read-only"
+			assert(w is get_smoothing_window(N=N, window_len=window_len, window=window)), "smoothing window was not cached"
+			f_w = get_smoothing_window(N=N, window_len=window_len, window=window, return_rfft=True)
+			assert(np.allclose(f_w, np.fft.rfft(expected_w))), "smoothing window rfft does not match"
+			w_f32 = get_smoothing_window(N=N, window_len=window_len, window=window, dtype=np.float32)
+			assert((w_f32.dtype == np.float32) and np.allclose(w_f32, expected_w)), "float32 smoothing window does not match"
+	print("PASSED test_get_smoothing_window")
+
+def circulant_loop(f, direction=1):
+	'''
+		Reference implementation of the circulant matrix
+	'''
+	N = f.size
+	C = np.zeros((N,N))
+	if(f.shape[0] == 1):
+		for i in range(0,N): C[[i],:] = np.roll(f,i*direction)
+	else:
+		for i in range(0,N): C[:,[i]] = np.roll(f,i*direction).reshape((N,1))
+	return C
+
+def test_circulant_operator(N=64, K=3):
+	x = np.random.rand(N)
+	X = np.random.rand(N, K)
+	f = np.random.rand(N)
+	for (curr_f, direction) in [(f, 1), (f, -1), (f.reshape((1,N)), 1), (f.reshape((N,1)), -1)]:
+		C = circulant_loop(curr_f, direction=direction)
+		assert(np.allclose(circulant(curr_f, direction=direction), C)), "circulant does not match reference implementation"
+		C_op = CirculantOperator(curr_f, direction=direction)
+		assert(np.allclose(C_op.to_dense(), C)), "circulant operator to_dense does not match"
+		assert(np.allclose(C_op.matvec(x), C @ x)), "circulant operator matvec does not match"
+		assert(np.allclose(C_op.matmat(X), C @ X)), "circulant operator matmat does not match"
+		assert(np.allclose(C_op.rmatvec(x), C.T @ x)), "circulant operator rmatvec does not match"
+		assert(np.allclose(C_op @ X, C @ X)), "circulant operator @ does not match"
+		assert(np.allclose(C_op.solve(C @ X), X)), "circulant operator solve did not recover input"
+	# Singular circulant matrix (zero-mean f)
+	f_zero_mean = f - f.mean()
+	for direction in [1, -1]:
+		C = circulant_loop(f_zero_mean, direction=direction)
+		C_op = CirculantOperator(f_zero_mean, direction=direction)
+		assert(np.allclose(C_op.solve(X, rcond=1e-10), np.linalg.pinv(C, rcond=1e-10) @ X)), "circulant operator solve does not match pinv"
+	print("PASSED test_circulant_operator")
+
+def test_broadcast_toeplitz(n_elems=5, n_rows=7, n_cols=4, K=3):
+	import scipy.linalg
+	C_tensor = np.random.rand(n_elems, n_rows)
+	R_tensor = np.random.rand(n_elems, n_cols)
+	C_tensor_cmpx = C_tensor + 1j*np.random.rand(n_elems, n_rows)
+	for (curr_C, curr_R) in [(C_tensor, R_tensor), (C_tensor_cmpx, R_tensor), (C_tensor_cmpx, None), (C_tensor, None)]:
+		T = broadcast_toeplitz(curr_C, curr_R)
+		for i in range(n_elems):
+			expected_T = scipy.linalg.toeplitz(curr_C[i], None if (curr_R is None) else curr_R[i])
+			assert(np.allclose(T[i], expected_T)), "broadcast_toeplitz does not match scipy.linalg.toeplitz"
+		T_view = broadcast_toeplitz(curr_C, curr_R, as_view=True)
+		assert(np.all(T_view == T)), "broadcast_toeplitz view does not match copy"
+		assert(not T_view.flags.writeable), "broadcast_toeplitz view should be read-only"
+		T_op = BatchedToeplitzOperator(curr_C, curr_R)
+		assert(T_op.shape == T.shape), "toeplitz operator shape does not match"
+		x = np.random.rand(n_elems, T.shape[-1]) + 1j*np.random.rand(n_elems, T.shape[-1])
+		y = np.random.rand(n_elems, T.shape[-2])
+		X = np.random.rand(n_elems, T.shape[-1], K)
+		assert(np.allclose(T_op.matvec(x), np.einsum('...ij,...j->...i', T, x))), "toeplitz operator matvec does not match"
+		assert(np.allclose(T_op.matvec(x.real), np.einsum('...ij,...j->...i', T, x.real))), "toeplitz operator matvec does not match for real inputs"
+		assert(np.allclose(T_op.matmat(X), T @ X)), "toeplitz operator matmat does not match"
+		assert(np.allclose(T_op.rmatvec(y), np.einsum('...ij,...i->...j', T.conj(), y))), "toeplitz operator rmatvec does not match"
+	print("PASSED test_broadcast_toeplitz")
+
+def gaussian_pulse_ext_domain(time_domain, mu, width):
+	'''
+		Reference implementation that evaluates the pulses over the full circularly extended domain
+	'''
+	ext_time_domain = get_extended_domain(time_domain)
+	ext_pulse = np.exp(-1*np.square((ext_time_domain[np.newaxis,:] - mu[:, np.newaxis]) / width[:, np.newaxis]))
+	n_bins = time_domain.shape[-1]
+	pulse = ext_pulse[...,0:n_bins] + ext_pulse[...,n_bins:2*n_bins] + ext_pulse[...,2*n_bins:3*n_bins]
+	return normalize_signal(pulse, axis=-1)
+
+def test_gaussian_pulse_bank(n_pulses=100, n=300):
+	time_domain = np.arange(0, n)*0.1
+	mu = np.random.rand(n_pulses)*(time_domain[-1] + 0.1)
+	mu[0:2] = [0, time_domain[-1]]
+	width = 0.1*np.random.randint(1, 20, size=(n_pulses,))
+	expected_pulses = gaussian_pulse_ext_domain(time_domain, mu, width)
+	assert(np.allclose(gaussian_pulse(time_domain, mu, width), expected_pulses)), "gaussian_pulse does not match reference"
+	assert(np.allclose(gaussian_pulse(time_domain, mu[0], width[0]), expected_pulses[0])), "single gaussian_pulse does not match reference"
+	for chunk_size in [None, 1, 32]:
+		pulses = gaussian_pulse_bank(time_domain, mu, width, chunk_size=chunk_size)
+		assert(np.allclose(pulses, expected_pulses)), "gaussian_pulse_bank does not match reference"
+	out = np.zeros((n_pulses, n), dtype=np.float32)
+	pulses = gaussian_pulse_bank(time_domain, mu, width, out=out, chunk_size=32)
+	assert((pulses is out) and np.allclose(out, expected_pulses, atol=1e-6)), "float32 gaussian_pulse_bank does not match reference"
+	# Pulses that are wider than the domain
+	width = np.ones((n_pulses,))*(time_domain[-1])
+	assert(np.allclose(gaussian_pulse_bank(time_domain, mu, width), gaussian_pulse_ext_domain(time_domain, mu, width))), "wide gaussian_pulse_bank does not match reference"
+	print("PASSED test_gaussian_pulse_bank")
+
+def test_sinc_resampler(n_elems=10):
+	from scipy import signal
+	for (lres_n, hres_n) in [(100, 2000), (101, 2000), (100, 2001), (100, 51), (64, 64)]:
+		x = np.random.rand(2, n_elems, lres_n)
+		expected_hres_x = signal.resample(x, hres_n, axis=-1)
+		assert(np.allclose(sinc_interp(x, hres_n), expected_hres_x)), "sinc_interp does not match scipy resample"
+		assert(np.allclose(sinc_interp(np.moveaxis(x, -1, 0), hres_n, axis=0), np.moveaxis(expected_hres_x, -1, 0))), "sinc_interp does not match scipy resample at axis 0"
+		resampler = get_sinc_resampler(lres_n, hres_n)
+		assert(resampler is get_sinc_resampler(lres_n, hres_n)), "resampler was not cached"
+		(hres_idx, hres_vals) = resampler.local_resample(x, half_window_len=5, chunk_size=3)
+		assert(hres_idx.shape == (2, n_elems, 11)), "incorrect local_resample shape"
+		assert(np.allclose(np.take_along_axis(expected_hres_x, hres_idx, axis=-1), hres_vals)), "local_resample does not match scipy resample"
+	# The local argmax matches the argmax of the full hres signal for smooth pulses
+	tbins = np.arange(0, 100)
+	x = gaussian_pulse(tbins, np.random.rand(n_elems)*100, 3)
+	resampler = get_sinc_resampler(100, 2000)
+	(peak_loc, peak_val) = resampler.local_argmax(x)
+	hres_x = resampler.resample(x)
+	assert(np.all(peak_loc == np.argmax(hres_x, axis=-1)) and np.allclose(peak_val, hres_x.max(axis=-1))), "local_argmax does not match full argmax"
+	print("PASSED test_sinc_resampler")
+
+def test_out_and_dtype(n_rows=6, n_cols=5, n=64):
+	X = np.random.rand(n_rows, n_cols, n)
+	X_f32 = X.astype(np.float32)
+	for func in [normalize_signal, standardize_signal]:
+		expected_Y = func(X, axis=-1)
+		assert(func(X_f32, axis=-1).dtype == np.float32), "{} upcasted float32 input".format(func.__name__)
+		out = np.zeros(X.shape, dtype=np.float32)
+		assert((func(X, axis=-1, out=out) is out) and np.allclose(out, expected_Y, atol=1e-6)), "{} out does not match".format(func.__name__)
+		Y = X.copy()
+		func(Y, axis=-1, out=Y)
+		assert(np.allclose(Y, expected_Y)), "in-place {} does not match".format(func.__name__)
+	# Integer inputs give floating point outputs
+	X_int = np.random.randint(0, 100, size=X.shape)
+	assert(np.allclose(standardize_signal(X_int, axis=-1), standardize_signal(X_int.astype(np.float64), axis=-1))), "integer standardize_signal does not match"
+	out = np.zeros(X.shape, dtype=np.float32)
+	assert(np.allclose(standardize_signal(X_int, axis=-1, out=out), standardize_signal(X_int.astype(np.float64), axis=-1), atol=1e-6)), "integer standardize_signal out does not match"
+	# Smoothing
+	assert(smooth_tensor(X_f32, window_duty=0.2, axis=-1).dtype == np.float32), "smooth_tensor upcasted float32 input"
+	for (axis, chunk_size) in [(-1, None), (-1, 4), (1, 4), (0, 4)]:
+		expected_Y = smooth_tensor(X, window_duty=0.2, axis=axis)
+		out = np.zeros(X.shape, dtype=np.float32)
+		assert((smooth_tensor(X, window_duty=0.2, axis=axis, out=out, chunk_size=chunk_size) is out) and np.allclose(out, expected_Y, atol=1e-6)), "smooth_tensor out does not match"
+		Y = X.copy()
+		smooth_tensor(Y, window_duty=0.2, axis=axis, out=Y, chunk_size=chunk_size)
+		assert(np.allclose(Y, expected_Y)), "in-place smooth_tensor does not match"
+	# Pulses
+	time_domain = np.arange(0, n)
+	mu = np.random.rand(n_rows)*n
+	for circ_shifted in [True, False]:
+		expected_pulses = gaussian_pulse(time_domain, mu, 3, circ_shifted=circ_shifted)
+		assert(gaussian_pulse(time_domain, mu, 3, circ_shifted=circ_shifted, dtype=np.float32).dtype == np.float32), "gaussian_pulse dtype does not match"
+		out = np.zeros((n_rows, n), dtype=np.float32)
+		assert((gaussian_pulse(time_domain, mu, 3, circ_shifted=circ_shifted, out=out) is out) and np.allclose(out, expected_pulses, atol=1e-6)), "gaussian_pulse out does not match"
+	# Vectorize
+	out = np.zeros((n_rows*n_cols, n), dtype=np.float32)
+	(X_vec, X_shape) = vectorize_tensor(X, out=out)
+	assert((X_vec is out) and (X_shape == X.shape) and np.allclose(out, X.reshape((-1, n)))), "vectorize_tensor out does not match"
+	assert(np.shares_memory(vectorize_tensor(X)[0], X)), "vectorize_tensor should return a view"
+	print("PASSED test_out_and_dtype")
+
+def test_torch_dispatch(n_rows=4, n_cols=5, n=64):
+	try: import torch
+	except ImportError:
+		print("SKIPPED test_torch_dispatch (torch is not installed)")
+		return
+	X = np.random.rand(n_rows, n_cols, n)
+	X_t = torch.tensor(X, requires_grad=True)
+	kernel = np.random.rand(n)
+	for func in [circular_conv, circular_corr]:
+		assert(np.allclose(func(torch.tensor(kernel), X_t).detach().numpy(), func(kernel, X))), "torch {} does not match".format(func.__name__)
+	circ_filter = CircularFilter(kernel)
+	assert(np.allclose(circ_filter.convolve(X_t).detach().numpy(), circ_filter.convolve(X))), "torch convolve does not match"
+	assert(np.all(circular_matched_filter(X_t, torch.tensor(kernel)).numpy() == circular_matched_filter(X, kernel))), "torch matched filter does not match"
+	for (axis, chunk_size) in [(-1, None), (1, 2)]:
+		Y_t = smooth_tensor(X_t, window_duty=0.2, axis=axis, chunk_size=chunk_size)
+		assert(np.allclose(Y_t.detach().numpy(), smooth_tensor(X, window_duty=0.2, axis=axis))), "torch smooth_tensor does not match"
+	assert(smooth_tensor(X_t.float(), window_duty=0.2).dtype == torch.float32), "torch smooth_tensor upcasted float32 input"
+	Y_t.sum().backward()
+	assert(X_t.grad.shape == X_t.shape), "torch smooth_tensor gradient was not computed"
+	# Pulses and center of mass
+	tbins = np.arange(0, n)
+	mu = np.random.rand(n_rows*n_cols)*n
+	mu_t = torch.tensor(mu, requires_grad=True)
+	for circ_shifted in [True, False]:
+		pulses_t = gaussian_pulse(tbins, mu_t, 3, circ_shifted=circ_shifted)
+		assert(np.allclose(pulses_t.detach().numpy(), gaussian_pulse(tbins, mu, 3, circ_shifted=circ_shifted))), "torch gaussian_pulse does not match"
+	(pulses_t*torch.tensor(tbins)).sum().backward()
+	assert(torch.all(mu_t.grad != 0)), "torch gaussian_pulse gradient was not computed"
+	transients = gaussian_pulse(tbins, mu, 2).reshape((n_rows, n_cols, n)) + 0.01*np.random.rand(n_rows, n_cols, n)
+	center_of_mass_t = max_gaussian_center_of_mass_mle(torch.tensor(transients), chunk_size=3)
+	assert(np.allclose(center_of_mass_t.numpy(), max_gaussian_center_of_mass_mle(transients))), "torch center of mass does not match"
+	photon_counts = np.random.poisson(100*transients)
+	center_of_mass_t = max_gaussian_center_of_mass_mle(torch.tensor(photon_counts, dtype=torch.int64), chunk_size=3)
+	assert((center_of_mass_t.dtype == torch.float64) and np.allclose(center_of_mass_t.numpy(), max_gaussian_center_of_mass_mle(photon_counts))), "torch center of mass of integer transients does not match"
+	print("PASSED test_torch_dispatch")
+
+if __name__=='__main__':
+	test_max_gaussian_center_of_mass_mle()
+	test_max_gaussian_center_of_mass_mle(n_rows=1, n_cols=1, n_tbins=16, sigma_tbins=1)
+	test_circular_filter()
+	test_fft_backends()
+	test_circular_matched_filter_subbin()
+	test_smooth_codes()
+	test_get_smoothing_window()
+	test_circulant_operator()
+	test_broadcast_toeplitz()
+	test_gaussian_pulse_bank()
+	test_sinc_resampler()
+	test_out_and_dtype()
+	test_torch_dispatch()
@@ -0,0 +1,42 @@
+## Standard Library Imports
+import sys
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from research_utils.spad_sim_ops import *
+from research_utils.signalproc_ops import gaussian_pulse
+
+
+def test_simulate_photon_counts(n_rows=4, n_cols=5, n_tbins=128, n_laser_cycles=20000):
+	tbins = np.arange(0, n_tbins)
+	transient = gaussian_pulse(tbins, np.random.rand(n_rows*n_cols)*n_tbins, 3.).reshape((n_rows, n_cols, n_tbins))
+	flux = get_photon_flux(transient, mean_signal_photons=1., mean_ambient_photons=1.)
+	assert(np.allclose(flux.sum(axis=-1), 2.)), "incorrect photon flux"
+	rng = np.random.RandomState(0)
+	for mode in PHOTON_COUNT_MODES:
+		counts = simulate_photon_counts(flux, n_laser_cycles, mode=mode, rng=rng, chunk_size=7)
+		assert(counts.shape == flux.shape), "incorrect counts shape"
+		n_photons = counts.sum(axis=-1)
+		if(mode == 'poisson'): assert(np.allclose(n_photons, 2*n_laser_cycles, rtol=0.05)), "incorrect number of poisson photons"
+		elif(mode == 'multinomial'): assert(np.all(n_photons == 2*n_laser_cycles)), "incorrect number of multinomial photons"
+		else: assert(np.allclose(n_photons, n_laser_cycles*(1 - np.exp(-2)), rtol=0.05)), "incorrect number of detected photons"
+	# The number of multinomial photons scales with the flux of each pixel, or is given by n_photons
+	flux_levels = np.random.rand(n_rows, n_cols, 1)*2 + 0.01
+	counts = simulate_photon_counts(flux_levels*flux, n_laser_cycles, mode='multinomial', rng=rng)
+	assert(np.all(counts.sum(axis=-1) == np.round(n_laser_cycles*(flux_levels*flux).sum(axis=-1)))), "multinomial photons do not scale with the flux"
+	counts = simulate_photon_counts(flux, n_laser_cycles, mode='multinomial', rng=rng, n_photons=np.arange(n_rows*n_cols).reshape((n_rows, n_cols)))
+	assert(np.all(counts.sum(axis=-1) == np.arange(n_rows*n_cols).reshape((n_rows, n_cols)))), "multinomial photons do not match n_photons"
+	# Coates correction should undo the pile-up
+	counts = simulate_photon_counts(flux, n_laser_cycles, mode='synchronous', rng=rng)
+	flux_est = coates_correction(counts, n_laser_cycles, chunk_size=7)
+	assert(np.allclose(flux_est.sum(axis=-1), 2., rtol=0.05)), "coates correction did not recover the total flux"
+	assert(np.abs(flux_est - flux).max() < 0.05), "coates correction did not recover the flux"
+	print("PASSED test_simulate_photon_counts")
+
+if __name__=='__main__':
+	test_simulate_photon_counts()
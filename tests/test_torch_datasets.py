@@ -0,0 +1,150 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+
+
+def write_paired_dataset(dirpath, n_samples=4, n_rows=16, n_cols=12, n_tbins=32):
+	'''
+		Write a dataset with transient cubes (n_rows x n_cols x n_tbins), and their sum over time (.npy) and max (.npz) images 
+	'''
+	dirpath_list = [os.path.join(dirpath, dirname) for dirname in ['transients', 'intensity', 'max_intensity']]
+	for curr_dirpath in dirpath_list: os.makedirs(curr_dirpath)
+	for i in range(n_samples):
+		transient = np.random.rand(n_rows, n_cols, n_tbins)
+		np.save(os.path.join(dirpath_list[0], 'sample{}.npy'.format(i)), transient)
+		np.save(os.path.join(dirpath_list[1], 'sample{}.npy'.format(i)), transient.sum(axis=-1))
+		np.savez(os.path.join(dirpath_list[2], 'sample{}.npz'.format(i)), max_intensity=transient.max(axis=-1))
+	return dirpath_list
+
+def test_multi_folder_paired_numpy_data():
+	try: from research_utils.torch_datasets import MultiFolderPairedNumpyData
+	except ImportError:
+		print("SKIPPED test_multi_folder_paired_numpy_data (torch is not installed)")
+		return
+	with tempfile.TemporaryDirectory() as tmp_dirpath:
+		dirpath_list = write_paired_dataset(tmp_dirpath)
+		dataset = MultiFolderPairedNumpyData(dirpath_list)
+		(full_sample, fname) = dataset.get_sample('sample2')
+		assert((fname == 'sample2') and (dataset.base_filenames[2] == 'sample2')), "filenames do not match"
+		assert(dataset.get_sample('missing_sample') is None), "missing sample was found"
+		crop = (slice(3, 11), slice(2, 6))
+		for mmap_mode in [None, 'r']:
+			dataset = MultiFolderPairedNumpyData(dirpath_list, mmap_mode=mmap_mode)
+			(sample, _) = dataset.__getitem__(2, crop=crop)
+			assert(np.allclose(sample[0], full_sample[0][crop]) and np.allclose(sample[1], full_sample[1][crop])), "cropped sample does not match"
+			assert(np.allclose(sample[2]['max_intensity'], full_sample[2]['max_intensity'][crop])), "cropped npz sample does not match"
+			# Random crops are the same for all arrays of the sample
+			dataset = MultiFolderPairedNumpyData(dirpath_list, mmap_mode=mmap_mode, random_crop_size=(8, 4), crop_axes=(0, 1))
+			(sample, _) = dataset[2]
+			assert((sample[0].shape == (8, 4, 32)) and (sample[1].shape == (8, 4))), "incorrect random crop shape"
+			assert(np.allclose(sample[0].sum(axis=-1), sample[1]) and np.allclose(sample[0].max(axis=-1), sample[2]['max_intensity'])), "random crops do not match"
+		# Random crops of datasets with only .npz files
+		dataset = MultiFolderPairedNumpyData(dirpath_list[2:], random_crop_size=(4, 4), crop_axes=(0, 1))
+		assert(dataset[0][0][0]['max_intensity'].shape == (4, 4)), "incorrect random crop shape of npz sample"
+		# With the default crop_axes, the last 2 dims of the H x W x T and H x W arrays have different sizes
+		dataset = MultiFolderPairedNumpyData(dirpath_list, random_crop_size=(4, 4))
+		try:
+			dataset[0]
+			assert(False), "inconsistent crop axes were not detected"
+		except ValueError as e:
+			assert("different sizes" in str(e)), "inconsistent crop axes were not detected"
+	print("PASSED test_multi_folder_paired_numpy_data")
+
+def test_packed_paired_numpy_data(n_samples=12):
+	try: from research_utils.torch_datasets import MultiFolderPairedNumpyData, PackedPairedNumpyData, PackedPairedNumpyIterableData
+	except ImportError:
+		print("SKIPPED test_packed_paired_numpy_data (torch is not installed)")
+		return
+	import torch
+	from research_utils.io_ops import pack_multi_folder_paired_data
+	with tempfile.TemporaryDirectory() as tmp_dirpath:
+		dirpath_list = write_paired_dataset(tmp_dirpath, n_samples=n_samples)
+		packed_dirpath = os.path.join(tmp_dirpath, 'packed')
+		pack_multi_folder_paired_data(dirpath_list, packed_dirpath, max_shard_nbytes=3*16*12*32*8)
+		dataset = MultiFolderPairedNumpyData(dirpath_list)
+		packed_dataset = PackedPairedNumpyData(packed_dirpath)
+		assert((len(packed_dataset) == n_samples) and (packed_dataset.n_shards > 1)), "incorrect number of samples or shards"
+		for i in range(n_samples):
+			((sample, fname), (packed_sample, packed_fname)) = (dataset[i], packed_dataset[i])
+			assert(fname == packed_fname), "filenames do not match"
+			assert(np.array_equal(sample[0], packed_sample[0]) and np.array_equal(sample[1], packed_sample[1])), "packed sample does not match"
+			assert(np.array_equal(sample[2]['max_intensity'], packed_sample[2]['max_intensity'])), "packed npz sample does not match"
+		# Every sample is loaded exactly once per epoch, with any number of workers
+		for (shuffle_buffer_size, shuffle_shards, num_workers) in [(1, False, 0), (5, True, 0), (5, True, 2)]:
+			iterable_dataset = PackedPairedNumpyIterableData(packed_dirpath, shuffle_buffer_size=shuffle_buffer_size, shuffle_shards=shuffle_shards)
+			loader = torch.utils.data.DataLoader(iterable_dataset, batch_size=4, num_workers=num_workers)
+			fnames = [fname for (_, batch_fnames) in loader for fname in batch_fnames]
+			assert(sorted(fnames) == packed_dataset.base_filenames), "iterable dataset did not load every sample once"
+			if(shuffle_buffer_size == 1): assert(fnames == packed_dataset.base_filenames), "samples are not in shard order"
+	print("PASSED test_packed_paired_numpy_data")
+
+def test_numpy_sample_cache(n_samples=6):
+	try: from research_utils.torch_datasets import MultiFolderPairedNumpyData, NumpySampleCache, get_sample_nbytes
+	except ImportError:
+		print("SKIPPED test_numpy_sample_cache (torch is not installed)")
+		return
+	import torch
+	with tempfile.TemporaryDirectory() as tmp_dirpath:
+		dirpath_list = write_paired_dataset(tmp_dirpath, n_samples=n_samples)
+		dataset = MultiFolderPairedNumpyData(dirpath_list)
+		sample_nbytes = get_sample_nbytes(dataset.load_sample(dataset.base_filenames[0]))
+		for cache_dirpath in [None, os.path.join(tmp_dirpath, 'cache')]:
+			cache = NumpySampleCache(10*n_samples*sample_nbytes, cache_dirpath=cache_dirpath)
+			cached_dataset = MultiFolderPairedNumpyData(dirpath_list, mmap_mode='r', cache=cache)
+			# The second epoch is served from the cache
+			for i in 2*list(range(n_samples)):
+				((sample, _), (cached_sample, _)) = (dataset[i], cached_dataset[i])
+				assert(np.array_equal(sample[0], cached_sample[0]) and np.array_equal(sample[2]['max_intensity'], cached_sample[2]['max_intensity'])), "cached sample does not match"
+			stats = cache.get_stats()
+			assert((stats['hits'] == n_samples) and (stats['misses'] == n_samples) and (stats['evictions'] == 0)), "incorrect cache counters"
+			(cropped_sample, _) = cached_dataset.__getitem__(0, crop=(slice(1, 5),))
+			assert(np.array_equal(cropped_sample[1], dataset[0][0][1][1:5])), "cropped cached sample does not match"
+			# Only 2 samples fit in the budget
+			for eviction in NumpySampleCache.valid_eviction:
+				cache = NumpySampleCache(int(2.5*sample_nbytes), cache_dirpath=cache_dirpath, eviction=eviction)
+				cached_dataset = MultiFolderPairedNumpyData(dirpath_list, cache=cache)
+				for i in range(n_samples): cached_dataset[i]
+				assert((len(cache) == 2) and (cache.get_stats()['nbytes'] <= cache.max_nbytes)), "cache is over budget"
+				if(cache_dirpath is not None): 
+					for fname in os.listdir(cache_dirpath): os.remove(os.path.join(cache_dirpath, fname))
+			# Samples are evicted in batches down to the low water mark (2 samples after the 5th sample is cached)
+			cache = NumpySampleCache(int(4.5*sample_nbytes), cache_dirpath=cache_dirpath, low_water_ratio=0.5)
+			cached_dataset = MultiFolderPairedNumpyData(dirpath_list, cache=cache)
+			for i in range(n_samples): cached_dataset[i]
+			assert((len(cache) == 3) and (cache.get_stats()['evictions'] == 3)), "samples were not evicted in batches"
+			if(cache_dirpath is not None): 
+				for fname in os.listdir(cache_dirpath): os.remove(os.path.join(cache_dirpath, fname))
+		# Modifying the returned (full or cropped) samples does not modify the cached samples
+		cache = NumpySampleCache(10*n_samples*sample_nbytes)
+		cached_dataset = MultiFolderPairedNumpyData(dirpath_list, cache=cache)
+		(expected_sample, _) = dataset[0]
+		for _ in range(2):
+			cached_dataset[0][0][0][:] = -1
+			cached_dataset[0][0][2]['max_intensity'][:] = -1
+			cached_dataset.__getitem__(0, crop=(slice(0, 2),))[0][1][:] = -1
+			(sample, _) = cached_dataset[0]
+			assert(np.array_equal(sample[0], expected_sample[0]) and np.array_equal(sample[1], expected_sample[1])), "cached sample was modified"
+			assert(np.array_equal(sample[2]['max_intensity'], expected_sample[2]['max_intensity'])), "cached npz sample was modified"
+		# The file-backed cache and its counters are shared by the DataLoader workers
+		cache = NumpySampleCache(10*n_samples*sample_nbytes, cache_dirpath=os.path.join(tmp_dirpath, 'shared_cache'))
+		cached_dataset = MultiFolderPairedNumpyData(dirpath_list, cache=cache)
+		loader = torch.utils.data.DataLoader(cached_dataset, batch_size=2, num_workers=2)
+		for epoch in range(2):
+			for (data_sample, fnames) in loader: pass
+		stats = cache.get_stats()
+		assert((stats['hits'] == n_samples) and (stats['misses'] == n_samples)), "cache was not shared by the workers"
+	print("PASSED test_numpy_sample_cache")
+
+if __name__=='__main__':
+	test_multi_folder_paired_numpy_data()
+	test_packed_paired_numpy_data()
+	test_numpy_sample_cache()
@@ -0,0 +1,46 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append('../')
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from research_utils.transient_dataset_gen import *
+
+
+def test_generate_expgaussian_pulse_dataset(n_samples=250, n_samples_per_shard=100, n=64):
+	with tempfile.TemporaryDirectory() as tmp_dirpath:
+		dirpath1 = os.path.join(tmp_dirpath, 'dataset1')
+		dirpath2 = os.path.join(tmp_dirpath, 'dataset2')
+		shard_fpaths = generate_expgaussian_pulse_dataset(dirpath1, n_samples, n_samples_per_shard=n_samples_per_shard, n=n, min_max_ambient=(0, 0.01), seed=1, n_workers=1)
+		assert(len(shard_fpaths) == 3), "incorrect number of shards"
+		shards = list(load_dataset_shards(dirpath1))
+		assert([shard['transients'].shape for shard in shards] == [(100, n), (100, n), (50, n)]), "incorrect shard sizes"
+		assert(shards[0]['transients'].dtype == np.float32), "incorrect dtype"
+		assert(np.allclose(shards[0]['transients'].sum(axis=-1), 1 + n*shards[0]['ambient'], atol=1e-4)), "pulses are not normalized or ambient was not added"
+		# Shards do not depend on the number of workers, and missing shards are regenerated
+		generate_expgaussian_pulse_dataset(dirpath2, n_samples, n_samples_per_shard=n_samples_per_shard, n=n, min_max_ambient=(0, 0.01), seed=1, n_workers=2)
+		os.remove(get_shard_fpath(dirpath2, 1))
+		generate_expgaussian_pulse_dataset(dirpath2, n_samples, n_samples_per_shard=n_samples_per_shard, n=n, min_max_ambient=(0, 0.01), seed=1, n_workers=2)
+		for (shard1, shard2) in zip(shards, load_dataset_shards(dirpath2)):
+			assert(np.all(shard1['transients'] == shard2['transients'])), "shards do not match"
+	print("PASSED test_generate_expgaussian_pulse_dataset")
+
+def test_render_expgaussian_pulses(n_samples=10, n=64):
+	for pulse_model in PULSE_MODELS:
+		shard = render_expgaussian_pulses(np.arange(0, n), n_samples, np.random.RandomState(0), pulse_model=pulse_model, chunk_size=3)
+		assert(shard['transients'].shape == (n_samples, n)), "incorrect transients shape"
+		assert(np.allclose(shard['transients'].sum(axis=-1), 1, atol=1e-4)), "pulses are not normalized"
+	# The erfc model does not overflow for long time domains
+	shard = render_expgaussian_pulses(np.arange(0, 2000), 200, np.random.RandomState(0), pulse_model='erfc')
+	assert(np.all(np.isfinite(shard['transients'])) and np.allclose(shard['transients'].sum(axis=-1), 1, atol=1e-3)), "erfc pulses are not finite or normalized"
+	print("PASSED test_render_expgaussian_pulses")
+
+if __name__=='__main__':
+	test_generate_expgaussian_pulse_dataset()
+	test_render_expgaussian_pulses()
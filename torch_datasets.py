@@ -3,6 +3,8 @@
 '''
 ## Standard Library Imports
 import os
+import collections
+import multiprocessing
 
 ## Library Imports
 import numpy as np
@@ -12,7 +14,149 @@ from IPython.core import debugger
 breakpoint = debugger.set_trace
 
 ## Local Imports
-from research_utils.io_ops import get_multi_folder_paired_fnames
+from research_utils.io_ops import save_object, load_object, get_multi_folder_paired_fnames, load_packed_index, get_packed_shard_fpath, get_packed_sample
+
+def get_sample_nbytes(np_data_sample):
+	return sum([data.nbytes if isinstance(data, np.ndarray) else sum([arr.nbytes for arr in data.values()]) for data in np_data_sample])
+
+def copy_sample(np_data_sample, writeable=True):
+	copied_sample = [data.copy() if isinstance(data, np.ndarray) else {key: arr.copy() for (key, arr) in data.items()} for data in np_data_sample]
+	if(not writeable):
+		for data in copied_sample:
+			for arr in ([data] if isinstance(data, np.ndarray) else data.values()): arr.setflags(write=False)
+	return copied_sample
+
+class NumpySampleCache:
+	'''
+		Cache of loaded samples (lists of numpy arrays, or dicts of arrays for .npz files) with a budget of max_nbytes.
+			* If cache_dirpath is None, the samples are kept in memory in this process. With DataLoader workers, each worker 
+			has its own cache (so use persistent_workers=True to keep it across epochs), and the budget is per worker.
+			* If cache_dirpath is given (e.g., a folder in /dev/shm), each sample is stored as a pickle file in it, so the 
+			cache is shared by all the DataLoader workers and persists across epochs (and runs).
+		When the cache goes over max_nbytes, samples are evicted in least recently used order (eviction='lru'), or from the 
+		largest one (eviction='size'), which keeps more samples in the cache, until the cache is below 
+		low_water_ratio*max_nbytes (so that the file-backed cache directory is only scanned once every few samples). 
+		Samples larger than max_nbytes are not cached.
+		The in-process cache stores read-only copies of the samples, and get returns copies of them unless copy=False.
+		The hit, miss and eviction counters are shared across the DataLoader workers (see get_stats). mp_context should be 
+		the same multiprocessing context (e.g., 'spawn') as the DataLoader's multiprocessing_context.
+	'''
+	valid_eviction = ['lru', 'size']
+	def __init__(self, max_nbytes, cache_dirpath=None, eviction='lru', low_water_ratio=0.9, mp_context=None):
+		assert(eviction in self.valid_eviction), "eviction should be one of {}".format(self.valid_eviction)
+		assert((low_water_ratio > 0) and (low_water_ratio <= 1)), "low_water_ratio should be in (0, 1]"
+		self.max_nbytes = max_nbytes
+		self.low_water_nbytes = low_water_ratio*max_nbytes
+		self.cache_dirpath = cache_dirpath
+		self.eviction = eviction
+		mp_context = multiprocessing.get_context(mp_context)
+		self.lock = mp_context.Lock()
+		self.n_hits = mp_context.Value('q', 0, lock=False)
+		self.n_misses = mp_context.Value('q', 0, lock=False)
+		self.n_evictions = mp_context.Value('q', 0, lock=False)
+		# Size of the file-backed cache (shared by all workers), and of the in-process cache (of this process)
+		self.nbytes = mp_context.Value('q', 0, lock=False)
+		self.samples = collections.OrderedDict()
+		self.samples_nbytes = 0
+		if(cache_dirpath is not None):
+			os.makedirs(cache_dirpath, exist_ok=True)
+			# Samples that were cached in a previous run
+			self.nbytes.value = sum([entry_stat.st_size for (_, entry_stat) in self.get_cache_file_stats()])
+			with self.lock: self.evict()
+
+	def __len__(self):
+		if(self.cache_dirpath is None): return len(self.samples)
+		return len(self.get_cache_file_stats())
+
+	def get_cache_fpath(self, key):
+		return os.path.join(self.cache_dirpath, key + '.pkl')
+
+	def get_cache_file_stats(self):
+		with os.scandir(self.cache_dirpath) as dir_entries:
+			return [(entry.path, entry.stat()) for entry in dir_entries if entry.name.endswith('.pkl')]
+
+	def get(self, key, copy=True):
+		'''
+			Returns the cached sample, or None if it is not in the cache. 
+			If copy=False, the in-process cache returns its own (read-only) arrays. The file-backed cache always returns 
+			new arrays.
+		'''
+		sample = None
+		if(self.cache_dirpath is None):
+			if(key in self.samples): 
+				self.samples.move_to_end(key)
+				sample = self.samples[key][0]
+				if(copy): sample = copy_sample(sample)
+		else:
+			cache_fpath = self.get_cache_fpath(key)
+			try:
+				os.utime(cache_fpath)
+				sample = load_object(cache_fpath)
+			except FileNotFoundError: pass
+		with self.lock:
+			if(sample is None): self.n_misses.value += 1
+			else: self.n_hits.value += 1
+		return sample
+
+	def put(self, key, sample):
+		sample_nbytes = get_sample_nbytes(sample)
+		if(sample_nbytes > self.max_nbytes): return
+		if(self.cache_dirpath is None):
+			if(key in self.samples): return
+			# Callers should not be able to modify the cached arrays
+			self.samples[key] = (copy_sample(sample, writeable=False), sample_nbytes)
+			self.samples_nbytes += sample_nbytes
+			with self.lock: self.evict()
+			return
+		# Write the file outside of the lock, and only add it if no other worker cached the same sample
+		cache_fpath = self.get_cache_fpath(key)
+		tmp_cache_fpath = cache_fpath + '.{}.tmp'.format(os.getpid())
+		save_object(sample, tmp_cache_fpath)
+		with self.lock:
+			if(os.path.exists(cache_fpath)): 
+				os.remove(tmp_cache_fpath)
+				return
+			os.replace(tmp_cache_fpath, cache_fpath)
+			self.nbytes.value += os.path.getsize(cache_fpath)
+			self.evict()
+
+	def evict(self):
+		'''
+			If the cache is over budget, evict samples until it is below the low water mark. Should be called with the lock 
+			acquired.
+		'''
+		if(self.cache_dirpath is None):
+			if(self.samples_nbytes <= self.max_nbytes): return
+			while(self.samples_nbytes > self.low_water_nbytes):
+				if(self.eviction == 'lru'): (_, (_, sample_nbytes)) = self.samples.popitem(last=False)
+				else: sample_nbytes = self.samples.pop(max(self.samples, key=lambda key: self.samples[key][1]))[1]
+				self.samples_nbytes -= sample_nbytes
+				self.n_evictions.value += 1
+			return
+		if(self.nbytes.value <= self.max_nbytes): return
+		# The access time of each file is its mtime (see get)
+		cache_file_stats = self.get_cache_file_stats()
+		if(self.eviction == 'lru'): cache_file_stats.sort(key=lambda fpath_stat: fpath_stat[1].st_mtime_ns)
+		else: cache_file_stats.sort(key=lambda fpath_stat: (-fpath_stat[1].st_size, fpath_stat[1].st_mtime_ns))
+		self.nbytes.value = sum([entry_stat.st_size for (_, entry_stat) in cache_file_stats])
+		for (cache_fpath, entry_stat) in cache_file_stats:
+			if(self.nbytes.value <= self.low_water_nbytes): break
+			os.remove(cache_fpath)
+			self.nbytes.value -= entry_stat.st_size
+			self.n_evictions.value += 1
+
+	def get_stats(self):
+		with self.lock:
+			(n_hits, n_misses) = (self.n_hits.value, self.n_misses.value)
+			nbytes = self.samples_nbytes if (self.cache_dirpath is None) else self.nbytes.value
+			return {'hits': n_hits, 'misses': n_misses, 'evictions': self.n_evictions.value, 'nbytes': nbytes, 
+				'hit_rate': n_hits / max(1, n_hits + n_misses)}
+
+	def reset_stats(self):
+		with self.lock:
+			self.n_hits.value = 0
+			self.n_misses.value = 0
+			self.n_evictions.value = 0
 
 class MultiFolderPairedNumpyData(torch.utils.data.Dataset):
 	'''
@@ -26,36 +170,202 @@ class MultiFolderPairedNumpyData(torch.utils.data.Dataset):
 				
 				folder3/f1.npz 
 						f2.npz
+		The filenames are sorted. If manifest_fpath is given, the folder listings are cached in that file (see 
+		get_multi_folder_paired_fnames), so creating the dataset again only rescans the folders that changed.
+		Partial reads:
+			* mmap_mode (e.g., 'r') opens the .npy files as memory-maps (see np.load), so only the parts of the arrays that 
+			are indexed are read from disk. .npz files are always fully read.
+			* __getitem__(idx, crop) indexes all the arrays of the sample with crop (e.g., (slice(0, 32), slice(0, 32))), 
+			so with mmap_mode only the cropped slabs are read.
+			* If random_crop_size is given, the same random crop of size random_crop_size along crop_axes is applied to all 
+			the arrays of the sample (same as torch_utils.multi_img_random_crop, but before loading the arrays). The crop 
+			axes of all the arrays need to have the same size. Negative crop_axes are counted from the last dim of each array, 
+			so with the default crop_axes=(-2, -1) the spatial dims need to be the last ones (e.g., T x H x W and H x W 
+			arrays). For H x W x T and H x W arrays use crop_axes=(0, 1).
+		If a NumpySampleCache is given, the loaded samples (before cropping, and with the .npz files decompressed into dicts)
+		are cached, so epochs after the first one do not read the files again.
 	'''
 	valid_file_ext = ['npy', 'npz']
-	def __init__(self, dirpath_list):
+	def __init__(self, dirpath_list, manifest_fpath=None, mmap_mode=None, random_crop_size=None, crop_axes=(-2, -1), cache=None):
 		assert(len(dirpath_list)>0), "empty dirpath list"
+		assert((random_crop_size is None) or (len(random_crop_size) == len(crop_axes))), "random_crop_size needs one element per crop axis"
 		self.dirpath_list = dirpath_list
 		self.n_dirpaths = len(dirpath_list)
-		(self.base_filenames, self.file_ext_per_dirpath) = get_multi_folder_paired_fnames(dirpath_list, self.valid_file_ext)
+		self.mmap_mode = mmap_mode
+		self.random_crop_size = random_crop_size
+		self.crop_axes = crop_axes
+		self.cache = cache
+		(self.base_filenames, self.file_ext_per_dirpath) = get_multi_folder_paired_fnames(dirpath_list, self.valid_file_ext, manifest_fpath=manifest_fpath)
+		self.base_filename_to_idx = {base_fname: i for (i, base_fname) in enumerate(self.base_filenames)}
 		self.n_samples = len(self.base_filenames)
 	
 	def __len__(self):
 		return self.n_samples
 	
-	def __getitem__(self, idx):
+	def load_np_file(self, fpath):
+		if(fpath.endswith('.npy')): return np.load(fpath, mmap_mode=self.mmap_mode)
+		return np.load(fpath)
+
+	def get_random_crop(self, np_data_sample):
+		'''
+			Returns a function that gives the crop index for an array with ndim dimensions. The crop location is drawn with 
+			torch's random number generator (like torchvision's RandomCrop). 
+			Raises a ValueError if the crop axes do not have the same size in all the arrays of the sample (.npy arrays and 
+			the arrays in the .npz dicts).
+		'''
+		crop_axes_sizes = set()
+		for data in np_data_sample:
+			for arr in ([data] if isinstance(data, np.ndarray) else data.values()):
+				if(arr.ndim < len(self.crop_axes)): raise ValueError("Can't crop a {}D array along crop_axes={}".format(arr.ndim, self.crop_axes))
+				crop_axes_sizes.add(tuple([arr.shape[axis] for axis in self.crop_axes]))
+		if(len(crop_axes_sizes) != 1): 
+			raise ValueError("The crop_axes={} of the arrays of a sample have different sizes {}. With negative crop_axes the spatial dims need to be the last ones of every array".format(self.crop_axes, sorted(crop_axes_sizes)))
+		ref_sizes = crop_axes_sizes.pop()
+		crop_starts = []
+		for (ref_size, crop_size) in zip(ref_sizes, self.random_crop_size):
+			if(ref_size < crop_size): raise ValueError("random_crop_size={} is larger than the arrays {}".format(self.random_crop_size, ref_sizes))
+			crop_starts.append(torch.randint(0, ref_size - crop_size + 1, size=(1,)).item())
+		def get_crop_index(ndim):
+			crop_index = [slice(None)]*ndim
+			for (axis, crop_start, crop_size) in zip(self.crop_axes, crop_starts, self.random_crop_size):
+				crop_index[axis] = slice(crop_start, crop_start + crop_size)
+			return tuple(crop_index)
+		return get_crop_index
+
+	def load_sample(self, base_fname, copy=True):
+		'''
+			If copy=False, the arrays of the sample may be the (read-only) arrays of the cache
+		'''
+		np_data_sample = None
+		if(self.cache is not None): np_data_sample = self.cache.get(base_fname, copy=copy)
+		if(np_data_sample is not None): return np_data_sample
 		np_data_sample = []
+		for i in range(self.n_dirpaths):
+			curr_fpath = os.path.join(self.dirpath_list[i], base_fname + '.' + self.file_ext_per_dirpath[i])
+			np_data_sample.append(self.load_np_file(curr_fpath))
+		if(self.cache is not None):
+			# Read the memory-maps and .npz files before caching them
+			for i in range(self.n_dirpaths):
+				if(isinstance(np_data_sample[i], np.lib.npyio.NpzFile)): 
+					with np_data_sample[i] as npz_file: np_data_sample[i] = {key: npz_file[key] for key in npz_file.files}
+				else: np_data_sample[i] = np.array(np_data_sample[i])
+			self.cache.put(base_fname, np_data_sample)
+		return np_data_sample
+
+	def __getitem__(self, idx, crop=None):
 		curr_base_fname = self.base_filenames[idx]
+		is_cropped = (crop is not None) or (self.random_crop_size is not None)
+		# The cropped arrays are copied, so the cached arrays only need to be copied if there is no crop
+		np_data_sample = list(self.load_sample(curr_base_fname, copy=(not is_cropped)))
+		if(not is_cropped): return (np_data_sample, curr_base_fname)
+		# Read the .npz files once (every NpzFile[key] reads the array again)
 		for i in range(self.n_dirpaths):
-			curr_fpath = os.path.join(self.dirpath_list[i], curr_base_fname + '.' + self.file_ext_per_dirpath[i])
-			np_data_sample.append(np.load(curr_fpath))
+			if(isinstance(np_data_sample[i], np.lib.npyio.NpzFile)): 
+				with np_data_sample[i] as npz_file: np_data_sample[i] = {key: npz_file[key] for key in npz_file.files}
+		if(crop is None): get_crop_index = self.get_random_crop(np_data_sample)
+		else: get_crop_index = lambda ndim: crop
+		# Only the cropped part of memory-mapped arrays is read. The crops are always copied (even if they are contiguous)
+		for i in range(self.n_dirpaths):
+			if(isinstance(np_data_sample[i], dict)):
+				np_data_sample[i] = {key: np.array(arr[get_crop_index(arr.ndim)], order='C') for (key, arr) in np_data_sample[i].items()}
+			else:
+				np_data_sample[i] = np.array(np_data_sample[i][get_crop_index(np_data_sample[i].ndim)], order='C')
 		return (np_data_sample, curr_base_fname)
 
 	def get_sample(self, sample_filename, **kwargs):
 		'''
 			kwargs are any extra key-word args that __getitem__ may take as input
 		'''
-		try:
-			idx = self.base_filenames.index(sample_filename)
-			return self.__getitem__(idx, **kwargs)
-		except ValueError:
+		if(not (sample_filename in self.base_filename_to_idx)):
+			print("{} not in datasets".format(sample_filename))
+			return None
+		return self.__getitem__(self.base_filename_to_idx[sample_filename], **kwargs)
+
+class PackedPairedNumpyData(torch.utils.data.Dataset):
+	'''
+		Same samples as MultiFolderPairedNumpyData, but read from the shards created with io_ops.pack_multi_folder_paired_data.
+		The shards are memory-mapped (opened lazily, so each DataLoader worker opens its own), and the arrays of each sample 
+		are views into the shards (no copies). The default mmap_mode='c' (copy-on-write) gives writable arrays without 
+		modifying the shards.
+	'''
+	def __init__(self, packed_dirpath, mmap_mode='c'):
+		self.packed_dirpath = packed_dirpath
+		self.mmap_mode = mmap_mode
+		self.index = load_packed_index(packed_dirpath)
+		self.base_filenames = [sample_info['base_fname'] for sample_info in self.index['samples']]
+		self.base_filename_to_idx = {base_fname: i for (i, base_fname) in enumerate(self.base_filenames)}
+		self.n_samples = len(self.base_filenames)
+		self.n_shards = len(self.index['shards'])
+		self.shard_buffers = {}
+
+	def __getstate__(self):
+		# Do not pickle the memory-maps when the dataset is sent to the DataLoader workers
+		state = dict(self.__dict__)
+		state['shard_buffers'] = {}
+		return state
+
+	def __len__(self):
+		return self.n_samples
+
+	def get_shard_buffer(self, shard_idx):
+		if(not (shard_idx in self.shard_buffers)):
+			self.shard_buffers[shard_idx] = np.memmap(get_packed_shard_fpath(self.packed_dirpath, shard_idx), dtype=np.uint8, mode=self.mmap_mode)
+		return self.shard_buffers[shard_idx]
+
+	def __getitem__(self, idx):
+		sample_info = self.index['samples'][idx]
+		return (get_packed_sample(self.get_shard_buffer(sample_info['shard_idx']), sample_info), sample_info['base_fname'])
+
+	def get_sample(self, sample_filename, **kwargs):
+		'''
+			kwargs are any extra key-word args that __getitem__ may take as input
+		'''
+		if(not (sample_filename in self.base_filename_to_idx)):
 			print("{} not in datasets".format(sample_filename))
 			return None
+		return self.__getitem__(self.base_filename_to_idx[sample_filename], **kwargs)
+
+class PackedPairedNumpyIterableData(torch.utils.data.IterableDataset):
+	'''
+		Iterate over the samples of a packed dataset (see PackedPairedNumpyData) in shard order, so that the shards are read 
+		sequentially. 
+			* With DataLoader workers, each worker iterates over a different subset of the shards.
+			* If shuffle_shards, the order of the shards of each worker is shuffled every epoch.
+			* If shuffle_buffer_size > 1, samples are shuffled with a buffer of that many samples (each sample is drawn at 
+			random from the buffer, and replaced with the next sample of the shards). 
+		The random numbers are drawn with torch's generator, which is seeded differently for every worker and epoch.
+	'''
+	def __init__(self, packed_dirpath, shuffle_buffer_size=1, shuffle_shards=False, mmap_mode='c'):
+		self.packed_data = PackedPairedNumpyData(packed_dirpath, mmap_mode=mmap_mode)
+		self.shuffle_buffer_size = shuffle_buffer_size
+		self.shuffle_shards = shuffle_shards
+
+	def __len__(self):
+		return len(self.packed_data)
+
+	def get_shard_ids(self):
+		shard_ids = list(range(self.packed_data.n_shards))
+		worker_info = torch.utils.data.get_worker_info()
+		if(worker_info is not None): shard_ids = shard_ids[worker_info.id::worker_info.num_workers]
+		if(self.shuffle_shards): shard_ids = [shard_ids[i] for i in torch.randperm(len(shard_ids)).tolist()]
+		return shard_ids
+
+	def __iter__(self):
+		shuffle_buffer = []
+		for shard_idx in self.get_shard_ids():
+			(start_idx, end_idx) = self.packed_data.index['shards'][shard_idx]['samples']
+			for idx in range(start_idx, end_idx):
+				sample = self.packed_data[idx]
+				if(self.shuffle_buffer_size <= 1): 
+					yield sample
+					continue
+				if(len(shuffle_buffer) < self.shuffle_buffer_size): 
+					shuffle_buffer.append(sample)
+					continue
+				buffer_idx = torch.randint(0, self.shuffle_buffer_size, size=(1,)).item()
+				yield shuffle_buffer[buffer_idx]
+				shuffle_buffer[buffer_idx] = sample
+		for buffer_idx in torch.randperm(len(shuffle_buffer)).tolist(): yield shuffle_buffer[buffer_idx]
 
 if __name__=='__main__':
 	dirpath1 = '/home/felipe/Dropbox/research_projects/data/synthetic_data_min/data_no-conductors_no-dielectric_automatic/transient_images_120x160_nt-2000'
@@ -0,0 +1,122 @@
+'''
+	Generate large synthetic datasets of exponentially modified gaussian pulses (transients) with ambient light.
+	The dataset is split into fixed-size shards that are generated in parallel by a process pool and written to disk as
+	they are done, so memory use does not depend on the dataset size. Each shard is generated with its own seeded random
+	number generator, so the dataset is the same for any number of workers, and an interrupted generation can be resumed
+	by calling generate_expgaussian_pulse_dataset again (shards that already exist are skipped).
+	Example:
+		generate_expgaussian_pulse_dataset('./pulse_dataset', n_samples=1000000, n=2000, min_max_ambient=(0, 0.01), seed=0)
+		for shard in load_dataset_shards('./pulse_dataset'): train_step(shard['transients'])
+'''
+## Standard Library Imports
+import os
+import concurrent.futures
+
+## Library Imports
+import numpy as np
+from IPython.core import debugger
+breakpoint = debugger.set_trace
+
+## Local Imports
+from .signalproc_ops import verify_time_domain, get_random_expgaussian_pulse_params, expgaussian_pulse_conv, expgaussian_pulse_erfc
+from .np_utils import get_chunk_slices
+from .io_ops import load_json, write_json
+
+PULSE_MODELS = ['conv', 'erfc']
+CONFIG_FNAME = 'dataset_config.json'
+
+def get_shard_fpath(dirpath, shard_idx):
+	return os.path.join(dirpath, 'shard_{:06d}.npz'.format(shard_idx))
+
+def get_shard_rng(seed, shard_idx):
+	'''
+		Independent random number generator for each shard, derived from the dataset seed and the shard index
+	'''
+	shard_seed = np.random.SeedSequence([seed, shard_idx]).generate_state(1)[0]
+	return np.random.RandomState(shard_seed)
+
+def render_expgaussian_pulses(time_domain, n_samples, rng, min_max_sigma=None, min_max_lambda=None, min_max_ambient=None, pulse_model='conv', dtype=np.float32, chunk_size=1024):
+	'''
+		Draw the parameters of n_samples exponentially modified gaussian pulses, render them and add a constant ambient level
+		(drawn uniformly from min_max_ambient) to each time bin. Pulses are rendered in chunks of chunk_size.
+		Returns a dict with the transients and the parameters used to generate them.
+	'''
+	assert(pulse_model in PULSE_MODELS), "pulse_model should be one of {}".format(PULSE_MODELS)
+	(time_domain, n, tau, dt) = verify_time_domain(time_domain)
+	(mu, sigma, exp_lambda) = get_random_expgaussian_pulse_params(time_domain=time_domain, min_max_sigma=min_max_sigma, min_max_lambda=min_max_lambda, n_samples=n_samples, rng=rng)
+	if(min_max_ambient is None): ambient = np.zeros((n_samples,))
+	else: ambient = rng.uniform(low=min_max_ambient[0], high=min_max_ambient[1], size=(n_samples,))
+	transients = np.zeros((n_samples, n), dtype=dtype)
+	for chunk in get_chunk_slices(n_samples, chunk_size):
+		if(pulse_model == 'conv'): pulses = expgaussian_pulse_conv(time_domain, mu[chunk], sigma[chunk], exp_lambda[chunk])
+		else: pulses = expgaussian_pulse_erfc(time_domain, mu[chunk], sigma[chunk, np.newaxis], exp_lambda[chunk, np.newaxis])
+		transients[chunk] = pulses.reshape((-1, n)) + ambient[chunk, np.newaxis]
+	return {'transients': transients, 'mu': mu, 'sigma': sigma, 'exp_lambda': exp_lambda, 'ambient': ambient}
+
+def generate_shard(dirpath, shard_idx, n_samples, config):
+	'''
+		Generate a single shard and write it to disk. The shard is first written to a temporary file that is then renamed,
+		so a shard file only exists if it was fully written.
+	'''
+	rng = get_shard_rng(config['seed'], shard_idx)
+	shard = render_expgaussian_pulses(np.array(config['time_domain']), n_samples, rng,
+		min_max_sigma=config['min_max_sigma'], min_max_lambda=config['min_max_lambda'], min_max_ambient=config['min_max_ambient'],
+		pulse_model=config['pulse_model'], dtype=np.dtype(config['dtype']))
+	assert(np.all(np.isfinite(shard['transients']))), "shard {} has non-finite transients".format(shard_idx)
+	shard_fpath = get_shard_fpath(dirpath, shard_idx)
+	tmp_shard_fpath = shard_fpath + '.tmp.npz'
+	np.savez(tmp_shard_fpath, **shard)
+	os.replace(tmp_shard_fpath, shard_fpath)
+	return shard_fpath
+
+def generate_expgaussian_pulse_dataset(dirpath, n_samples, n_samples_per_shard=10000, time_domain=None, n=1000, min_max_sigma=None, min_max_lambda=None, min_max_ambient=None, pulse_model='conv', dtype=np.float32, seed=0, n_workers=None):
+	'''
+		Generate a dataset of n_samples transients, split into shards of n_samples_per_shard samples that are written to dirpath.
+		Shards are generated in parallel by n_workers processes (all cores by default, and no process pool if n_workers=1).
+		If dirpath already contains a dataset with the same configuration, only the missing shards are generated.
+		Returns the list of shard filepaths.
+	'''
+	assert(n_samples > 0), "n_samples should be positive"
+	assert(n_samples_per_shard > 0), "n_samples_per_shard should be positive"
+	(time_domain, n, tau, dt) = verify_time_domain(time_domain, n)
+	config = {
+		'n_samples': int(n_samples),
+		'n_samples_per_shard': int(n_samples_per_shard),
+		'time_domain': time_domain.tolist(),
+		'min_max_sigma': None if (min_max_sigma is None) else list(min_max_sigma),
+		'min_max_lambda': None if (min_max_lambda is None) else list(min_max_lambda),
+		'min_max_ambient': None if (min_max_ambient is None) else list(min_max_ambient),
+		'pulse_model': pulse_model,
+		'dtype': np.dtype(dtype).name,
+		'seed': int(seed)
+	}
+	os.makedirs(dirpath, exist_ok=True)
+	config_fpath = os.path.join(dirpath, CONFIG_FNAME)
+	if(os.path.exists(config_fpath)):
+		assert(load_json(config_fpath) == config), "{} contains a dataset generated with a different configuration".format(dirpath)
+	else:
+		write_json(config_fpath, config)
+	# Find the shards that still need to be generated
+	n_shards = int(np.ceil(n_samples / n_samples_per_shard))
+	shard_fpaths = [get_shard_fpath(dirpath, i) for i in range(n_shards)]
+	missing_shards = [i for i in range(n_shards) if (not os.path.exists(shard_fpaths[i]))]
+	missing_shards_n_samples = [min(n_samples_per_shard, n_samples - i*n_samples_per_shard) for i in missing_shards]
+	print("Generating {} out of {} shards in {}".format(len(missing_shards), n_shards, dirpath))
+	if(n_workers == 1):
+		for (shard_idx, shard_n_samples) in zip(missing_shards, missing_shards_n_samples):
+			generate_shard(dirpath, shard_idx, shard_n_samples, config)
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+			futures = [executor.submit(generate_shard, dirpath, shard_idx, shard_n_samples, config) for (shard_idx, shard_n_samples) in zip(missing_shards, missing_shards_n_samples)]
+			for future in concurrent.futures.as_completed(futures): future.result()
+	return shard_fpaths
+
+def load_dataset_shards(dirpath):
+	'''
+		Iterate over the shards of a dataset generated with generate_expgaussian_pulse_dataset, one shard at a time.
+	'''
+	config = load_json(os.path.join(dirpath, CONFIG_FNAME))
+	n_shards = int(np.ceil(config['n_samples'] / config['n_samples_per_shard']))
+	for i in range(n_shards):
+		with np.load(get_shard_fpath(dirpath, i)) as shard:
+			yield dict(shard)